@@ -2,10 +2,51 @@
 """
 This file contains definitions of all the API paths and is meant to be ran as a
 Flask app.
+
+Importing drywall doesn't read the config file or touch the database; use
+create_app to get a ready to use app:
+
+    $ FLASK_APP="drywall:create_app()" flask run
 """
 from drywall import config
 
 from flask import Flask
+from werkzeug.middleware.proxy_fix import ProxyFix
 app = Flask(__name__)
 app.config['JSON_SORT_KEYS'] = False
-app.secret_key = config.get("secret")
+# The app without ProxyFix, so that create_app can be called more than once
+_wsgi_app = app.wsgi_app
+
+def create_app(config_path=None):
+	"""
+	Sets up the app and returns it. This loads the config file (from the
+	given path, if any) and registers all routes and commands, but doesn't
+	connect to the database; connections are opened when they're first
+	needed. This makes it cheap to load the app once in a pre-fork server's
+	master process and fork workers from it.
+
+	The database has to be set up with the init-db command before the first
+	start, and updated with the migrate command after upgrading.
+
+	If the trusted_proxies setting is set to the amount of reverse proxies
+	in front of the app, the client's address, scheme and host are taken
+	from the X-Forwarded-* headers set by them, so that rate limits are kept
+	per client instead of per proxy.
+	"""
+	if config_path:
+		config.load(config_path)
+	app.secret_key = config.get("secret")
+	proxies = config.get("trusted_proxies") or 0
+	if proxies:
+		app.wsgi_app = ProxyFix(_wsgi_app, x_for=proxies, x_proto=proxies, x_host=proxies)
+	else:
+		app.wsgi_app = _wsgi_app
+
+	from drywall import api # noqa: F401
+	from drywall import cli
+	if 'init-db' not in app.cli.commands:
+		app.cli.add_command(cli.init_db_command)
+		app.cli.add_command(cli.migrate_command)
+		app.cli.add_command(cli.purge_deleted_command)
+		app.cli.add_command(cli.run_jobs_command)
+	return app
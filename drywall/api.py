@@ -7,33 +7,207 @@ from drywall import objects
 from drywall import pings
 from drywall import app
 from drywall import config
+from drywall import deletion
+from drywall import directory
 from drywall import auth # noqa: F401
+from drywall import metrics # noqa: F401
+from drywall import permissions
+from drywall import tokens # noqa: F401
+from drywall import ratelimit # noqa: F401
+from drywall import utils
 
+import datetime
 import simplejson as json
-from flask import Response, request
+from flask import Response, g, request
+from sqlalchemy.exc import IntegrityError
 
 VERSION = "0.1"
 
-# Define our instance.
-instance_dict = {"type": "object", "object_type": "instance",
-                 "address": config.get('instance_domain'),
-                 "server_software": "drywall " + VERSION,
-                 "name": config.get('instance_name'),
-                 "description": config.get('instance_description')}
-created_instance_object = objects.make_object_from_dict(instance_dict, extend="0",
-                          ignore_nonexistent_id_in_extend=True)
-if not db.id_taken("0"):
-	db.add_object(created_instance_object)
-else:
-	db.push_object(id="0", object=created_instance_object)
+def push_instance():
+	"""
+	Creates or updates our instance object (ID 0) from the instance settings.
+	This is done by the init-db and migrate commands, so that starting a
+	worker doesn't have to write to the database.
+	"""
+	instance_dict = {"type": "object", "object_type": "instance",
+	                 "address": config.get('instance_domain'),
+	                 "server_software": "drywall " + VERSION,
+	                 "name": config.get('instance_name'),
+	                 "description": config.get('instance_description')}
+	created_instance_object = objects.make_object_from_dict(instance_dict, extend="0",
+	                          ignore_nonexistent_id_in_extend=True)
+	if not db.id_taken("0"):
+		db.add_object(created_instance_object)
+	else:
+		db.push_object(id="0", object=created_instance_object)
+
+# Scopes needed for each method, by the object type of the conference or
+# channel the permissions are checked in; see permissions.authorize. Roles,
+# conference members and invites are checked in their conference, messages
+# in their channel.
+CONFERENCE_SCOPES = {"conference": {"GET": "conference:read", "PATCH": "conference:moderate", "DELETE": "conference:moderate"}}
+CHANNEL_SCOPES = {"channel": {"GET": "conference:read", "PATCH": "channel:moderate", "DELETE": "channel:moderate"}}
+REPORT_SCOPES = {**{object_type: {"POST": "conference:read"}
+                    for object_type in ["conference", "channel", *permissions.CONFERENCE_CHILD_TYPES]},
+                 "message": {"POST": "channel:read"}}
+MEMBER_SCOPES = {object_type: {"POST": "conference:moderate", "GET": "conference:read",
+                               "PATCH": "conference_member:moderate_nick", "DELETE": "conference_member:kick"}
+                 for object_type in ["conference", "conference_member"]}
+MEMBER_KEY_SCOPES = {object_type: {"roles": "role:moderate", "permissions": "role:moderate", "banned": "conference_member:ban"}
+                     for object_type in ["conference", "conference_member"]}
+CONFERENCE_CHANNEL_SCOPES = {"conference": {"POST": "channel:moderate"}, **CHANNEL_SCOPES}
+ROLE_SCOPES = {object_type: {"POST": "role:moderate", "GET": "conference:read",
+                             "PATCH": "role:moderate", "DELETE": "role:moderate"}
+               for object_type in ["conference", "role"]}
+INVITE_SCOPES = {object_type: {"POST": "invite:create", "GET": "conference:read",
+                               "PATCH": "invite:create", "DELETE": "invite:create"}
+                 for object_type in ["conference", "invite"]}
+# Changing messages also depends on the author; see _message_author_error.
+MESSAGE_SCOPES = {"channel": {"POST": "channel:write", "GET": "channel:read",
+                              "PATCH": "channel:write", "DELETE": "channel:read"}}
+MESSAGE_REPORT_SCOPES = {"channel": REPORT_SCOPES["message"]}
+OBJECT_SCOPES = {**CONFERENCE_SCOPES, **CHANNEL_SCOPES, "role": ROLE_SCOPES["role"],
+                 "conference_member": MEMBER_SCOPES["conference_member"], "invite": INVITE_SCOPES["invite"],
+                 "message": MESSAGE_SCOPES["channel"]}
+OBJECT_KEY_SCOPES = {"conference_member": MEMBER_KEY_SCOPES["conference_member"]}
+NEW_CHANNEL_SCOPES = {"conference": {"POST": "channel:moderate"}, None: {"POST": None}}
+NEW_CONFERENCE_SCOPES = {None: {"POST": None}}
+SEARCH_SCOPES = {"channel": {"GET": "channel:read"}, None: {"GET": "channel:read"}}
+DIRECTORY_SCOPES = {None: {"GET": None}}
+REPORT_LIST_SCOPES = {"conference": {"GET": "message:moderate"}, None: {"GET": None}}
+READ_STATE_SCOPES = {"channel": {"POST": "channel:read"}}
+UNREAD_SCOPES = {"conference": {"GET": "channel:read"}, None: {"GET": "channel:read"}}
+DIRECT_MESSAGE_SCOPES = {None: {"POST": None}}
+REACTION_SCOPES = {"channel": {"PUT": "channel:write", "DELETE": "channel:write"}}
+REPLY_SCOPES = {"channel": {"GET": "channel:read"}}
+
+# Maximum length of reaction emojis, which can be custom emoji names.
+MAX_EMOJI_LENGTH = 64
+
+# Keys that can be requested with the fields query parameter.
+OBJECT_FIELDS = {"id", "type", "object_type", "reaction_counts"}.union(*[object.valid_keys for object in objects.objects])
+
+# Default and maximum amount of objects returned in one page.
+DEFAULT_PAGE_LIMIT = 25
+MAX_PAGE_LIMIT = 100
+
+def _parent_conference_from_body():
+	"""Returns the parent_conference value from the request's JSON body."""
+	body = request.get_json(silent=True)
+	if isinstance(body, dict):
+		return body.get('parent_conference')
+	return None
+
+def _parent_channel_from_body():
+	"""Returns the parent_channel value from the request's JSON body."""
+	body = request.get_json(silent=True)
+	if isinstance(body, dict):
+		return body.get('parent_channel')
+	return None
+
+def _invite_conference_from_body():
+	"""Returns the conference_id value from the request's JSON body."""
+	body = request.get_json(silent=True)
+	if isinstance(body, dict):
+		return body.get('conference_id')
+	return None
+
+def _channel_from_args():
+	"""Returns the channel query parameter."""
+	return request.args.get('channel')
+
+def _conference_from_args():
+	"""Returns the conference query parameter."""
+	return request.args.get('conference')
+
+def _channel_from_message():
+	"""
+	Returns the channel of the message in the message_id URL variable, or
+	None if there is no such message. The message dict is kept in g.message.
+	"""
+	messages = db.get_objects_as_dicts_by_ids('message', [request.view_args['message_id']])
+	g.message = messages[0] if messages else None
+	return g.message['parent_channel'] if g.message else None
+
+def _message_error(message_id):
+	"""
+	Returns an error response if the message loaded by _channel_from_message
+	doesn't exist or its channel was deleted, None otherwise.
+	"""
+	if not g.get('message') or not permissions.get_object_type(g.message['parent_channel']):
+		object_type = permissions.get_object_type(message_id)
+		if object_type and object_type != 'message':
+			return pings.response_from_error(5)
+		return pings.response_from_error(4)
+	return None
+
+def _message_author_error(message):
+	"""
+	Returns an error response if the request's account may not change a
+	message dict with the request's method, None otherwise. Messages can
+	only be edited by their author, and deleted by their author or accounts
+	that can moderate messages in the channel.
+	"""
+	if request.method not in ('PATCH', 'DELETE') or not message:
+		return None
+	if not g.get('token'):
+		return pings.response_from_error(12)
+	if message['author'] == g.token['account']:
+		return None
+	if request.method == 'DELETE':
+		return permissions.check_scope('message:moderate', message['parent_channel'])
+	return pings.response_from_error(3)
+
+def _get_page_limit():
+	"""
+	Returns the limit query parameter as an int. Raises a ValueError if it's
+	not a number between 1 and MAX_PAGE_LIMIT.
+	"""
+	limit = int(request.args.get('limit', DEFAULT_PAGE_LIMIT))
+	if limit < 1 or limit > MAX_PAGE_LIMIT:
+		raise ValueError("limit must be between 1 and " + str(MAX_PAGE_LIMIT))
+	return limit
+
+def _get_fields():
+	"""
+	Returns the keys in the comma-separated fields query parameter as a
+	list, or None if it's not set. Raises a ValueError if one of them isn't
+	a key of any object.
+	"""
+	value = request.args.get('fields')
+	if value is None:
+		return None
+	fields = [field.strip() for field in value.split(',') if field.strip()]
+	for field in fields:
+		if field not in OBJECT_FIELDS:
+			raise ValueError("Unknown field: " + field)
+	return fields
+
+def _get_datetime_arg(name):
+	"""
+	Returns the query parameter with the given name as a naive UTC datetime,
+	or None if it's not set. Raises a ValueError if it's not an ISO 8601
+	date.
+	"""
+	value = request.args.get(name)
+	if not value:
+		return None
+	try:
+		date = datetime.datetime.fromisoformat(value)
+	except ValueError:
+		raise ValueError(name + " must be an ISO 8601 date")
+	if date.tzinfo:
+		date = date.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+	return date
 
 # Function templates
 
-def api_get(object_id, object_type=None):
+def api_get(object_id, object_type=None, fields=None):
 	"""
-	Gets an object by ID and returns the required object.
+	Gets an object by ID and returns the required object. If a list of keys
+	is given in fields, only those keys are loaded and returned.
 	"""
-	object = db.get_object_as_dict_by_id(object_id)
+	object = db.get_object_as_dict_by_id(object_id, fields=fields)
 	if not object:
 		return pings.response_from_error(4)
 	if object_type and not object['object_type'] == object_type:
@@ -64,7 +238,11 @@ def api_patch(object_id, object_type=None):
 	if object_type and not object.__dict__['object_type'] == object_type:
 		return pings.response_from_error(5)
 
-	db.push_object(object_id, object)
+	try:
+		db.push_object(object_id, object)
+	except IntegrityError:
+		# A unique value was taken between the checks and the update
+		return pings.response_from_error(10)
 
 	return object.__dict__
 
@@ -85,13 +263,19 @@ def api_post(object_dict, object_type=None):
 	except KeyError as e:
 		return pings.response_from_error(7, error_message=e)
 
-	db.add_object(object)
+	try:
+		db.add_object(object)
+	except IntegrityError:
+		# A unique value was taken between the checks and the insert
+		return pings.response_from_error(10)
 
 	return Response(json.dumps(object.__dict__), status=201, mimetype='application/json')
 
 def api_delete(object_id, object_type=None):
 	"""
-	Deletes an object by ID.
+	Deletes an object by ID. Conferences and channels are removed in the
+	background, along with everything in them (see the deletion module);
+	for those, a 202 response is returned right away.
 	"""
 	object = db.get_object_as_dict_by_id(object_id)
 	if not object:
@@ -99,14 +283,29 @@ def api_delete(object_id, object_type=None):
 	if object_type and not object['object_type'] == object_type:
 		return pings.response_from_error(5)
 
+	if object['object_type'] in deletion.CASCADE_TYPES:
+		deletion.delete(object_id, object['object_type'])
+		return Response(json.dumps({"id": object_id}), status=202, mimetype='application/json')
 	return {"id": db.delete_object(object_id)}
 
 def api_get_patch_delete(object_id, object_type=None):
 	"""
-	Gets/patches an object by ID depending on the method.
+	Gets/patches an object by ID depending on the method. Messages are
+	returned with their reaction counts in the reaction_counts variable.
+
+	GET requests can limit the returned keys with the fields query
+	parameter; see _get_fields.
 	"""
 	if request.method == "GET":
-		return api_get(object_id, object_type=object_type)
+		try:
+			fields = _get_fields()
+		except ValueError as e:
+			return pings.response_from_error(13, error_message=e)
+		object = api_get(object_id, object_type=object_type, fields=fields)
+		if isinstance(object, dict) and object['object_type'] == 'message' and \
+				(fields is None or 'reaction_counts' in fields):
+			object['reaction_counts'] = db.get_reaction_counts([object_id]).get(object_id, {})
+		return object
 	elif request.method == "PATCH":
 		return api_patch(object_id, object_type=object_type)
 	elif request.method == "DELETE":
@@ -139,19 +338,29 @@ def api_get_patch_delete_conference_child(conference_id, object_type, object_id)
 	if not db.id_taken(conference_id):
 		return pings.response_from_error(4)
 
-	try:
-		object_get = api_get(object_id, object_type=object_type)
-		object_get_id = object_get['id']
-	except:
-		return object_get
 	if object_type == "invite":
 		conference_id_key = "conference_id"
 	else:
 		conference_id_key = "parent_conference"
+	fields = None
+	if request.method == "GET":
+		try:
+			fields = _get_fields()
+		except ValueError as e:
+			return pings.response_from_error(13, error_message=e)
+
+	try:
+		object_get = api_get(object_id, object_type=object_type,
+			fields=fields + [conference_id_key] if fields is not None else None)
+		object_get_id = object_get['id']
+	except:
+		return object_get
 	if object_get[conference_id_key] != conference_id:
 		error_message = "The given " + object_type + " does not belong to the given conference"
 		return pings.response_from_error(8, error_message=error_message)
 	if request.method == "GET":
+		if fields is not None and conference_id_key not in fields:
+			del object_get[conference_id_key]
 		return object_get
 	else:
 		return api_get_patch_delete(object_get_id, object_type=object_type)
@@ -216,18 +425,43 @@ def api_get_instance():
 
 @app.route('/api/v1/id', methods=['POST'])
 def api_post_by_id():
-	"""Takes an object and creates the object on the server."""
-	return api_post(request.json)
+	"""
+	Takes an object and creates the object on the server. Conferences and
+	objects in them are passed on to the endpoint for their object type, so
+	that the same permissions are checked.
+	"""
+	object_dict = request.json
+	object_type = object_dict.get('object_type') if isinstance(object_dict, dict) else None
+	if object_type == "conference":
+		return api_post_conference()
+	elif object_type == "channel":
+		return api_post_channel()
+	elif object_type == "conference_member":
+		return api_post_conference_member(conference_id=object_dict.get('parent_conference'))
+	elif object_type == "role":
+		return api_post_role()
+	elif object_type == "invite":
+		return api_post_invite()
+	elif object_type == "message":
+		return api_post_message()
+	return api_post(object_dict)
 
 @app.route('/api/v1/id/<object_id>', methods=['GET', 'PATCH', 'DELETE'])
+@permissions.authorize(OBJECT_SCOPES, target='object_id', key_scopes=OBJECT_KEY_SCOPES)
 def api_get_patch_delete_by_id(object_id):
 	"""
 	Takes an object ID and returns/patches/deletes the object with the
 	provided ID.
 	"""
+	if request.method != 'GET' and permissions.get_object_type(object_id) == 'message':
+		messages = db.get_objects_as_dicts_by_ids('message', [object_id])
+		error = _message_author_error(messages[0] if messages else None)
+		if error:
+			return error
 	return api_get_patch_delete(object_id=object_id)
 
 @app.route('/api/v1/id/<object_id>/report', methods=['POST'])
+@permissions.authorize(REPORT_SCOPES, target='object_id')
 def api_report_by_id(object_id):
 	"""
 	Takes an object ID and report data and reports the object with the
@@ -238,7 +472,11 @@ def api_report_by_id(object_id):
 @app.route('/api/v1/stash/request', methods=['POST'])
 def api_stash_request():
 	"""
-	Creates and returns a new stash.
+	Creates and returns a new stash. The keys of the objects in it can be
+	limited with the fields query parameter; see _get_fields.
+
+	Objects that can only be read with a permission are checked the same
+	way as on /api/v1/id/<object_id>.
 	"""
 	data_dict = request.json
 	if not data_dict:
@@ -249,12 +487,29 @@ def api_stash_request():
 	id_list = data_dict['id_list']
 
 	try:
-		stash = objects.create_stash(id_list)
+		fields = _get_fields()
+	except ValueError as e:
+		return pings.response_from_error(13, error_message=e)
+
+	# The keys pointing at conferences and channels are needed for the
+	# permission checks
+	parent_keys = set(permissions.CONFERENCE_CHILD_TYPES.values()).union(permissions.CHANNEL_CHILD_TYPES.values())
+	try:
+		stash = objects.create_stash(id_list,
+			fields=fields + list(parent_keys) if fields is not None else None)
 	except ValueError:
 		return pings.response_from_error(11)
 	except KeyError as e:
 		return pings.response_from_error(9, error_message=str(e))
 
+	object_dicts = [stash[id] for id in dict.fromkeys(id_list)]
+	error = permissions.authorize_objects(OBJECT_SCOPES, object_dicts)
+	if error:
+		return error
+	if fields is not None:
+		for object_dict in object_dicts:
+			for key in parent_keys.difference(fields):
+				object_dict.pop(key, None)
 	return stash
 
 # Accounts
@@ -288,6 +543,7 @@ def api_report_account(account_id):
 # Conferences
 
 @app.route('/api/v1/conferences', methods=['POST'])
+@permissions.authorize(NEW_CONFERENCE_SCOPES)
 def api_post_conference():
 	"""
 	Takes a Conference object and creates it on the server.
@@ -295,6 +551,7 @@ def api_post_conference():
 	return api_post(request.json, object_type="conference")
 
 @app.route('/api/v1/conferences/<conference_id>', methods=["GET", "PATCH", "DELETE"])
+@permissions.authorize(CONFERENCE_SCOPES, target='conference_id')
 def api_get_patch_delete_conference(conference_id):
 	"""
 	Takes the ID of a Conference object and returns the object with
@@ -303,6 +560,7 @@ def api_get_patch_delete_conference(conference_id):
 	return api_get_patch_delete(object_id=conference_id, object_type="conference")
 
 @app.route('/api/v1/conferences/<conference_id>/report', methods=['POST'])
+@permissions.authorize(REPORT_SCOPES, target='conference_id')
 def api_report_conference(conference_id):
 	"""
 	Takes a conference ID and report data and reports the object with the
@@ -310,7 +568,40 @@ def api_report_conference(conference_id):
 	"""
 	return api_report(request.json, conference_id, object_type="conference")
 
+@app.route('/api/v1/conferences/<conference_id>/members', methods=['GET'])
+@permissions.authorize(MEMBER_SCOPES, target='conference_id')
+def api_get_conference_members(conference_id):
+	"""
+	Lists the members of a conference, ordered by account ID.
+
+	Query parameters:
+	  - user_id - only list the member for the account with this ID
+	  - limit - amount of results per page (1-100, default 25)
+	  - cursor - the next_cursor value from the previous page
+	"""
+	object_type = permissions.get_object_type(conference_id)
+	if not object_type:
+		return pings.response_from_error(4)
+	if object_type != 'conference':
+		return pings.response_from_error(5)
+	try:
+		limit = _get_page_limit()
+		after = None
+		if request.args.get('cursor'):
+			after = utils.decode_cursor(request.args['cursor'], 1)[0]
+	except (ValueError, TypeError) as e:
+		return pings.response_from_error(13, error_message=e)
+
+	members = db.get_conference_members(conference_id, user_id=request.args.get('user_id'),
+	                                    after=after, limit=limit + 1)
+	next_cursor = None
+	if len(members) > limit:
+		members = members[:limit]
+		next_cursor = utils.encode_cursor([members[-1]['user_id']])
+	return {"type": "member_list", "results": members, "next_cursor": next_cursor}
+
 @app.route('/api/v1/conferences/<conference_id>/members', methods=['POST'])
+@permissions.authorize(MEMBER_SCOPES, target='conference_id', key_scopes=MEMBER_KEY_SCOPES)
 def api_post_conference_member(conference_id):
 	"""
 	Takes a ConferenceMember object and creates it on the server.
@@ -320,6 +611,7 @@ def api_post_conference_member(conference_id):
 
 @app.route('/api/v1/conferences/<conference_id>/members/<member_id>',
            methods=["GET", "PATCH", "DELETE"])
+@permissions.authorize(MEMBER_SCOPES, target='conference_id', key_scopes=MEMBER_KEY_SCOPES)
 def api_get_patch_delete_conference_member(conference_id, member_id):
 	"""
 	Gets/patches/deletes a ConferenceMember in the conference by ID.
@@ -327,6 +619,7 @@ def api_get_patch_delete_conference_member(conference_id, member_id):
 	return api_get_patch_delete_conference_child(conference_id, "conference_member", member_id)
 
 @app.route('/api/v1/conferences/<conference_id>/members/<member_id>/report', methods=['POST'])
+@permissions.authorize(REPORT_SCOPES, target='conference_id')
 def api_report_conference_member(conference_id, member_id):
 	"""
 	Takes an conference member ID and report data and reports the object with
@@ -335,6 +628,7 @@ def api_report_conference_member(conference_id, member_id):
 	return api_report_conference_child(conference_id, request.json, member_id, object_type="conference_member")
 
 @app.route('/api/v1/conferences/<conference_id>/channels', methods=['POST'])
+@permissions.authorize(CONFERENCE_CHANNEL_SCOPES, target='conference_id')
 def api_post_conference_channel(conference_id):
 	"""
 	Takes a Channel object and creates it on the server.
@@ -344,6 +638,7 @@ def api_post_conference_channel(conference_id):
 
 @app.route('/api/v1/conferences/<conference_id>/channels/<channel_id>',
            methods=["GET", "PATCH", "DELETE"])
+@permissions.authorize(CONFERENCE_CHANNEL_SCOPES, target='channel_id')
 def api_get_patch_delete_conference_channel(conference_id, channel_id):
 	"""
 	Gets/patches/deletes a channel in the conference by ID.
@@ -351,6 +646,7 @@ def api_get_patch_delete_conference_channel(conference_id, channel_id):
 	return api_get_patch_delete_conference_child(conference_id, "channel", channel_id)
 
 @app.route('/api/v1/conferences/<conference_id>/channels/<channel_id>/report', methods=['POST'])
+@permissions.authorize(REPORT_SCOPES, target='channel_id')
 def api_report_conference_channel(conference_id, channel_id):
 	"""
 	Takes a channel ID and report data and reports the object with the
@@ -359,6 +655,7 @@ def api_report_conference_channel(conference_id, channel_id):
 	return api_report_conference_child(conference_id, request.json, channel_id, object_type="channel")
 
 @app.route('/api/v1/conferences/<conference_id>/roles', methods=['POST'])
+@permissions.authorize(ROLE_SCOPES, target='conference_id')
 def api_post_conference_role(conference_id):
 	"""
 	Takes a Role object and creates it on the server.
@@ -368,6 +665,7 @@ def api_post_conference_role(conference_id):
 
 @app.route('/api/v1/conferences/<conference_id>/roles/<role_id>',
            methods=["GET", "PATCH", "DELETE"])
+@permissions.authorize(ROLE_SCOPES, target='conference_id')
 def api_get_patch_delete_conference_role(conference_id, role_id):
 	"""
 	Gets/patches/deletes a role in the conference by ID.
@@ -375,6 +673,7 @@ def api_get_patch_delete_conference_role(conference_id, role_id):
 	return api_get_patch_delete_conference_child(conference_id, "role", role_id)
 
 @app.route('/api/v1/conferences/<conference_id>/roles/<role_id>/report', methods=['POST'])
+@permissions.authorize(REPORT_SCOPES, target='conference_id')
 def api_report_conference_role(conference_id, role_id):
 	"""
 	Takes a role ID and report data and reports the object with the
@@ -383,6 +682,7 @@ def api_report_conference_role(conference_id, role_id):
 	return api_report_conference_child(conference_id, request.json, role_id, object_type="role")
 
 @app.route('/api/v1/conferences/<conference_id>/invites', methods=['POST'])
+@permissions.authorize(INVITE_SCOPES, target='conference_id')
 def api_post_conference_invite(conference_id):
 	"""
 	Takes a Invite object and creates it on the server.
@@ -392,6 +692,7 @@ def api_post_conference_invite(conference_id):
 
 @app.route('/api/v1/conferences/<conference_id>/invites/<invite_id>',
            methods=["GET", "PATCH", "DELETE"])
+@permissions.authorize(INVITE_SCOPES, target='conference_id')
 def api_get_patch_delete_conference_invite(conference_id, invite_id):
 	"""
 	Gets/patches/deletes a invite in the conference by ID.
@@ -399,6 +700,7 @@ def api_get_patch_delete_conference_invite(conference_id, invite_id):
 	return api_get_patch_delete_conference_child(conference_id, "invite", invite_id)
 
 @app.route('/api/v1/conferences/<conference_id>/invites/<invite_id>/report', methods=['POST'])
+@permissions.authorize(REPORT_SCOPES, target='conference_id')
 def api_report_conference_invite(conference_id, invite_id):
 	"""
 	Takes an invite ID and report data and reports the object with the
@@ -409,6 +711,7 @@ def api_report_conference_invite(conference_id, invite_id):
 # Channels
 
 @app.route('/api/v1/channels', methods=['POST'])
+@permissions.authorize(NEW_CHANNEL_SCOPES, target=_parent_conference_from_body)
 def api_post_channel():
 	"""
 	Takes a Channel object and creates it on the server.
@@ -416,6 +719,7 @@ def api_post_channel():
 	return api_post(request.json, object_type="channel")
 
 @app.route('/api/v1/channels/<channel_id>', methods=["GET", "PATCH", "DELETE"])
+@permissions.authorize(CHANNEL_SCOPES, target='channel_id')
 def api_get_patch_delete_channel(channel_id):
 	"""
 	Takes the ID of a Channel object and returns the object with
@@ -424,6 +728,7 @@ def api_get_patch_delete_channel(channel_id):
 	return api_get_patch_delete(object_id=channel_id, object_type="channel")
 
 @app.route('/api/v1/channels/<channel_id>/report', methods=['POST'])
+@permissions.authorize(REPORT_SCOPES, target='channel_id')
 def api_report_channel(channel_id):
 	"""
 	Takes a channel ID and report data and reports the object with the
@@ -431,34 +736,211 @@ def api_report_channel(channel_id):
 	"""
 	return api_report(request.json, channel_id, object_type="channel")
 
+@app.route('/api/v1/channels/<channel_id>/read', methods=['POST'])
+@permissions.authorize(READ_STATE_SCOPES, target='channel_id')
+def api_mark_channel_read(channel_id):
+	"""
+	Marks the channel as read by the account, up to the latest message, or
+	up to the message given in the (optional) message variable of the
+	body. Returns the account's unread and mention counts in the channel.
+	"""
+	if not g.get('token'):
+		return pings.response_from_error(12)
+	object_type = permissions.get_object_type(channel_id)
+	if not object_type:
+		return pings.response_from_error(4)
+	if object_type != 'channel':
+		return pings.response_from_error(5)
+
+	message_id = (request.get_json(silent=True) or {}).get('message')
+	if message_id:
+		message = db.get_object_as_dict_by_id(message_id)
+		if not message:
+			return pings.response_from_error(9)
+		if message['object_type'] != 'message':
+			return pings.response_from_error(10)
+		if message['parent_channel'] != channel_id:
+			return pings.response_from_error(8)
+	return {"type": "read_state", **db.mark_channel_read(g.token['account'], channel_id, message_id)}
+
+# Direct messages
+
+@app.route('/api/v1/direct_messages', methods=['POST'])
+@permissions.authorize(DIRECT_MESSAGE_SCOPES)
+def api_get_or_create_direct_message():
+	"""
+	Returns the direct message channel between the account and the accounts
+	in the members variable of the body, creating it if there is none yet.
+	The order of the members does not matter, and the account itself can be
+	left out. The optional name and icon variables are only used when the
+	channel is created.
+
+	Returns the existing channel, or the new channel with a 201 status.
+	"""
+	if not g.get('token'):
+		return pings.response_from_error(12)
+	body = request.get_json(silent=True)
+	if not body:
+		return pings.response_from_error(2)
+	members = body.get('members')
+	if not isinstance(members, list) or not all(isinstance(member, str) for member in members):
+		return pings.response_from_error(7, error_message="members must be a list of account IDs")
+	members = list(dict.fromkeys([g.token['account']] + members))
+	if len(members) < 2:
+		return pings.response_from_error(7, error_message="members must contain another account")
+
+	dm_key = objects.direct_message_key(members)
+	channel = db.get_direct_message(dm_key)
+	if channel:
+		return channel
+
+	try:
+		channel = objects.make_object_from_dict({"object_type": "channel", "channel_type": "direct_message",
+			"members": members, "name": body.get('name') or "Direct message", "icon": body.get('icon') or ""})
+	except TypeError as e:
+		# The channel may have been created by another request in the meantime
+		channel = db.get_direct_message(dm_key)
+		if channel:
+			return channel
+		return pings.response_from_error(10, error_message=e)
+	except KeyError as e:
+		return pings.response_from_error(7, error_message=e)
+	channel_dict, created = db.add_direct_message(channel)
+	if not created:
+		return channel_dict
+	return Response(json.dumps(channel_dict), status=201, mimetype='application/json')
+
+# Unread counts
+
+@app.route('/api/v1/unread')
+@permissions.authorize(UNREAD_SCOPES, target=_conference_from_args)
+def api_get_unread():
+	"""
+	Returns the account's unread and mention counts in all channels it can
+	read, from counters kept up to date as messages are posted. Channels
+	without unread messages or mentions are left out.
+
+	Query parameters:
+	  - conference - only return counts for channels in this conference
+	"""
+	if not g.get('token'):
+		return pings.response_from_error(12)
+	conference_id = request.args.get('conference')
+	if conference_id:
+		object_type = permissions.get_object_type(conference_id)
+		if not object_type:
+			return pings.response_from_error(4)
+		if object_type != 'conference':
+			return pings.response_from_error(5)
+	channel_ids = permissions.get_readable_channels(g.token['account'], conference_id)
+	return {"type": "unread_counts", "results": db.get_unread_counts(g.token['account'], channel_ids)}
+
 # Messages
 
 @app.route('/api/v1/messages', methods=['POST'])
+@permissions.authorize(MESSAGE_SCOPES, target=_parent_channel_from_body)
 def api_post_message():
 	"""
-	Takes a Message object and creates it on the server.
+	Takes a Message object and creates it on the server. The author must be
+	the account the access token belongs to.
 	"""
-	return api_post(request.json, object_type="message")
+	object_dict = request.json
+	if not g.get('token'):
+		return pings.response_from_error(12)
+	if isinstance(object_dict, dict) and object_dict.get('object_type') == "message" and \
+			object_dict.get('author') != g.token['account']:
+		return pings.response_from_error(3, error_message="Messages can only be posted as the token's account")
+	return api_post(object_dict, object_type="message")
 
 @app.route('/api/v1/messages/<message_id>', methods=["GET", "PATCH", "DELETE"])
+@permissions.authorize(MESSAGE_SCOPES, target=_channel_from_message)
 def api_get_patch_delete_message(message_id):
 	"""
 	Takes the ID of a Message object and returns the object with
 	the provided ID if it's a message.
 	"""
+	error = _message_error(message_id) or _message_author_error(g.message)
+	if error:
+		return error
 	return api_get_patch_delete(object_id=message_id, object_type="message")
 
 @app.route('/api/v1/messages/<message_id>/report', methods=['POST'])
+@permissions.authorize(MESSAGE_REPORT_SCOPES, target=_channel_from_message)
 def api_report_message(message_id):
 	"""
 	Takes a message ID and report data and reports the object with the
 	provided ID.
 	"""
+	error = _message_error(message_id)
+	if error:
+		return error
 	return api_report(request.json, message_id, object_type="message")
 
+@app.route('/api/v1/messages/<message_id>/replies')
+@permissions.authorize(REPLY_SCOPES, target=_channel_from_message)
+def api_get_replies(message_id):
+	"""
+	Lists the replies to a message, oldest first. Replies in channels the
+	account can't read are left out, so pages can have less than limit
+	replies even if there are more.
+
+	Query parameters:
+	  - limit - amount of results per page (1-100, default 25)
+	  - cursor - the next_cursor value from the previous page
+	"""
+	if not g.get('token'):
+		return pings.response_from_error(12)
+	error = _message_error(message_id)
+	if error:
+		return error
+	try:
+		limit = _get_page_limit()
+		after = None
+		if request.args.get('cursor'):
+			after = utils.decode_cursor(request.args['cursor'], 2)
+			after[0] = datetime.datetime.fromisoformat(after[0]).replace(tzinfo=None)
+	except (ValueError, TypeError) as e:
+		return pings.response_from_error(13, error_message=e)
+
+	replies = db.get_replies(message_id, after=after, limit=limit + 1)
+	next_cursor = None
+	if len(replies) > limit:
+		replies = replies[:limit]
+		next_cursor = utils.encode_cursor([replies[-1]['post_date'], replies[-1]['id']])
+	# Permissions are cached, so this only resolves every channel once
+	results = [reply for reply in replies
+	           if permissions.has_permission(g.token['account'], reply['parent_channel'], 'channel:read')]
+	return {"type": "reply_list", "results": results, "next_cursor": next_cursor}
+
+@app.route('/api/v1/messages/<message_id>/reactions/<emoji>', methods=['PUT', 'DELETE'])
+@permissions.authorize(REACTION_SCOPES, target=_channel_from_message)
+def api_put_delete_reaction(message_id, emoji):
+	"""
+	Adds (PUT) or removes (DELETE) the account's reaction with the given
+	emoji to or from a message. Only the reaction and its counter are
+	written; the message stays as it is. Adding a reaction twice, or
+	removing one that isn't there, does nothing.
+
+	Returns the amount of reactions with the emoji on the message.
+	"""
+	if not g.get('token'):
+		return pings.response_from_error(12)
+	error = _message_error(message_id)
+	if error:
+		return error
+	if len(emoji) > MAX_EMOJI_LENGTH:
+		return pings.response_from_error(13, error_message="emoji must be at most " + str(MAX_EMOJI_LENGTH) + " characters long")
+
+	if request.method == 'PUT':
+		count = db.add_reaction(message_id, emoji, g.token['account'])[0]
+	else:
+		count = db.remove_reaction(message_id, emoji, g.token['account'])[0]
+	return {"type": "reaction", "message": message_id, "emoji": emoji, "count": count, "reacted": request.method == 'PUT'}
+
 # Invite
 
 @app.route('/api/v1/invites', methods=['POST'])
+@permissions.authorize(INVITE_SCOPES, target=_invite_conference_from_body)
 def api_post_invite():
 	"""
 	Takes an Invite object and creates it on the server.
@@ -466,6 +948,7 @@ def api_post_invite():
 	return api_post(request.json, object_type="invite")
 
 @app.route('/api/v1/invites/<invite_id>', methods=["GET", "PATCH", "DELETE"])
+@permissions.authorize(INVITE_SCOPES, target='invite_id')
 def api_get_patch_delete_invite(invite_id):
 	"""
 	Takes the ID of an Invite object and returns the object with
@@ -474,6 +957,7 @@ def api_get_patch_delete_invite(invite_id):
 	return api_get_patch_delete(object_id=invite_id, object_type="invite")
 
 @app.route('/api/v1/invites/<invite_id>/report', methods=['POST'])
+@permissions.authorize(REPORT_SCOPES, target='invite_id')
 def api_report_invite(invite_id):
 	"""
 	Takes an invite ID and report data and reports the object with the
@@ -487,6 +971,7 @@ def api_report_invite(invite_id):
 # Roles
 
 @app.route('/api/v1/roles', methods=['POST'])
+@permissions.authorize(ROLE_SCOPES, target=_parent_conference_from_body)
 def api_post_role():
 	"""
 	Takes a Role object and creates it on the server.
@@ -494,6 +979,7 @@ def api_post_role():
 	return api_post(request.json, object_type="role")
 
 @app.route('/api/v1/roles/<role_id>', methods=["GET", "PATCH", "DELETE"])
+@permissions.authorize(ROLE_SCOPES, target='role_id')
 def api_get_patch_delete_role(role_id):
 	"""
 	Takes the ID of a Role object and returns the object with
@@ -502,6 +988,7 @@ def api_get_patch_delete_role(role_id):
 	return api_get_patch_delete(object_id=role_id, object_type="role")
 
 @app.route('/api/v1/roles/<role_id>/report', methods=['POST'])
+@permissions.authorize(REPORT_SCOPES, target='role_id')
 def api_report_role(role_id):
 	"""
 	Takes an role ID and report data and reports the object with the
@@ -518,6 +1005,63 @@ def api_post_report():
 	"""
 	return api_post(request.json, object_type="report")
 
+@app.route('/api/v1/reports', methods=['GET'])
+@permissions.authorize(REPORT_LIST_SCOPES, target=_conference_from_args)
+def api_get_reports():
+	"""
+	Lists reports for moderators, newest first. Reports about objects in a
+	conference can be listed by its moderators (members with the
+	moderate_messages permission); listing all reports is limited to the
+	accounts in the instance_moderators setting.
+
+	Query parameters:
+	  - conference - only list reports about objects in this conference
+	  - target_type - only list reports about objects of this type
+	  - group - if set to true, only list the latest report for every
+	            reported object, along with the amount of reports about it
+	  - limit - amount of results per page (1-100, default 25)
+	  - cursor - the next_cursor value from the previous page
+	"""
+	if not g.get('token'):
+		return pings.response_from_error(12)
+	conference_id = request.args.get('conference')
+	if conference_id:
+		object_type = permissions.get_object_type(conference_id)
+		if not object_type:
+			return pings.response_from_error(4)
+		if object_type != 'conference':
+			return pings.response_from_error(5)
+	elif g.token['account'] not in (config.get('instance_moderators') or []):
+		return pings.response_from_error(3, error_message="Only instance moderators can list reports without a conference")
+
+	target_type = request.args.get('target_type')
+	if target_type and target_type not in objects.object_types:
+		return pings.response_from_error(13, error_message="Invalid target_type: " + target_type)
+	group = request.args.get('group', 'false').lower() in ('true', '1')
+	try:
+		limit = _get_page_limit()
+		after = None
+		if request.args.get('cursor'):
+			after = utils.decode_cursor(request.args['cursor'], 2)
+			after[0] = datetime.datetime.fromisoformat(after[0]).replace(tzinfo=None)
+	except (ValueError, TypeError) as e:
+		return pings.response_from_error(13, error_message=e)
+
+	reports = db.get_reports(conference_id, target_type, after=after, limit=limit + 1, group=group)
+	next_cursor = None
+	if len(reports) > limit:
+		reports = reports[:limit]
+		last_report = reports[-1][0] if group else reports[-1]
+		next_cursor = utils.encode_cursor([last_report['submission_date'], last_report['id']])
+	if group:
+		results = [{"target": report['target'], "target_type": report.get('target_type'),
+		            "target_conference": report.get('target_conference'),
+		            "report_count": report_count, "latest_report": report}
+		           for report, report_count in reports]
+	else:
+		results = reports
+	return {"type": "report_list", "results": results, "next_cursor": next_cursor}
+
 @app.route('/api/v1/reports/<report_id>', methods=["GET", "PATCH", "DELETE"])
 def api_get_patch_delete_report(report_id):
 	"""
@@ -525,3 +1069,111 @@ def api_get_patch_delete_report(report_id):
 	the provided ID if it's a report.
 	"""
 	return api_get_patch_delete(object_id=report_id, object_type="report")
+
+# Search
+
+@app.route('/api/v1/search/messages')
+@permissions.authorize(SEARCH_SCOPES, target=_channel_from_args)
+def api_search_messages():
+	"""
+	Searches for messages in channels the account can read. Results are
+	ordered by relevance.
+
+	Query parameters:
+	  - q (required) - the search query; supports "quoted phrases", OR and
+	                   -excluded words
+	  - channel - only search in the channel with this ID
+	  - conference - only search in the conference with this ID
+	  - author - only return messages by the account with this ID
+	  - before - only return messages posted before this date (ISO 8601)
+	  - limit - amount of results per page (1-100, default 25)
+	  - cursor - the next_cursor value from the previous page
+	"""
+	if not g.get('token'):
+		return pings.response_from_error(12)
+	search_query = request.args.get('q', '').strip()
+	if not search_query:
+		return pings.response_from_error(7, error_message="Missing required variable: q")
+	try:
+		limit = _get_page_limit()
+		before = _get_datetime_arg('before')
+		after = None
+		if request.args.get('cursor'):
+			after = utils.decode_cursor(request.args['cursor'], 2)
+	except ValueError as e:
+		return pings.response_from_error(13, error_message=e)
+
+	channel_id = request.args.get('channel')
+	if channel_id:
+		object_type = permissions.get_object_type(channel_id)
+		if not object_type:
+			return pings.response_from_error(4)
+		if object_type != 'channel':
+			return pings.response_from_error(5)
+		channel_ids = [channel_id]
+	else:
+		channel_ids = permissions.get_readable_channels(g.token['account'], request.args.get('conference'))
+
+	results = db.search_messages(search_query, channel_ids, author=request.args.get('author'),
+	                             before=before, after=after, limit=limit + 1)
+	next_cursor = None
+	if len(results) > limit:
+		results = results[:limit]
+		last_message, last_rank = results[-1]
+		next_cursor = utils.encode_cursor([last_rank, last_message['id']])
+	return {"type": "search_results", "results": [message for message, rank in results],
+	        "next_cursor": next_cursor}
+
+def api_directory_search(object_type):
+	"""
+	Searches for objects of the given type in the directory; see the
+	directory module. Matches are returned in pages, with names that start
+	with the query first, followed by similar names.
+
+	Query parameters:
+	  - q (required) - the name or beginning of the name to look for
+	  - limit - amount of results per page (1-100, default 25)
+	  - cursor - the next_cursor value from the previous page
+	"""
+	search_query = request.args.get('q', '').strip()
+	if not search_query:
+		return pings.response_from_error(7, error_message="Missing required variable: q")
+	try:
+		limit = _get_page_limit()
+		after = None
+		if request.args.get('cursor'):
+			after = utils.decode_cursor(request.args['cursor'], 4)
+		results = directory.search(object_type, search_query, limit + 1, after=after)
+	except ValueError as e:
+		return pings.response_from_error(13, error_message=e)
+
+	next_cursor = None
+	if len(results) > limit:
+		results = results[:limit]
+		next_cursor = utils.encode_cursor(results[-1][1])
+	# The index of this worker can be out of date; objects that have left the
+	# directory or were deleted since are dropped from it
+	object_dicts = {object_dict['id']: object_dict for object_dict in db.get_directory_objects(
+		object_type, [id for id, position in results], directory.DIRECTORY_OBJECTS[object_type].directory_flag)}
+	for id, position in results:
+		if id not in object_dicts:
+			directory.remove(object_type, id)
+	return {"type": "search_results",
+	        "results": [object_dicts[id] for id, position in results if id in object_dicts],
+	        "next_cursor": next_cursor}
+
+@app.route('/api/v1/search/accounts')
+@permissions.authorize(DIRECTORY_SCOPES)
+def api_search_accounts():
+	"""
+	Searches for accounts that have index_user set by username.
+	"""
+	return api_directory_search('account')
+
+@app.route('/api/v1/search/conferences')
+@permissions.authorize(DIRECTORY_SCOPES)
+def api_search_conferences():
+	"""
+	Searches for conferences that have index_conference set by name.
+	"""
+	return api_directory_search('conference')
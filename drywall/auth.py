@@ -5,16 +5,13 @@ Contains code for authentication and OAuth2 support.
 from drywall import app
 from drywall import db
 from drywall import objects
+from drywall import passwords
 from drywall import utils
 
 from flask import render_template, flash, request, redirect, session, url_for
 from email_validator import validate_email, EmailNotValidError
 from uuid import uuid4 # For client IDs
 from secrets import token_hex # For client secrets
-# We're using these functions for now; if anyone has any suggestions for
-# whether this is secure or not, see issue #3
-from werkzeug.security import check_password_hash
-from werkzeug.security import generate_password_hash
 
 ##########
 # OAuth2 #
@@ -22,8 +19,7 @@ from werkzeug.security import generate_password_hash
 
 class Client:
 	"""Contains information about OAuth2 clients."""
-	client_keys = ['client_id', 'client_secret', 'name', 'description',
-	               'scopes', 'owner', 'type', 'account_id']
+	client_keys = db.client_keys
 
 def create_client(client_dict):
 	"""Creates a client from a basic client dict."""
@@ -58,13 +54,17 @@ def register_user(username, email, password):
 	Registers a new user. Returns the Account object for the newly created
 	user.
 
-	Raises a ValueError if the username or email is already taken.
+	Raises a ValueError if the username or email is already taken, or if
+	the server is too busy to hash the password.
 	"""
 	# Do some basic validation
 	if db.get_object_by_key_value_pair("account", {"username": username}):
 		raise ValueError("Username taken.")
 	if db.get_user_by_email(email):
 		raise ValueError("E-mail already in use.")
+	# Hash the password first, so that we don't leave an orphaned account
+	# behind if the server is too busy to hash it
+	password_hash = passwords.hash_password(password)
 	# Create an Account object for the user
 	account_object = {"type": "object", "object_type": "account",
 	                   "username": username, "icon": "stub", "email": email}
@@ -73,9 +73,35 @@ def register_user(username, email, password):
 	account_id = added_object['id']
 	# Add the user to the user database
 	user_dict = {"username": username, "account_id": account_id, "email": email,
-	              "password": generate_password_hash(password)}
+	              "password": password_hash}
 	db.add_user(user_dict)
 
+def authenticate_user(email, password):
+	"""
+	Checks the password of the user with the given email. Returns the user
+	dict.
+
+	If the password was hashed with different settings than the ones that are
+	currently configured, it is hashed again with the current settings.
+
+	Raises a ValueError if the user does not exist, the password is invalid,
+	or the server is too busy to check the password.
+	"""
+	user = db.get_user_by_email(email)
+	if not user:
+		raise ValueError("User with provided email does not exist.")
+	if not passwords.check_password(user['password'], password):
+		raise ValueError("Invalid password.")
+	if passwords.needs_rehash(user['password']):
+		try:
+			user['password'] = passwords.hash_password(password)
+		except ValueError:
+			# We'll try again on the next login.
+			pass
+		else:
+			user = db.update_user(email, user)
+	return user
+
 @app.route('/auth/sign_up', methods=["GET", "POST"])
 def auth_signup():
 	"""Sign-up page."""
@@ -108,11 +134,7 @@ def auth_login():
 		password = request.form["password"]
 		try:
 			valid_email = validate_email(email).email
-			user = db.get_user_by_email(valid_email)
-			if not user:
-				raise ValueError("User with provided email does not exist.")
-			if not check_password_hash(user['password'], password):
-				raise ValueError("Invalid password.")
+			user = authenticate_user(valid_email, password)
 		except (ValueError, EmailNotValidError) as e:
 			flash(str(e))
 		else:
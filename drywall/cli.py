@@ -0,0 +1,67 @@
+# coding: utf-8
+"""
+Contains the drywall commands for the flask command line tool:
+
+    $ export FLASK_APP="drywall:create_app()"
+    $ flask init-db
+    $ flask migrate
+    $ flask purge-deleted
+    $ flask run-jobs
+"""
+from drywall import api
+from drywall import db
+from drywall import deletion
+from drywall import jobs
+from drywall import metrics
+
+import click
+import signal
+
+@click.command('init-db')
+def init_db_command():
+	"""Create the database tables and the instance object."""
+	for version in db.init_db():
+		click.echo("Applied migration " + version)
+	api.push_instance()
+	click.echo("Initialized the database.")
+
+@click.command('migrate')
+def migrate_command():
+	"""Apply new database migrations and update the instance object."""
+	applied = db.migrate()
+	for version in applied:
+		click.echo("Applied migration " + version)
+	api.push_instance()
+	if applied:
+		click.echo("Updated the database.")
+	else:
+		click.echo("The database is up to date.")
+
+@click.command('purge-deleted')
+def purge_deleted_command():
+	"""Remove deleted conferences and channels that haven't been removed yet."""
+	purged = deletion.purge_pending(throttle=False)
+	click.echo("Removed " + str(purged) + " deleted conferences and channels.")
+
+@click.command('run-jobs')
+@click.option('--queue', '-q', 'queues', multiple=True,
+              help="Queue to run jobs from; can be given more than once. Defaults to all queues.")
+@click.option('--burst', is_flag=True, help="Exit once there are no jobs left to run.")
+@click.option('--metrics-bind', metavar="HOST:PORT", help="Serve the runner's metrics on this address.")
+def run_jobs_command(queues, burst, metrics_bind):
+	"""Run jobs from the job queues until stopped."""
+	runner = jobs.Runner(queues)
+	if burst:
+		click.echo("Ran " + str(runner.run_burst()) + " jobs.")
+		return
+	if metrics_bind:
+		host, port = metrics_bind.rsplit(':', 1)
+		metrics.serve(host, int(port))
+	signal.signal(signal.SIGTERM, lambda signum, frame: runner.stop())
+	runner.start()
+	click.echo("Running jobs from: " + ", ".join(runner.queues))
+	try:
+		runner.wait()
+	except KeyboardInterrupt:
+		runner.stop()
+		runner.wait()
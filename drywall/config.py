@@ -1,10 +1,40 @@
 # encoding: utf-8
 """
 Handles interactions with the config.json file.
+
+The config file is read the first time a setting is needed, not when this
+module is imported. Its path can be set with the DRYWALL_CONFIG environment
+variable or passed to load(); it defaults to config.json in the current
+directory.
 """
+import os
 import simplejson as json
-config_file = json.loads(open("config.json", 'r').read())
+
+DEFAULT_PATH = "config.json"
+
+_config = None
+
+def load(path=None):
+	"""
+	Reads the config file at the given path (or the default one), replacing
+	the currently loaded settings. Returns the settings as a dict.
+	"""
+	global _config
+	path = path or os.environ.get('DRYWALL_CONFIG') or DEFAULT_PATH
+	with open(path, 'r') as config_file:
+		_config = json.loads(config_file.read())
+	return _config
 
 def get(setting):
 	"""Get a setting's value by name. Returns the content of the setting."""
-	return config_file.get(setting)
+	if _config is None:
+		load()
+	return _config.get(setting)
+
+def __getattr__(name):
+	# The settings dict used to be loaded on import as config_file.
+	if name == 'config_file':
+		if _config is None:
+			load()
+		return _config
+	raise AttributeError("module " + __name__ + " has no attribute " + name)
@@ -3,10 +3,19 @@
 This is the SQLAlchemy backend, intended to replace all existing
 database backends.
 """
-from sqlalchemy import create_engine
-from sqlalchemy.orm import Session
+from sqlalchemy import create_engine, delete, inspect, select, text, update
+from sqlalchemy import case, cast, func, literal, or_, and_, tuple_
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import REAL, insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, aliased, load_only
 from drywall import db_models as models
 from drywall import config
+from drywall import utils
+
+import datetime
+import os
+import threading
 
 # !!! IMPORTANT !!! --- !!! IMPORTANT !!! --- !!! IMPORTANT !!!
 # If you came here to change the database type, ***DON'T***.
@@ -25,13 +34,108 @@ from drywall import config
 # no need to! See the test runner script (tests/test_runner.sh) for more
 # information on how to prepare a database for one-time use.
 # !!! IMPORTANT !!! --- !!! IMPORTANT !!! --- !!! IMPORTANT !!!
-engine = create_engine("postgresql://%s:%s@localhost/%s" % (config.get('db_user'), config.get('db_password'), config.get('db_name')), future=True)
 
-models.Base.metadata.create_all(engine)
+# The engine is created the first time it's needed, so that importing this
+# module doesn't need the config file or a database. Creating the engine
+# doesn't connect to the database either; connections are opened by the
+# pool when the first query is made. Tables are created with the init-db
+# and migrate commands (see init_db and migrate), not on import.
+_engine = None
+_engine_lock = threading.Lock()
+
+# Client lookups happen on every token validation, so we cache them. Since
+# every worker has its own cache, changes made by other workers can take up
+# to client_cache_ttl seconds to show up.
+_client_cache = None
+
+def get_engine():
+	"""Returns the database engine, creating it if needed."""
+	global _engine
+	if _engine is None:
+		with _engine_lock:
+			if _engine is None:
+				_engine = create_engine("postgresql://%s:%s@localhost/%s" % (config.get('db_user'), config.get('db_password'), config.get('db_name')),
+					pool_size=config.get('db_pool_size') or 5, future=True)
+	return _engine
+
+def _get_client_cache():
+	global _client_cache
+	if _client_cache is None:
+		_client_cache = utils.LRUCache(maxsize=1024, ttl=config.get('client_cache_ttl') or 60)
+	return _client_cache
 
-# The current client DB functions are due to be deprecated once we add authlib
-# support. Thus, we'll re-use the old dummy DB backend functions for it.
-client_db = {}
+def __getattr__(name):
+	# Lets other modules use db.engine as before.
+	if name == 'engine':
+		return get_engine()
+	raise AttributeError("module " + __name__ + " has no attribute " + name)
+
+def _after_fork():
+	"""
+	Makes sure that a child process doesn't use the connections opened by
+	its parent, which are shared between both processes after a fork. The
+	parent keeps using them; the child opens its own.
+	"""
+	global _engine_lock
+	_engine_lock = threading.Lock()
+	if _engine is not None:
+		_engine.dispose(close=False)
+
+os.register_at_fork(after_in_child=_after_fork)
+
+# Setup
+
+# Versioned schema migrations, generated by utils/alchemify.py.
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+# Key of the advisory lock held while migrating, so that two processes
+# don't apply the same migrations at once.
+MIGRATION_LOCK = 0x64727977616c6c
+
+def get_migrations():
+	"""Returns a sorted list of (version, path) tuples of all migrations."""
+	return sorted((file_name[:-len('.sql')], os.path.join(MIGRATIONS_DIR, file_name))
+	              for file_name in os.listdir(MIGRATIONS_DIR) if file_name.endswith('.sql'))
+
+def init_db():
+	"""
+	Sets up the database. Empty databases get all tables at once, and all
+	migrations are marked as applied; databases that already have tables
+	are migrated instead (see migrate). Returns a list of the applied
+	migrations.
+	"""
+	with get_engine().begin() as connection:
+		connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK})
+		if inspect(connection).has_table(models.Objects.__tablename__):
+			existing = True
+		else:
+			existing = False
+			models.Base.metadata.create_all(connection)
+			now = datetime.datetime.utcnow()
+			for version, path in get_migrations():
+				connection.execute(models.SchemaMigration.__table__.insert().values(version=version, applied=now))
+	if existing:
+		return migrate()
+	return []
+
+def migrate():
+	"""
+	Applies the migrations that have not been applied yet, in order, in a
+	single transaction. Returns a list of the applied migrations.
+	"""
+	applied = []
+	with get_engine().begin() as connection:
+		connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK})
+		table = models.SchemaMigration.__table__
+		table.create(connection, checkfirst=True)
+		done = set(connection.execute(select(table.c.version)).scalars())
+		for version, path in get_migrations():
+			if version in done:
+				continue
+			with open(path, 'r') as migration_file:
+				connection.exec_driver_sql(migration_file.read())
+			connection.execute(table.insert().values(version=version, applied=datetime.datetime.utcnow()))
+			applied.append(version)
+	return applied
 
 # Helper functions
 
@@ -56,7 +160,7 @@ def add_object(object):
 	if id_taken(str(id)):
 		return False
 
-	with Session(engine) as session:
+	with Session(get_engine()) as session:
 		object_type = object_dict['object_type']
 		new_type_object = models.object_type_to_model(object_type)()
 		new_generic_object = models.Objects(id=id, object_type=object_type)
@@ -64,6 +168,8 @@ def add_object(object):
 			setattr(new_type_object, key, value)
 		session.add(new_type_object)
 		session.add(new_generic_object)
+		if object_type == 'message':
+			_count_message(session, object_dict)
 		session.commit()
 
 	return object_dict
@@ -80,7 +186,7 @@ def push_object(id, object):
 	if not id_taken(str(id)):
 		return False
 
-	with Session(engine) as session:
+	with Session(get_engine()) as session:
 		object_type = session.query(models.Objects).get(id).object_type
 		new_object = session.query(models.object_type_to_model(object_type)).get(id)
 		for key, value in object_dict.items():
@@ -96,7 +202,7 @@ def delete_object(id):
 
 	Returns False if the ID does not exist.
 	"""
-	with Session(engine) as session:
+	with Session(get_engine()) as session:
 		object_type_query = session.query(models.Objects).get(id)
 		if not object_type_query:
 			return None
@@ -108,36 +214,407 @@ def delete_object(id):
 
 	return id
 
+def tombstone_object(id):
+	"""
+	Marks an object as deleted, without removing it. Deleted objects can't
+	be fetched or referenced by new objects; they are removed along with
+	their dependents by delete_dependents_batch and delete_tombstoned_object.
+	The channels of a conference are marked along with it.
+
+	Returns a list with the IDs of the marked objects.
+	"""
+	now = datetime.datetime.utcnow()
+	with Session(get_engine()) as session:
+		ids = [id]
+		object_type = session.query(models.Objects.object_type).filter(models.Objects.id == id).scalar()
+		if object_type == 'conference':
+			ids += session.execute(select(models.Channel.id).where(models.Channel.parent_conference == id)).scalars().all()
+		session.execute(update(models.Objects).where(models.Objects.id.in_(ids),
+			models.Objects.deleted.is_(None)).values(deleted=now))
+		if object_type == 'channel':
+			# Let the members start a new direct message channel right away
+			session.execute(update(models.Channel).where(models.Channel.id == id,
+				models.Channel.dm_key.isnot(None)).values(dm_key=None))
+		session.commit()
+	return ids
+
+def get_tombstones(limit=100):
+	"""
+	Returns a list of (ID, object type) tuples of objects marked as deleted,
+	oldest first. Channels come before the conferences they were deleted
+	with.
+	"""
+	with Session(get_engine()) as session:
+		return [tuple(tombstone) for tombstone in session.query(models.Objects.id, models.Objects.object_type).filter(
+			models.Objects.deleted.isnot(None)).order_by(models.Objects.deleted,
+			models.Objects.object_type == 'conference').limit(limit).all()]
+
+def _delete_ids(session, object_type, ids):
+	"""
+	Deletes the objects of the given type with the given IDs, along with
+	the reports about them, with bulk statements. ORM events are not
+	triggered.
+	"""
+	if not ids:
+		return
+	model = models.object_type_to_model(object_type)
+	if object_type == 'message':
+		session.execute(update(models.Message).where(models.Message.reply_to.in_(ids)).values(reply_to=None))
+	report_ids = session.execute(delete(models.Report).where(models.Report.target.in_(ids)).returning(models.Report.id)).scalars().all()
+	session.execute(delete(model).where(model.id.in_(ids)))
+	session.execute(delete(models.Objects).where(models.Objects.id.in_(list(ids) + report_ids)))
+
+def delete_dependents_batch(object_type, key, value, limit):
+	"""
+	Deletes up to limit objects of the given type whose key has the given
+	value (for example, messages whose parent_channel is a deleted channel),
+	in one short transaction. Rows locked by other transactions are skipped.
+
+	Returns a list with the IDs of the deleted objects.
+	"""
+	model = models.object_type_to_model(object_type)
+	with Session(get_engine()) as session:
+		ids = session.execute(select(model.id).where(getattr(model, key) == value).limit(limit).with_for_update(
+			skip_locked=True)).scalars().all()
+		_delete_ids(session, object_type, ids)
+		session.commit()
+	return ids
+
+def delete_tombstoned_object(id, object_type):
+	"""
+	Removes an object marked as deleted, once its dependents are gone.
+	"""
+	with Session(get_engine()) as session:
+		_delete_ids(session, object_type, [id])
+		session.commit()
+
 def id_taken(id):
 	"""
 	Takes an ID and returns True or False based on whether the ID was found in
 	the database.
 	"""
-	with Session(engine) as session:
+	with Session(get_engine()) as session:
 		if session.query(models.Objects).get(id):
 			return True
 		else:
 			return False
 
-def get_object_as_dict_by_id(id):
+def get_object_type(id):
+	"""
+	Takes an object ID and returns the object type of the object with that
+	ID, without loading the object itself.
+
+	Returns None if the ID is not found in the database, or if the object
+	has been deleted (see tombstone_object).
+	"""
+	with Session(get_engine()) as session:
+		object_type_query = session.query(models.Objects).get(id)
+		if not object_type_query or object_type_query.deleted:
+			return None
+		return object_type_query.object_type
+
+def get_object_types(ids):
+	"""
+	Takes a list of object IDs and returns a dict with the IDs as keys and
+	the object types of the objects as values, using a single query. IDs
+	that are not found or belong to deleted objects are skipped.
+	"""
+	if not ids:
+		return {}
+	with Session(get_engine()) as session:
+		return dict(session.query(models.Objects.id, models.Objects.object_type).filter(
+			models.Objects.id.in_(list(ids)), models.Objects.deleted.is_(None)).all())
+
+def get_object_type_and_conference(id):
+	"""
+	Takes an object ID and returns a tuple with the object's type and the
+	ID of the conference it belongs to (the conference itself for
+	conferences, the channel's conference for messages), using a single
+	query. The conference is None for objects that don't belong to one,
+	like accounts or messages in direct message channels.
+
+	Returns (None, None) if the ID is not found in the database.
+	"""
+	message_channel = aliased(models.Channel)
+	with Session(get_engine()) as session:
+		result = session.query(models.Objects.object_type, func.coalesce(
+				case((models.Objects.object_type == 'conference', models.Objects.id)),
+				models.Channel.parent_conference, models.Role.parent_conference,
+				models.ConferenceMember.parent_conference, models.Invite.conference_id,
+				message_channel.parent_conference)).filter(models.Objects.id == id).outerjoin(
+			models.Channel, models.Channel.id == models.Objects.id).outerjoin(
+			models.Role, models.Role.id == models.Objects.id).outerjoin(
+			models.ConferenceMember, models.ConferenceMember.id == models.Objects.id).outerjoin(
+			models.Invite, models.Invite.id == models.Objects.id).outerjoin(
+			models.Message, models.Message.id == models.Objects.id).outerjoin(
+			message_channel, message_channel.id == models.Message.parent_channel).first()
+		if not result:
+			return (None, None)
+		return tuple(result)
+
+def _load_fields(model, fields):
+	"""
+	Returns a tuple with the query options that only load the given keys of
+	a model (and its ID) from the database, and the keys to pass to
+	to_dict(only=...). Keys that the model has no column for are skipped.
+	If fields is None, everything is loaded.
+	"""
+	if fields is None:
+		return ([], ())
+	keys = ['id'] + [key for key in fields if key != 'id' and key in model.__table__.columns]
+	return ([load_only(*[getattr(model, key) for key in keys])], tuple(keys))
+
+def get_object_as_dict_by_id(id, fields=None):
 	"""
 	Takes an object ID and returns a dict containing the object's content.
+	If a list of keys is given in fields, only those keys are read from the
+	database and returned, along with the ID and type.
 
-	Returns None if the ID is not found in the database.
+	Returns None if the ID is not found in the database, or if the object
+	has been deleted (see tombstone_object).
 	"""
 	if not id:
 		return None
 
-	with Session(engine) as session:
+	with Session(get_engine()) as session:
 		object_type_query = session.query(models.Objects).get(id)
-		if not object_type_query:
+		if not object_type_query or object_type_query.deleted:
 			return None
 		object_type = object_type_query.object_type
-		object = session.query(models.object_type_to_model(object_type)).get(id)
-		object_dict = object.to_dict()
+		model = models.object_type_to_model(object_type)
+		options, only = _load_fields(model, fields)
+		object = session.query(model).options(*options).get(id)
+		object_dict = object.to_dict(only=only)
 		return clean_object_dict(object_dict, object_type)
 
-def get_object_by_key_value_pair(object_type, key_value_dict, limit_objects=False):
+def get_objects_as_dicts(ids, fields=None):
+	"""
+	Takes a list of object IDs and returns a dict with the IDs as keys and
+	dicts containing the content of the objects as values, using one query
+	for the object types and one for every type. IDs that are not found or
+	belong to deleted objects are skipped. fields works like in
+	get_object_as_dict_by_id.
+	"""
+	if not ids:
+		return {}
+	with Session(get_engine()) as session:
+		ids_by_type = {}
+		for id, object_type in session.query(models.Objects.id, models.Objects.object_type).filter(
+				models.Objects.id.in_(list(ids)), models.Objects.deleted.is_(None)).all():
+			ids_by_type.setdefault(object_type, []).append(id)
+		object_dicts = {}
+		for object_type, type_ids in ids_by_type.items():
+			model = models.object_type_to_model(object_type)
+			options, only = _load_fields(model, fields)
+			for object in session.query(model).options(*options).filter(model.id.in_(type_ids)).all():
+				object_dicts[object.id] = clean_object_dict(object.to_dict(only=only), object_type)
+		return object_dicts
+
+def get_objects_as_dicts_by_ids(object_type, ids):
+	"""
+	Takes an object type and a list of IDs and returns a list with dicts
+	containing the content of the objects of the given type with those IDs,
+	using a single query. IDs that are not found or belong to deleted
+	objects are skipped.
+	"""
+	if not ids:
+		return []
+	model = models.object_type_to_model(object_type)
+	with Session(get_engine()) as session:
+		query = session.query(model).join(models.Objects, models.Objects.id == model.id).filter(
+			model.id.in_(list(ids)), models.Objects.deleted.is_(None)).all()
+		return [clean_object_dict(object.to_dict(), object_type) for object in query]
+
+def get_conference_member(conference_id, account_id):
+	"""
+	Returns the dict of the ConferenceMember object of the given account in
+	the given conference. Returns None if the account is not a member.
+	"""
+	with Session(get_engine()) as session:
+		member = session.query(models.ConferenceMember).filter(
+			models.ConferenceMember.parent_conference == conference_id,
+			models.ConferenceMember.user_id == account_id).first()
+		if not member:
+			return None
+		return clean_object_dict(member.to_dict(), 'conference_member')
+
+def get_conference_permission_data(conference_id):
+	"""
+	Returns the data needed to evaluate the permissions of every member of
+	a conference at once, using two queries. Returns a tuple with:
+	  - a list of (user_id, permissions, roles, banned) tuples, one per
+	    member of the conference,
+	  - a dict with role IDs as keys and role permissions as values, for
+	    every role in the conference.
+	"""
+	with Session(get_engine()) as session:
+		members = session.query(models.ConferenceMember.user_id,
+			models.ConferenceMember.permissions, models.ConferenceMember.roles,
+			models.ConferenceMember.banned).filter(
+			models.ConferenceMember.parent_conference == conference_id).all()
+		roles = session.query(models.Role.id, models.Role.permissions).filter(
+			models.Role.parent_conference == conference_id).all()
+		return ([tuple(member) for member in members], dict(roles))
+
+def get_account_channels(account_id, conference_id=None):
+	"""
+	Returns a list of (ID, parent_conference, permissions) tuples for all
+	channels in conferences the given account owns or is a (non-banned)
+	member of, plus the direct message channels it's in. If a conference ID
+	is given, only channels in that conference are returned.
+
+	This does not check channel permissions; see permissions.get_readable_channels.
+	"""
+	with Session(get_engine()) as session:
+		member_conferences = session.query(models.ConferenceMember.parent_conference).filter(
+			models.ConferenceMember.user_id == account_id,
+			models.ConferenceMember.banned.isnot(True))
+		owned_conferences = session.query(models.Conference.id).filter(
+			models.Conference.owner == account_id)
+		query = session.query(models.Channel.id, models.Channel.parent_conference,
+			models.Channel.permissions).filter(or_(
+			models.Channel.parent_conference.in_(member_conferences.scalar_subquery()),
+			models.Channel.parent_conference.in_(owned_conferences.scalar_subquery()),
+			# @> can use the GIN index on members, unlike = ANY
+			and_(models.Channel.channel_type == 'direct_message',
+			     models.Channel.members.contains([account_id]))))
+		if conference_id:
+			query = query.filter(models.Channel.parent_conference == conference_id)
+		return [tuple(row) for row in query.all()]
+
+def get_directory_entries(object_type, key, flag):
+	"""
+	Returns a list of (ID, value of key) tuples for all objects of the given
+	type that have the given boolean key set and have not been deleted.
+	Used to load the directory search index.
+	"""
+	model = models.object_type_to_model(object_type)
+	with Session(get_engine()) as session:
+		query = session.query(model.id, getattr(model, key)).join(models.Objects, models.Objects.id == model.id).filter(
+			getattr(model, flag).is_(True), getattr(model, key).isnot(None), models.Objects.deleted.is_(None))
+		return [tuple(row) for row in query.all()]
+
+def get_directory_objects(object_type, ids, flag):
+	"""
+	Returns a list with dicts containing the content of the objects of the
+	given type with the given IDs that have the given boolean key set and
+	have not been deleted, using a single query. Used to load directory
+	search results, since the search index may be out of date.
+	"""
+	if not ids:
+		return []
+	model = models.object_type_to_model(object_type)
+	with Session(get_engine()) as session:
+		query = session.query(model).join(models.Objects, models.Objects.id == model.id).filter(
+			model.id.in_(list(ids)), getattr(model, flag).is_(True), models.Objects.deleted.is_(None))
+		return [clean_object_dict(object.to_dict(), object_type) for object in query.all()]
+
+def get_replies(message_id, after=None, limit=25):
+	"""
+	Returns the replies to a message, oldest first, ordered by post date
+	and ID. Pages are read from the (reply_to, post_date) index, so the
+	message itself is never read or written.
+
+	Arguments:
+	  - after - (post date, ID) tuple of the last reply on the previous
+	            page; only replies after it are returned
+	  - limit (default: 25) - maximum amount of replies to return
+
+	Returns a list of message dicts.
+	"""
+	with Session(get_engine()) as session:
+		query = session.query(models.Message).filter(models.Message.reply_to == message_id)
+		if after:
+			query = query.filter(tuple_(models.Message.post_date, models.Message.id) > tuple_(after[0], after[1]))
+		query = query.order_by(models.Message.post_date, models.Message.id).limit(limit)
+		return [clean_object_dict(message.to_dict(), 'message') for message in query.all()]
+
+def search_messages(search_query, channel_ids, author=None, before=None, after=None, limit=25):
+	"""
+	Searches for messages matching a query in the message search index.
+	Returns a list of (message dict, rank) tuples, ordered by rank and ID
+	(both descending).
+
+	Arguments:
+	  - search_query (required) - the search query; supports "quoted
+	                              phrases", OR and -excluded words
+	  - channel_ids (required) - list of IDs of channels to search in
+	  - author - only return messages by the account with this ID
+	  - before - only return messages posted before this datetime
+	  - after - (rank, ID) tuple of the last message on the previous page;
+	            only messages after it are returned
+	  - limit (default: 25) - maximum amount of messages to return
+	"""
+	if not channel_ids:
+		return []
+	with Session(get_engine()) as session:
+		ts_query = func.websearch_to_tsquery(models.TEXT_SEARCH_CONFIG, search_query)
+		rank = func.ts_rank(models.Message.search_vector, ts_query)
+		query = session.query(models.Message, rank).filter(
+			models.Message.search_vector.op('@@')(ts_query),
+			models.Message.parent_channel.in_(list(channel_ids)))
+		if author:
+			query = query.filter(models.Message.author == author)
+		if before:
+			query = query.filter(models.Message.post_date < before)
+		if after:
+			# ts_rank returns a real, so compare with the cursor's rank as a real
+			# as well; otherwise equal ranks would not compare as equal.
+			query = query.filter(tuple_(rank, models.Message.id) < tuple_(cast(after[0], REAL), after[1]))
+		query = query.order_by(rank.desc(), models.Message.id.desc()).limit(limit)
+		return [(clean_object_dict(message.to_dict(), 'message'), message_rank)
+		        for message, message_rank in query.all()]
+
+def get_reports(conference_id=None, target_type=None, after=None, limit=25, group=False):
+	"""
+	Returns reports, newest first, ordered by submission date and ID (both
+	descending). Every filter and the order are covered by an index on the
+	report table, so pages are read without going through all reports.
+
+	Arguments:
+	  - conference_id - only return reports about objects in this conference
+	  - target_type - only return reports about objects of this type
+	  - after - (submission date, ID) tuple of the last report on the
+	            previous page; only reports after it are returned
+	  - limit (default: 25) - maximum amount of reports to return
+	  - group (default: False) - only return the latest report for every
+	                             target
+
+	Returns a list of report dicts, or, if group is set, a list of
+	(latest report dict, amount of reports about its target) tuples.
+	"""
+	with Session(get_engine()) as session:
+		query = session.query(models.Report)
+		if conference_id:
+			query = query.filter(models.Report.target_conference == conference_id)
+		if target_type:
+			query = query.filter(models.Report.target_type == target_type)
+		if after:
+			query = query.filter(tuple_(models.Report.submission_date, models.Report.id) < tuple_(after[0], after[1]))
+		if group:
+			# Skip reports that have a newer report about the same target;
+			# this is a lookup in the (target, submission_date, id) index.
+			newer = aliased(models.Report)
+			query = query.filter(~session.query(newer.id).filter(newer.target == models.Report.target,
+				tuple_(newer.submission_date, newer.id) > tuple_(models.Report.submission_date, models.Report.id)).exists())
+		query = query.order_by(models.Report.submission_date.desc(), models.Report.id.desc()).limit(limit)
+		reports = [clean_object_dict(report.to_dict(), 'report') for report in query.all()]
+		if not group:
+			return reports
+		counts = dict(session.query(models.Report.target, func.count()).filter(
+			models.Report.target.in_([report['target'] for report in reports])).group_by(models.Report.target).all())
+		return [(report, counts.get(report['target'], 1)) for report in reports]
+
+# Operators for get_object_by_key_value_pair; all but "==" take a list and
+# only work on list keys, where they can use the keys' GIN indexes.
+KEY_OPERATORS = {
+	"==": lambda column, value: column == value,
+	"contains": lambda column, value: column.contains(value),
+	"contained_by": lambda column, value: column.contained_by(value),
+	"overlaps": lambda column, value: column.overlap(value)
+}
+
+def get_object_by_key_value_pair(object_type, key_value_dict, limit_objects=False, operator="=="):
 	"""
 	Takes an object type, a dict with key/value pairs and returns objects that
 	match (contain) the key-value pair. Returns a list with dicts.
@@ -146,20 +623,286 @@ def get_object_by_key_value_pair(object_type, key_value_dict, limit_objects=Fals
 	  - limit_objects (default: False) - If set to a number, limits the
 	                                     search to the given amount of
 	                                     objects.
+	  - operator (default: "==") - how values are compared; one of:
+	                               - "==" - the key equals the value,
+	                               - "contains" - the list key contains
+	                                 every item of the value (@>),
+	                               - "contained_by" - every item of the list
+	                                 key is in the value (<@),
+	                               - "overlaps" - the list key and the value
+	                                 have at least one item in common (&&).
+	                               For the list operators, a single value is
+	                               taken as a list with one item.
+
+	Raises ValueError if the operator doesn't exist or can't be used on
+	one of the keys.
 	"""
+	if operator not in KEY_OPERATORS:
+		raise ValueError("Unknown operator: " + str(operator))
 	matches = []
 	model = models.object_type_to_model(object_type)
-	with Session(engine) as session:
+	with Session(get_engine()) as session:
 		for key, value in key_value_dict.items():
-			query = session.query(model).filter(getattr(model, key) == value).all()
-			if query:
-				for object in query:
-					matches.append(clean_object_dict(object.to_dict(), object_type))
+			column = getattr(model, key)
+			if operator != "==":
+				if not isinstance(column.type, postgresql.ARRAY):
+					raise ValueError("The '" + operator + "' operator only works on list keys")
+				if not isinstance(value, (list, tuple, set)):
+					value = [value]
+				value = list(value)
+			query = session.query(model).filter(KEY_OPERATORS[operator](column, value))
+			if limit_objects:
+				query = query.limit(limit_objects)
+			for object in query.all():
+				matches.append(clean_object_dict(object.to_dict(), object_type))
 	if matches:
 		return matches
 	else:
 		return None
 
+def get_object_ids_by_keys(object_type, key_value_dict):
+	"""
+	Returns a list with the IDs of objects of the given type that have all
+	of the given key/value pairs.
+	"""
+	model = models.object_type_to_model(object_type)
+	with Session(get_engine()) as session:
+		return session.execute(select(model.id).where(*[getattr(model, key) == value
+			for key, value in key_value_dict.items()])).scalars().all()
+
+def get_conference_members(conference_id, user_id=None, after=None, limit=25):
+	"""
+	Returns members of a conference, ordered by account ID. Pages are read
+	from the unique (parent_conference, user_id) index.
+
+	Arguments:
+	  - user_id - only return the member for this account
+	  - after - account ID of the last member on the previous page; only
+	            members after it are returned
+	  - limit (default: 25) - maximum amount of members to return
+
+	Returns a list of conference member dicts.
+	"""
+	with Session(get_engine()) as session:
+		query = session.query(models.ConferenceMember).filter(models.ConferenceMember.parent_conference == conference_id)
+		if user_id:
+			query = query.filter(models.ConferenceMember.user_id == user_id)
+		if after:
+			query = query.filter(models.ConferenceMember.user_id > after)
+		query = query.order_by(models.ConferenceMember.user_id).limit(limit)
+		return [clean_object_dict(member.to_dict(), 'conference_member') for member in query.all()]
+
+def get_direct_message(dm_key):
+	"""
+	Returns the dict of the direct message channel with the given key (see
+	objects.direct_message_key), read from the unique dm_key index. Returns
+	None if there is no such channel.
+	"""
+	with Session(get_engine()) as session:
+		channel = session.query(models.Channel).filter(models.Channel.dm_key == dm_key).first()
+		if not channel:
+			return None
+		return clean_object_dict(channel.to_dict(), 'channel')
+
+def add_direct_message(channel):
+	"""
+	Takes a direct message Channel object and inserts it into the database,
+	unless a channel with the same members was added in the meantime.
+	Returns a (channel dict, created) tuple, where created is False if the
+	existing channel was returned.
+	"""
+	try:
+		return (add_object(channel), True)
+	except IntegrityError:
+		return (get_direct_message(channel.dm_key), False)
+
+# Read state
+
+def _count_message(session, message):
+	"""
+	Updates the counters used for unread counts after a message is added:
+	the message count of its channel and the message's position in it
+	(see mark_channel_read), the mention counts of the accounts it
+	mentions, and the read state of its author, who has read the channel up
+	to their own message.
+	"""
+	channel_id = message['parent_channel']
+	table = models.ChannelState.__table__
+	statement = insert(table).values(channel_id=channel_id, message_count=1,
+		last_message=message['id'], last_message_date=message['post_date'])
+	counted = statement.on_conflict_do_update(index_elements=[table.c.channel_id], set_={
+		"message_count": table.c.message_count + 1,
+		"last_message": statement.excluded.last_message,
+		"last_message_date": statement.excluded.last_message_date
+	}).returning(table.c.message_count).cte('counted')
+	# The message's position is stored in the same statement; the message
+	# has to be inserted before it
+	session.flush()
+	positions = models.MessagePosition.__table__
+	message_count = session.execute(insert(positions).from_select(['message_id', 'position'],
+		select(literal(message['id']), counted.c.message_count)).returning(positions.c.position)).scalar()
+
+	table = models.ReadState.__table__
+	rows = [{"account_id": message['author'], "channel_id": channel_id, "last_read_message": message['id'],
+	         "read_count": message_count, "mention_count": 0}]
+	rows += [{"account_id": account_id, "channel_id": channel_id, "last_read_message": None,
+	          "read_count": 0, "mention_count": 1}
+	         for account_id in sorted(set(message.get('mentions') or []) - {message['author']})]
+	statement = insert(table).values(rows)
+	# Only the author's row has a last_read_message
+	is_author = statement.excluded.last_read_message.isnot(None)
+	session.execute(statement.on_conflict_do_update(index_elements=[table.c.account_id, table.c.channel_id], set_={
+		"last_read_message": case((is_author, statement.excluded.last_read_message), else_=table.c.last_read_message),
+		"read_count": case((is_author, statement.excluded.read_count), else_=table.c.read_count),
+		"mention_count": case((is_author, 0), else_=table.c.mention_count + 1)
+	}))
+
+def get_unread_counts(account_id, channel_ids):
+	"""
+	Returns the unread counts of an account in the given channels, in one
+	query. Returns a list of dicts with the channel, unread_count,
+	mention_count, last_read_message and last_message keys, for channels
+	with unread messages or mentions only.
+
+	Unread counts are the amount of messages posted since the account last
+	read the channel (see mark_channel_read); messages that were removed in
+	the meantime are still counted.
+	"""
+	if not channel_ids:
+		return []
+	channel_state = models.ChannelState.__table__
+	read_state = models.ReadState.__table__
+	unread_count = func.greatest(channel_state.c.message_count - func.coalesce(read_state.c.read_count, 0), 0)
+	mention_count = func.coalesce(read_state.c.mention_count, 0)
+	query = select(channel_state.c.channel_id, unread_count, mention_count, read_state.c.last_read_message,
+		channel_state.c.last_message).select_from(channel_state.outerjoin(read_state, and_(
+		read_state.c.channel_id == channel_state.c.channel_id, read_state.c.account_id == account_id))).where(
+		channel_state.c.channel_id.in_(channel_ids), or_(unread_count > 0, mention_count > 0)).order_by(
+		channel_state.c.channel_id)
+	with Session(get_engine()) as session:
+		return [{"channel": channel, "unread_count": unread, "mention_count": mentions,
+		         "last_read_message": last_read_message, "last_message": last_message}
+		        for channel, unread, mentions, last_read_message, last_message in session.execute(query)]
+
+def mark_channel_read(account_id, channel_id, message_id=None):
+	"""
+	Marks a channel as read by an account, up to the message with the given
+	ID (which has to be in the channel) or up to the latest message. The
+	messages after the given one are counted from the position stored when
+	it was posted, without going through the channel's messages.
+
+	Returns a dict with the channel, unread_count, mention_count and
+	last_read_message keys.
+	"""
+	channel_state = models.ChannelState.__table__
+	columns = [select(channel_state.c.message_count).where(channel_state.c.channel_id == channel_id).scalar_subquery(),
+	           select(channel_state.c.last_message).where(channel_state.c.channel_id == channel_id).scalar_subquery()]
+	if message_id:
+		# Read in the same query as the message count, so that all of them
+		# see the same messages. Unread messages are the ones positioned
+		# after the given one; mentions are found through the index on
+		# mentions, so only messages mentioning the account are read.
+		columns.append(select(models.MessagePosition.position).where(
+			models.MessagePosition.message_id == message_id).scalar_subquery())
+		read_message = aliased(models.Message)
+		columns.append(select(func.count()).select_from(models.Message).join(read_message,
+			read_message.id == message_id).where(models.Message.parent_channel == channel_id,
+			models.Message.mentions.contains([account_id]),
+			tuple_(models.Message.post_date, models.Message.id) > tuple_(read_message.post_date, read_message.id)).scalar_subquery())
+
+	table = models.ReadState.__table__
+	with Session(get_engine()) as session:
+		state = session.execute(select(*columns)).one()
+		message_count = state[0] or 0
+		if message_id:
+			last_read_message = message_id
+			# Messages posted before the counters were added have no position
+			unread_count = max(message_count - (state[2] or 0), 0)
+			mention_count = min(state[3], unread_count)
+		else:
+			last_read_message = state[1]
+			unread_count = mention_count = 0
+		statement = insert(table).values(account_id=account_id, channel_id=channel_id,
+			last_read_message=last_read_message, read_count=message_count - unread_count, mention_count=mention_count)
+		session.execute(statement.on_conflict_do_update(index_elements=[table.c.account_id, table.c.channel_id], set_={
+			"last_read_message": statement.excluded.last_read_message,
+			"read_count": statement.excluded.read_count,
+			"mention_count": statement.excluded.mention_count
+		}))
+		session.commit()
+	return {"channel": channel_id, "unread_count": unread_count, "mention_count": mention_count,
+	        "last_read_message": last_read_message}
+
+# Reactions
+
+def add_reaction(message_id, emoji, account_id):
+	"""
+	Adds an account's reaction with an emoji to a message, unless it's
+	already there, and counts it. This only touches the reaction's row and
+	the counter of the emoji, in one statement, so the message itself is
+	never rewritten.
+
+	Returns a tuple with the amount of reactions with the emoji and
+	whether the reaction was added.
+	"""
+	reactions = models.Reaction.__table__
+	counts = models.ReactionCount.__table__
+	added = insert(reactions).values(message_id=message_id, emoji=emoji, account_id=account_id,
+		created=datetime.datetime.utcnow()).on_conflict_do_nothing().returning(
+		reactions.c.message_id, reactions.c.emoji).cte('added')
+	counted = insert(counts).from_select(['message_id', 'emoji', 'count'],
+		select(added.c.message_id, added.c.emoji, 1))
+	counted = counted.on_conflict_do_update(index_elements=[counts.c.message_id, counts.c.emoji],
+		set_={"count": counts.c.count + 1}).returning(counts.c.count).cte('counted')
+	# The outer query doesn't see the changes made by the CTEs, so the old
+	# count is only used if nothing was added
+	current = select(counts.c.count).where(counts.c.message_id == message_id, counts.c.emoji == emoji)
+	with Session(get_engine()) as session:
+		count, was_added = session.execute(select(
+			func.coalesce(select(counted.c.count).scalar_subquery(), current.scalar_subquery(), 0),
+			select(func.count()).select_from(counted).scalar_subquery() > 0)).one()
+		session.commit()
+	return (count, was_added)
+
+def remove_reaction(message_id, emoji, account_id):
+	"""
+	Removes an account's reaction with an emoji from a message, if it's
+	there, and uncounts it; see add_reaction.
+
+	Returns a tuple with the amount of reactions with the emoji and
+	whether the reaction was removed.
+	"""
+	reactions = models.Reaction.__table__
+	counts = models.ReactionCount.__table__
+	removed = delete(reactions).where(reactions.c.message_id == message_id, reactions.c.emoji == emoji,
+		reactions.c.account_id == account_id).returning(reactions.c.message_id, reactions.c.emoji).cte('removed')
+	counted = update(counts).where(counts.c.message_id == removed.c.message_id, counts.c.emoji == removed.c.emoji,
+		counts.c.count > 0).values(count=counts.c.count - 1).returning(counts.c.count).cte('counted')
+	current = select(counts.c.count).where(counts.c.message_id == message_id, counts.c.emoji == emoji)
+	with Session(get_engine()) as session:
+		count, was_removed = session.execute(select(
+			func.coalesce(select(counted.c.count).scalar_subquery(), current.scalar_subquery(), 0),
+			select(func.count()).select_from(removed).scalar_subquery() > 0)).one()
+		session.commit()
+	return (count, was_removed)
+
+def get_reaction_counts(message_ids):
+	"""
+	Returns the reaction counts of the given messages, in one query, as a
+	dict with message IDs as keys and dicts with emojis as keys and counts
+	as values. Emojis are sorted by count, most used first; messages
+	without reactions are left out.
+	"""
+	if not message_ids:
+		return {}
+	counts = models.ReactionCount.__table__
+	result = {}
+	with Session(get_engine()) as session:
+		for message_id, emoji, count in session.execute(select(counts.c.message_id, counts.c.emoji, counts.c.count).where(
+				counts.c.message_id.in_(list(message_ids)), counts.c.count > 0).order_by(counts.c.count.desc(), counts.c.emoji)):
+			result.setdefault(message_id, {})[emoji] = count
+	return result
+
 # Users
 
 def get_user_by_email(email):
@@ -168,7 +911,7 @@ def get_user_by_email(email):
 	None.
 	"""
 	user_dict = None
-	with Session(engine) as session:
+	with Session(get_engine()) as session:
 		query = session.query(models.User).get(email)
 		if query:
 			user_dict = query.to_dict()
@@ -176,7 +919,7 @@ def get_user_by_email(email):
 
 def add_user(user_dict):
 	"""Adds a new user to the database."""
-	with Session(engine) as session:
+	with Session(get_engine()) as session:
 		new_user = models.User()
 		for key in ['account_id', 'username', 'email', 'password']:
 			setattr(new_user, key, user_dict[key])
@@ -187,7 +930,7 @@ def add_user(user_dict):
 
 def update_user(user_email, user_dict):
 	"""Edits a user in the database."""
-	with Session(engine) as session:
+	with Session(get_engine()) as session:
 		object = session.query(models.User).get(user_email)
 		if user_email != user_dict['email']:
 			if get_user_by_email(user_email):
@@ -207,19 +950,48 @@ def remove_user(email):
 
 # Clients
 
+client_keys = ['client_id', 'client_secret', 'name', 'description', 'scopes',
+               'owner', 'type', 'account_id']
+
+def client_to_dict(client):
+	"""
+	Turns a Client model into a client dict. Scopes are stored as a list of
+	scope names, but client dicts store them as a {scope: True} dict.
+	"""
+	client_dict = {key: getattr(client, key) for key in client_keys}
+	client_dict['scopes'] = {scope: True for scope in (client.scopes or [])}
+	return client_dict
+
+def _set_client_values(client, client_dict):
+	"""Sets the values from a client dict on a Client model."""
+	for key in client_keys:
+		if key == 'scopes':
+			scopes = client_dict.get('scopes') or {}
+			client.scopes = [scope for scope, enabled in scopes.items() if enabled]
+		else:
+			setattr(client, key, client_dict.get(key))
+
 def get_client_by_id(client_id):
 	"""Returns a client dict by client ID. Returns None if not found."""
-	if id in client_db:
-		return client_db['id']
+	client_dict = _get_client_cache().get(client_id, False)
+	if client_dict is False:
+		with Session(get_engine()) as session:
+			client = session.query(models.Client).get(client_id)
+			if client:
+				client_dict = client_to_dict(client)
+			else:
+				client_dict = None
+		_get_client_cache().set(client_id, client_dict)
+	if client_dict:
+		return {**client_dict, 'scopes': client_dict['scopes'].copy()}
 	return None
 
 def get_clients_for_user(user_id, access_type):
-	"""Returns a dict containing all clients owned/given access to by an user."""
-	return_dict = {}
+	"""Returns a list of client dicts owned/given access to by an user."""
 	if access_type == "owner":
-		for client_dict in client_db.values():
-			if client_dict['owner'] == user_id:
-				return_dict[client_dict['client_id']] == client_dict
+		with Session(get_engine()) as session:
+			query = session.query(models.Client).filter(models.Client.owner == user_id)
+			return [client_to_dict(client) for client in query.all()]
 	elif access_type == "user":
 		# TODO: We should let people view the apps they're using and
 		# revoke access if needed. This will most likely require adding
@@ -229,23 +1001,194 @@ def get_clients_for_user(user_id, access_type):
 		raise Exception('stub')
 	else:
 		raise ValueError
-	if return_dict:
-		return return_dict
-	return None
 
 def add_client(client_dict):
 	"""Adds a new client to the database."""
-	client_db[client_dict['id']] = client_dict
-	return client_dict
+	with Session(get_engine()) as session:
+		client = models.Client()
+		_set_client_values(client, client_dict)
+		session.add(client)
+		session.commit()
+		new_client_dict = client_to_dict(client)
+	_get_client_cache().invalidate(new_client_dict['client_id'])
+	return new_client_dict
 
 def update_client(client_id, client_dict):
 	"""Updates an existing client"""
-	client_db[client_id] = client_dict
-	return client_dict
+	with Session(get_engine()) as session:
+		client = session.query(models.Client).get(client_id)
+		_set_client_values(client, client_dict)
+		session.commit()
+		new_client_dict = client_to_dict(client)
+	_get_client_cache().invalidate(client_id)
+	return new_client_dict
 
 def remove_client(client_id):
 	"""Removes a client from the database."""
-	del client_db[client_id]
+	with Session(get_engine()) as session:
+		client = session.query(models.Client).get(client_id)
+		if client:
+			session.delete(client)
+			session.commit()
+	_get_client_cache().invalidate(client_id)
 	# TODO: Handle removing removed clients from "used applications" variables
 	# in user info; since we don't implement this yet, there's no code for it
 	return client_id
+
+# Revoked access tokens
+
+def add_revoked_token(jti, expires):
+	"""
+	Adds an access token ID to the revocation list. The entry is kept until
+	the given expiry date (a datetime) has passed.
+	"""
+	with Session(get_engine()) as session:
+		if not session.query(models.RevokedToken).get(jti):
+			session.add(models.RevokedToken(jti=jti, expires=expires))
+			session.commit()
+	return jti
+
+def get_revoked_tokens():
+	"""
+	Returns a dict containing the IDs of revoked access tokens that have not
+	expired yet, alongside their expiry dates. Expired entries are removed
+	from the database.
+	"""
+	now = datetime.datetime.utcnow()
+	with Session(get_engine()) as session:
+		session.query(models.RevokedToken).filter(models.RevokedToken.expires <= now).delete()
+		session.commit()
+		return {token.jti: token.expires for token in session.query(models.RevokedToken).all()}
+
+# Rate limits
+
+def take_rate_limit_tokens(buckets):
+	"""
+	Takes a token from each of the given rate limit buckets, in a single
+	query. Buckets are refilled based on the time since they were last
+	used; this is done by the database, so that every worker sees the same
+	state.
+
+	Takes a list of (key, rate, burst) tuples, where rate is the amount of
+	tokens added per second and burst is the size of the bucket. Returns a
+	dict with keys as keys and (tokens left, allowed) tuples as values;
+	allowed is False if the bucket was empty, in which case no token was
+	taken from it.
+	"""
+	table = models.RateLimitBucket.__table__
+	now = func.timezone('UTC', func.clock_timestamp())
+	elapsed = func.greatest(0, func.extract('epoch', now - table.c.updated))
+	statement = insert(table).values([{"key": key, "tokens": burst - 1, "rate": rate, "burst": burst,
+	                                   "allowed": True, "updated": now} for key, rate, burst in buckets])
+	refilled = func.least(statement.excluded.burst, table.c.tokens + elapsed * statement.excluded.rate)
+	statement = statement.on_conflict_do_update(index_elements=[table.c.key], set_={
+		"tokens": case((refilled >= 1, refilled - 1), else_=refilled),
+		"rate": statement.excluded.rate,
+		"burst": statement.excluded.burst,
+		"allowed": refilled >= 1,
+		"updated": now
+	}).returning(table.c.key, table.c.tokens, table.c.allowed)
+	with Session(get_engine()) as session:
+		result = session.execute(statement).all()
+		session.commit()
+		return {key: (tokens, allowed) for key, tokens, allowed in result}
+
+def remove_full_rate_limit_buckets():
+	"""
+	Removes rate limit buckets that have refilled completely since they
+	were last used, as they are the same as buckets that don't exist yet.
+	"""
+	table = models.RateLimitBucket.__table__
+	elapsed = func.extract('epoch', func.timezone('UTC', func.clock_timestamp()) - table.c.updated)
+	with Session(get_engine()) as session:
+		session.execute(table.delete().where(table.c.tokens + elapsed * table.c.rate >= table.c.burst))
+		session.commit()
+
+# Jobs
+
+# Channel used to notify job runners about new jobs; the payload is the
+# name of the queue.
+JOB_CHANNEL = "drywall_jobs"
+
+def _utc_now():
+	return func.timezone('UTC', func.clock_timestamp())
+
+def add_jobs(jobs):
+	"""
+	Adds jobs to their queues and notifies job runners about them, in one
+	transaction. Takes a list of dicts with the queue, task, payload,
+	priority, max_attempts and delay (in seconds) keys. Returns a list
+	with the IDs of the added jobs.
+	"""
+	table = models.Job.__table__
+	with Session(get_engine()) as session:
+		# Identical notifications are only delivered once per transaction
+		ids = session.execute(insert(table).values([{
+			"queue": job['queue'], "task": job['task'], "payload": job['payload'],
+			"priority": job['priority'], "attempts": 0, "max_attempts": job['max_attempts'],
+			"run_at": _utc_now() + datetime.timedelta(seconds=job['delay']), "created": _utc_now()
+		} for job in jobs]).returning(table.c.id, func.pg_notify(JOB_CHANNEL, table.c.queue))).scalars().all()
+		session.commit()
+	return ids
+
+def claim_jobs(queue, limit, lease):
+	"""
+	Claims up to limit jobs that are ready to run from a queue, in order of
+	priority (lowest first) and then of the time they became ready. Jobs
+	locked by other transactions are skipped, so that runners never wait
+	for each other.
+
+	Claimed jobs aren't handed out again for lease seconds, unless they're
+	retried or finished earlier, and have their attempt counted. Returns a
+	list of dicts with the id, task, payload, priority, attempts,
+	max_attempts and latency (seconds since the job became ready) keys, in
+	the order the jobs should run in.
+	"""
+	table = models.Job.__table__
+	claimed = select(table.c.id, table.c.run_at).where(table.c.queue == queue, table.c.failed.is_(None),
+		table.c.run_at <= _utc_now()).order_by(table.c.priority, table.c.run_at, table.c.id).limit(
+		limit).with_for_update(skip_locked=True).cte('claimed')
+	statement = update(table).where(table.c.id == claimed.c.id).values(attempts=table.c.attempts + 1,
+		run_at=_utc_now() + datetime.timedelta(seconds=lease)).returning(table.c.id, table.c.task,
+		table.c.payload, table.c.priority, table.c.attempts, table.c.max_attempts,
+		func.extract('epoch', _utc_now() - claimed.c.run_at).label('latency'))
+	with Session(get_engine()) as session:
+		jobs = [dict(job._mapping) for job in session.execute(statement)]
+		session.commit()
+	# RETURNING doesn't keep the order of the claiming query
+	jobs.sort(key=lambda job: (job['priority'], -job['latency'], job['id']))
+	return jobs
+
+def finish_jobs(ids):
+	"""Removes finished jobs."""
+	if not ids:
+		return
+	with Session(get_engine()) as session:
+		session.execute(delete(models.Job).where(models.Job.id.in_(ids)))
+		session.commit()
+
+def retry_job(id, error, delay):
+	"""Records a failed attempt at running a job and runs it again after delay seconds."""
+	with Session(get_engine()) as session:
+		session.execute(update(models.Job).where(models.Job.id == id).values(last_error=error,
+			run_at=_utc_now() + datetime.timedelta(seconds=delay)))
+		session.commit()
+
+def fail_job(id, error):
+	"""Records the last failed attempt at running a job; it isn't run again."""
+	with Session(get_engine()) as session:
+		session.execute(update(models.Job).where(models.Job.id == id).values(last_error=error,
+			failed=_utc_now()))
+		session.commit()
+
+def get_job_queue_stats():
+	"""
+	Returns a dict with queue names as keys and (amount of jobs ready to
+	run, seconds since the oldest of them became ready) tuples as values.
+	Jobs that are waiting for a retry or currently running aren't counted.
+	"""
+	table = models.Job.__table__
+	with Session(get_engine()) as session:
+		return {queue: (count, age) for queue, count, age in session.execute(
+			select(table.c.queue, func.count(), func.extract('epoch', _utc_now() - func.min(table.c.run_at))).where(
+			table.c.failed.is_(None), table.c.run_at <= _utc_now()).group_by(table.c.queue))}
@@ -2,15 +2,18 @@
 # drywall utilities. For more information, see the documentation:
 # https://punctum-im.github.io/drywall/dev/alchemify
 
-from sqlalchemy import Column, ForeignKey
-from sqlalchemy import Integer, String, DateTime, Boolean, SmallInteger, Text
-from sqlalchemy.orm import declarative_base
+from sqlalchemy import Column, Computed, ForeignKey, Index, text
+from sqlalchemy import BigInteger, Integer, String, DateTime, Boolean, SmallInteger, Text, Float
+from sqlalchemy.orm import declarative_base, deferred
 from sqlalchemy.dialects import postgresql
 from sqlalchemy_serializer import SerializerMixin
 import datetime
 
 Base = declarative_base()
 
+# Text search configuration used for search vectors and queries.
+TEXT_SEARCH_CONFIG = 'simple'
+
 class CustomSerializerMixin(SerializerMixin):
 	# TODO: Ideally we'd just set datetime_format to None to set it to isoformat,
 	#       but that leaves out the +00:00 suffix, because we're missing
@@ -24,9 +27,13 @@ class CustomSerializerMixin(SerializerMixin):
 # Main object lookup table
 class Objects(Base):
 	__tablename__ = 'objects'
+	__table_args__ = (Index('ix_objects_deleted', 'deleted', postgresql_where=text('deleted IS NOT NULL')),)
 
 	id = Column(String(255), primary_key=True)
 	object_type = Column(String(255), nullable=False)
+	# Set when the object is deleted, until its dependents are removed in
+	# the background (see drywall/deletion.py)
+	deleted = Column(DateTime)
 
 # instance
 class Instance(Base, CustomSerializerMixin):
@@ -41,6 +48,7 @@ class Instance(Base, CustomSerializerMixin):
 # account
 class Account(Base, CustomSerializerMixin):
 	__tablename__ = 'account'
+	__table_args__ = (Index('ix_account_friends', 'friends', postgresql_using='gin'), Index('ix_account_blocklist', 'blocklist', postgresql_using='gin'),)
 
 	id = Column('id', String(255), primary_key=True)
 	username = Column(Text, nullable=False, unique=True)
@@ -56,12 +64,13 @@ class Account(Base, CustomSerializerMixin):
 # conference
 class Conference(Base, CustomSerializerMixin):
 	__tablename__ = 'conference'
+	__table_args__ = (Index('ix_conference_channels', 'channels', postgresql_using='gin'), Index('ix_conference_users', 'users', postgresql_using='gin'), Index('ix_conference_roles', 'roles', postgresql_using='gin'),)
 
 	id = Column('id', String(255), primary_key=True)
 	name = Column(Text, nullable=False)
 	description = Column(Text)
 	icon = Column(Text, nullable=False)
-	owner = Column(String(255), ForeignKey('account.id'), nullable=False)
+	owner = Column(String(255), ForeignKey('account.id'), nullable=False, index=True)
 	index_conference = Column(Boolean, default=False)
 	permissions = Column(SmallInteger, nullable=False)
 	creation_date = Column(DateTime, nullable=False)
@@ -69,12 +78,24 @@ class Conference(Base, CustomSerializerMixin):
 	users = Column(postgresql.ARRAY(String(255)))
 	roles = Column(postgresql.ARRAY(String(255)))
 
+# role
+class Role(Base, CustomSerializerMixin):
+	__tablename__ = 'role'
+
+	id = Column('id', String(255), primary_key=True)
+	name = Column(Text, nullable=False)
+	permissions = Column(SmallInteger, nullable=False)
+	color = Column(Text, nullable=False)
+	description = Column(Text)
+	parent_conference = Column(String(255), ForeignKey('conference.id'), nullable=False, index=True)
+
 # conference_member
 class ConferenceMember(Base, CustomSerializerMixin):
 	__tablename__ = 'conference_member'
+	__table_args__ = (Index('ix_conference_member_parent_conference_user_id', 'parent_conference', 'user_id', unique=True), Index('ix_conference_member_roles', 'roles', postgresql_using='gin'),)
 
 	id = Column('id', String(255), primary_key=True)
-	user_id = Column(String(255), ForeignKey('account.id'), nullable=False)
+	user_id = Column(String(255), ForeignKey('account.id'), nullable=False, index=True)
 	nickname = Column(Text)
 	parent_conference = Column(String(255), ForeignKey('conference.id'), nullable=False)
 	roles = Column(postgresql.ARRAY(String(255)))
@@ -84,31 +105,35 @@ class ConferenceMember(Base, CustomSerializerMixin):
 # channel
 class Channel(Base, CustomSerializerMixin):
 	__tablename__ = 'channel'
+	__table_args__ = (Index('ix_channel_members', 'members', postgresql_using='gin'),)
 
 	id = Column('id', String(255), primary_key=True)
 	name = Column(Text, nullable=False)
 	permissions = Column(SmallInteger, nullable=False)
 	channel_type = Column(Text, nullable=False)
-	parent_conference = Column(String(255), ForeignKey('conference.id'))
+	parent_conference = Column(String(255), ForeignKey('conference.id'), index=True)
 	members = Column(postgresql.ARRAY(String(255)))
 	icon = Column(Text)
 	description = Column(Text)
+	dm_key = Column(Text, unique=True)
 
 # message
 class Message(Base, CustomSerializerMixin):
 	__tablename__ = 'message'
+	__table_args__ = (Index('ix_message_parent_channel_post_date', 'parent_channel', 'post_date'), Index('ix_message_reply_to_post_date', 'reply_to', 'post_date'), Index('ix_message_attached_files', 'attached_files', postgresql_using='gin'), Index('ix_message_mentions', 'mentions', postgresql_using='gin'), Index('ix_message_search_vector', 'search_vector', postgresql_using='gin'),)
+	serialize_rules = ('-search_vector',)
 
 	id = Column('id', String(255), primary_key=True)
 	content = Column(Text, nullable=False)
 	parent_channel = Column(String(255), ForeignKey('channel.id'), nullable=False)
-	author = Column(String(255), ForeignKey('account.id'), nullable=False)
+	author = Column(String(255), ForeignKey('account.id'), nullable=False, index=True)
 	post_date = Column(DateTime, nullable=False)
 	edit_date = Column(DateTime)
 	edited = Column(Boolean, nullable=False, default=False)
 	attached_files = Column(postgresql.ARRAY(String(255)))
-	reactions = Column(postgresql.ARRAY(String(255)))
 	reply_to = Column(String(255), ForeignKey('message.id'))
-	replies = Column(postgresql.ARRAY(String(255)))
+	mentions = Column(postgresql.ARRAY(String(255)))
+	search_vector = deferred(Column(postgresql.TSVECTOR, Computed("to_tsvector('simple', coalesce(content, ''))", persisted=True)))
 
 # invite
 class Invite(Base, CustomSerializerMixin):
@@ -116,28 +141,20 @@ class Invite(Base, CustomSerializerMixin):
 
 	id = Column('id', String(255), primary_key=True)
 	code = Column(Text, nullable=False, unique=True)
-	conference_id = Column(String(255), ForeignKey('conference.id'), nullable=False)
-	creator = Column(String(255), ForeignKey('account.id'), nullable=False)
-
-# role
-class Role(Base, CustomSerializerMixin):
-	__tablename__ = 'role'
-
-	id = Column('id', String(255), primary_key=True)
-	name = Column(Text, nullable=False)
-	permissions = Column(SmallInteger, nullable=False)
-	color = Column(Text, nullable=False)
-	description = Column(Text)
-	parent_conference = Column(String(255), ForeignKey('conference.id'), nullable=False)
+	conference_id = Column(String(255), ForeignKey('conference.id'), nullable=False, index=True)
+	creator = Column(String(255), ForeignKey('account.id'), nullable=False, index=True)
 
 # report
 class Report(Base, CustomSerializerMixin):
 	__tablename__ = 'report'
+	__table_args__ = (Index('ix_report_target_submission_date_id', 'target', 'submission_date', 'id'), Index('ix_report_submission_date_id', 'submission_date', 'id'), Index('ix_report_target_type_submission_date_id', 'target_type', 'submission_date', 'id'), Index('ix_report_target_conference_submission_date_id', 'target_conference', 'submission_date', 'id'),)
 
 	id = Column('id', String(255), primary_key=True)
-	target = Column(String(255), ForeignKey('objects.id', ondelete="CASCADE"), nullable=False)
+	target = Column(String(255), ForeignKey('objects.id', ondelete='CASCADE'), nullable=False)
 	note = Column(Text)
 	submission_date = Column(DateTime, nullable=False)
+	target_type = Column(Text)
+	target_conference = Column(String(255), ForeignKey('conference.id', ondelete='CASCADE'))
 
 # User
 class User(Base, SerializerMixin):
@@ -148,6 +165,112 @@ class User(Base, SerializerMixin):
 	username = Column(String(255), nullable=False, unique=True)
 	password = Column(Text, nullable=False)
 
+# OAuth2 clients
+class Client(Base, SerializerMixin):
+	__tablename__ = "clients"
+
+	client_id = Column(String(255), primary_key=True)
+	client_secret = Column(String(255), nullable=False)
+	name = Column(Text, nullable=False)
+	description = Column(Text)
+	scopes = Column(postgresql.ARRAY(String(255)))
+	owner = Column(String(255), ForeignKey('account.id'), nullable=False, index=True)
+	type = Column(String(255), nullable=False)
+	account_id = Column(String(255), ForeignKey('account.id'))
+
+# Revoked access tokens
+class RevokedToken(Base):
+	__tablename__ = "revoked_tokens"
+
+	jti = Column(String(255), primary_key=True)
+	expires = Column(DateTime, nullable=False, index=True)
+
+# Rate limit token buckets, for the database rate limit backend
+class RateLimitBucket(Base):
+	__tablename__ = "rate_limit_buckets"
+
+	key = Column(String(255), primary_key=True)
+	tokens = Column(Float, nullable=False)
+	rate = Column(Float, nullable=False)
+	burst = Column(Float, nullable=False)
+	allowed = Column(Boolean, nullable=False)
+	updated = Column(DateTime, nullable=False)
+
+# Background jobs; see drywall/jobs.py
+class Job(Base):
+	__tablename__ = "jobs"
+	__table_args__ = (Index('ix_jobs_queue_priority_run_at_id', 'queue', 'priority', 'run_at', 'id',
+		postgresql_where=text('failed IS NULL')),)
+
+	id = Column(BigInteger, primary_key=True)
+	queue = Column(String(255), nullable=False)
+	task = Column(String(255), nullable=False)
+	payload = Column(postgresql.JSONB, nullable=False)
+	priority = Column(SmallInteger, nullable=False, default=0)
+	attempts = Column(Integer, nullable=False, default=0)
+	max_attempts = Column(Integer, nullable=False)
+	# When the job can run next; pushed forward while the job is running
+	# (see job_lease_time) and after failed attempts
+	run_at = Column(DateTime, nullable=False)
+	created = Column(DateTime, nullable=False)
+	last_error = Column(Text)
+	# Set once the job has used up all of its attempts
+	failed = Column(DateTime)
+
+# Message counters for unread counts; see db.get_unread_counts
+class ChannelState(Base):
+	__tablename__ = "channel_state"
+
+	channel_id = Column(String(255), ForeignKey('channel.id', ondelete='CASCADE'), primary_key=True)
+	# Amount of messages ever posted in the channel
+	message_count = Column(BigInteger, nullable=False, default=0)
+	last_message = Column(String(255))
+	last_message_date = Column(DateTime)
+
+# Position of messages in their channel; see db.mark_channel_read
+class MessagePosition(Base):
+	__tablename__ = "message_position"
+
+	message_id = Column(String(255), ForeignKey('message.id', ondelete='CASCADE'), primary_key=True)
+	# The channel's message_count right after the message was posted
+	position = Column(BigInteger, nullable=False)
+
+# How far accounts have read in channels
+class ReadState(Base):
+	__tablename__ = "read_state"
+
+	account_id = Column(String(255), ForeignKey('account.id', ondelete='CASCADE'), primary_key=True)
+	channel_id = Column(String(255), ForeignKey('channel.id', ondelete='CASCADE'), primary_key=True, index=True)
+	last_read_message = Column(String(255))
+	# The channel's message_count at last_read_message
+	read_count = Column(BigInteger, nullable=False, default=0)
+	# Amount of messages mentioning the account posted since last_read_message
+	mention_count = Column(Integer, nullable=False, default=0)
+
+# Reactions to messages; see db.add_reaction
+class Reaction(Base):
+	__tablename__ = "reactions"
+
+	message_id = Column(String(255), ForeignKey('message.id', ondelete='CASCADE'), primary_key=True)
+	emoji = Column(String(255), primary_key=True)
+	account_id = Column(String(255), ForeignKey('account.id', ondelete='CASCADE'), primary_key=True, index=True)
+	created = Column(DateTime, nullable=False)
+
+# Amount of reactions with each emoji on messages
+class ReactionCount(Base):
+	__tablename__ = "reaction_counts"
+
+	message_id = Column(String(255), ForeignKey('message.id', ondelete='CASCADE'), primary_key=True)
+	emoji = Column(String(255), primary_key=True)
+	count = Column(Integer, nullable=False, default=0)
+
+# Applied migrations
+class SchemaMigration(Base):
+	__tablename__ = "schema_migrations"
+
+	version = Column(String(255), primary_key=True)
+	applied = Column(DateTime, nullable=False)
+
 # Helper functions
 
 def object_type_to_model(object_type):
@@ -162,6 +285,8 @@ def object_type_to_model(object_type):
 		return Account
 	elif object_type == 'conference':
 		return Conference
+	elif object_type == 'role':
+		return Role
 	elif object_type == 'conference_member':
 		return ConferenceMember
 	elif object_type == 'channel':
@@ -170,8 +295,6 @@ def object_type_to_model(object_type):
 		return Message
 	elif object_type == 'invite':
 		return Invite
-	elif object_type == 'role':
-		return Role
 	elif object_type == 'report':
 		return Report
 	else:
@@ -0,0 +1,122 @@
+# coding: utf-8
+"""
+Contains the job that removes deleted conferences and channels along with
+everything in them.
+
+Deleting a conference or channel only marks it (and, for conferences, its
+channels) as deleted, which is quick; see db.tombstone_object.
+Marked objects can't be fetched or referenced by new objects anymore. A
+purge_deleted job on the deletion queue (see jobs.py) then removes their
+dependents in batches of at most deletion_batch_size objects, each in its
+own short transaction:
+  - channels: their messages, then the channel itself,
+  - conferences: their channels (as above), members, roles, invites and
+    reports about objects in them, then the conference itself.
+Reports about removed objects are removed along with them.
+
+To leave the database to requests, the job sleeps after every batch, so
+that it spends at most deletion_duty_cycle of its time running batches.
+Slow batches (for example, when the database is busy) lead to longer
+pauses. Removing an object twice is harmless, so the job can be retried.
+Objects whose job failed for good are removed by the purge-deleted
+command.
+
+Settings (in config.json):
+  - deletion_batch_size - maximum amount of objects removed per batch.
+                          Defaults to 500.
+  - deletion_duty_cycle - share of time spent running batches, between 0
+                          and 1. Defaults to 0.2.
+"""
+from drywall import config
+from drywall import db
+from drywall import directory
+from drywall import jobs
+from drywall import permissions
+
+import time
+
+# Default for the deletion_batch_size setting.
+DEFAULT_BATCH_SIZE = 500
+# Default for the deletion_duty_cycle setting.
+DEFAULT_DUTY_CYCLE = 0.2
+
+# Object types that are deleted in the background.
+CASCADE_TYPES = ("conference", "channel")
+# Dependents of a conference other than its channels, as (object type, key
+# pointing at the conference) tuples, in the order they are removed.
+CONFERENCE_DEPENDENTS = [("conference_member", "parent_conference"), ("role", "parent_conference"),
+                         ("invite", "conference_id"), ("report", "target_conference")]
+
+def delete(object_id, object_type):
+	"""
+	Marks a conference or channel as deleted and adds a job removing it.
+	Returns immediately; the object is removed by a job runner.
+	"""
+	scope_id = _get_scope(object_id)
+	db.tombstone_object(object_id)
+	# Marking objects is a bulk update, which the ORM events don't see
+	permissions.invalidate(scope_id)
+	directory.remove(object_type, object_id)
+	jobs.enqueue('purge_deleted', {"id": object_id, "object_type": object_type})
+
+def _get_scope(object_id):
+	"""
+	Returns the ID of the conference a conference or channel belongs to, or
+	the ID of the channel itself for direct message channels; see
+	permissions.invalidate. Works for objects marked as deleted.
+	"""
+	return db.get_object_type_and_conference(object_id)[1] or object_id
+
+def _throttle(started):
+	"""Sleeps long enough to keep the share of time spent in batches at the duty cycle."""
+	duty_cycle = config.get('deletion_duty_cycle') or DEFAULT_DUTY_CYCLE
+	if duty_cycle < 1:
+		time.sleep((time.monotonic() - started) * (1 - duty_cycle) / duty_cycle)
+
+def _delete_dependents(object_type, key, value, throttle):
+	"""Removes all objects of the given type whose key has the given value, in batches."""
+	batch_size = config.get('deletion_batch_size') or DEFAULT_BATCH_SIZE
+	while True:
+		started = time.monotonic()
+		ids = db.delete_dependents_batch(object_type, key, value, batch_size)
+		if throttle:
+			_throttle(started)
+		if len(ids) < batch_size:
+			return
+
+def purge(object_id, object_type, throttle=True):
+	"""
+	Removes a conference or channel marked as deleted, with everything in
+	it, in batches.
+	"""
+	scope_id = _get_scope(object_id)
+	if object_type == 'conference':
+		channels = db.get_object_by_key_value_pair('channel', {'parent_conference': object_id}) or []
+		for channel in channels:
+			purge(channel['id'], 'channel', throttle=throttle)
+		for dependent_type, key in CONFERENCE_DEPENDENTS:
+			_delete_dependents(dependent_type, key, object_id, throttle)
+	elif object_type == 'channel':
+		_delete_dependents('message', 'parent_channel', object_id, throttle)
+	db.delete_tombstoned_object(object_id, object_type)
+	# Bulk deletes don't trigger the ORM events that usually take care of this
+	permissions.invalidate(scope_id)
+	directory.remove(object_type, object_id)
+
+def purge_pending(throttle=True):
+	"""
+	Removes all objects marked as deleted. Returns the amount of removed
+	conferences and channels.
+	"""
+	purged = 0
+	while True:
+		tombstones = db.get_tombstones()
+		if not tombstones:
+			return purged
+		for object_id, object_type in tombstones:
+			purge(object_id, object_type, throttle=throttle)
+			purged += 1
+
+@jobs.task('purge_deleted', queue='deletion')
+def _purge_job(payload):
+	purge(payload['id'], payload['object_type'])
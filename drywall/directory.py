@@ -0,0 +1,324 @@
+# coding: utf-8
+"""
+Contains the directory search index, used to find accounts and conferences
+that have opted into being listed (see Object.directory_key and
+Object.directory_flag) by name.
+
+The index is kept in memory, since directory search is used for
+autocompletion and has to be fast. It has two parts:
+  - a sorted list of (name, ID) pairs, with names case-folded, used for
+    prefix matches,
+  - an inverted trigram index ({trigram: set of IDs}), used for fuzzy
+    matches. Names are split into trigrams the same way Postgres' pg_trgm
+    does it, and the similarity of two names is the amount of trigrams
+    they share divided by the amount of distinct trigrams in both.
+
+Prefix matches come first, in alphabetical order; they are followed by
+fuzzy matches with a similarity of at least directory_similarity_threshold,
+ordered by similarity.
+
+The index is loaded from the database the first time it's used. Objects
+that are inserted, updated or deleted through the ORM are updated in the
+index once the change is committed; this only happens within the current
+process, so the index is also reloaded in the background every
+directory_refresh seconds, to pick up changes made by other workers.
+
+Settings (in config.json):
+  - directory_refresh - time after which the index is reloaded, in seconds.
+                        Defaults to 300.
+  - directory_similarity_threshold - minimum similarity of fuzzy matches,
+                                     between 0 and 1. Defaults to 0.3.
+"""
+from drywall import config
+from drywall import db
+from drywall import db_models as models
+from drywall import objects
+
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+import os
+import re
+import sys
+import threading
+import time
+
+# Default for the directory_refresh setting, in seconds.
+DEFAULT_REFRESH = 300
+# Default for the directory_similarity_threshold setting.
+DEFAULT_SIMILARITY_THRESHOLD = 0.3
+
+# Object classes that can be found through directory search, by object type.
+DIRECTORY_OBJECTS = {object.object_type: object for object in objects.objects if object.directory_key}
+
+_word_regex = re.compile(r'\w+')
+
+def normalize(name):
+	"""Returns the form of a name that is stored in the index."""
+	return name.casefold().strip()
+
+def get_trigrams(name):
+	"""
+	Returns the set of trigrams in a name. Every word is padded with two
+	spaces in front and one at the end, so that the start of a word weighs
+	more than its end.
+	"""
+	trigrams = set()
+	for word in _word_regex.findall(normalize(name)):
+		word = "  " + word + " "
+		for i in range(len(word) - 2):
+			trigrams.add(sys.intern(word[i:i+3]))
+	return trigrams
+
+class DirectoryIndex:
+	"""In-memory prefix and trigram index of the objects of one type."""
+	def __init__(self, entries=()):
+		self.lock = threading.RLock()
+		# Sorted list of (normalized name, ID) pairs
+		self.names = []
+		# {ID: (normalized name, amount of trigrams)}
+		self.entries = {}
+		# {trigram: set of IDs}
+		self.trigrams = {}
+		self.loaded = time.monotonic()
+		for id, name in entries:
+			self._add(id, name)
+		self.names.sort()
+
+	def _add(self, id, name):
+		name = normalize(name)
+		trigrams = get_trigrams(name)
+		self.entries[id] = (name, len(trigrams))
+		self.names.append((name, id))
+		for trigram in trigrams:
+			self.trigrams.setdefault(trigram, set()).add(id)
+
+	def add(self, id, name):
+		"""Adds an object to the index, replacing the old entry if needed."""
+		with self.lock:
+			self.remove(id)
+			name = normalize(name)
+			trigrams = get_trigrams(name)
+			self.entries[id] = (name, len(trigrams))
+			insort(self.names, (name, id))
+			for trigram in trigrams:
+				self.trigrams.setdefault(trigram, set()).add(id)
+
+	def remove(self, id):
+		"""Removes an object from the index, if it's in it."""
+		with self.lock:
+			entry = self.entries.pop(id, None)
+			if not entry:
+				return
+			name = entry[0]
+			position = bisect_left(self.names, (name, id))
+			if position < len(self.names) and self.names[position] == (name, id):
+				del self.names[position]
+			for trigram in get_trigrams(name):
+				ids = self.trigrams.get(trigram)
+				if ids is not None:
+					ids.discard(id)
+					if not ids:
+						del self.trigrams[trigram]
+
+	def _prefix_matches(self, query, after=None):
+		"""
+		Yields (name, ID) pairs of names starting with the query, in order,
+		starting after the given (name, ID) pair.
+		"""
+		if after:
+			position = bisect_right(self.names, tuple(after))
+		else:
+			position = bisect_left(self.names, (query,))
+		while position < len(self.names) and self.names[position][0].startswith(query):
+			yield self.names[position]
+			position += 1
+
+	def _fuzzy_matches(self, query, threshold):
+		"""
+		Returns a sorted list of (-similarity, name, ID) tuples for names that
+		are similar to the query, but don't start with it.
+		"""
+		query_trigrams = get_trigrams(query)
+		if not query_trigrams:
+			return []
+		shared = Counter()
+		for trigram in query_trigrams:
+			ids = self.trigrams.get(trigram)
+			if ids:
+				shared.update(ids)
+		matches = []
+		for id, count in shared.items():
+			name, trigram_count = self.entries[id]
+			similarity = count / (len(query_trigrams) + trigram_count - count)
+			if similarity >= threshold and not name.startswith(query):
+				matches.append((-similarity, name, id))
+		matches.sort()
+		return matches
+
+	def search(self, query, limit, after=None, threshold=DEFAULT_SIMILARITY_THRESHOLD):
+		"""
+		Searches the index. Returns a list of up to limit (ID, position)
+		tuples. Positions are [0, 0, name, ID] lists for prefix matches and
+		[1, -similarity, name, ID] lists for fuzzy matches; they can be
+		passed as after to get the results that follow.
+		"""
+		query = normalize(query)
+		results = []
+		with self.lock:
+			if not after or after[0] == 0:
+				for name, id in self._prefix_matches(query, after[2:] if after else None):
+					results.append((id, [0, 0, name, id]))
+					if len(results) >= limit:
+						return results
+				after = None
+			for similarity, name, id in self._fuzzy_matches(query, threshold):
+				if after and (similarity, name, id) <= tuple(after[1:]):
+					continue
+				results.append((id, [1, similarity, name, id]))
+				if len(results) >= limit:
+					break
+		return results
+
+# Indexes: {object type: DirectoryIndex}
+_indexes = {}
+_indexes_lock = threading.Lock()
+# Changes committed while an index is being reloaded in the background, to
+# be applied to the new index: {object type: list of (ID, name or None)}
+_pending = {}
+
+def _load_index(object_type):
+	"""Loads the index of an object type from the database."""
+	object = DIRECTORY_OBJECTS[object_type]
+	return DirectoryIndex(db.get_directory_entries(object_type, object.directory_key, object.directory_flag))
+
+def _apply_change(index, id, name):
+	if name:
+		index.add(id, name)
+	else:
+		index.remove(id)
+
+def _reload_index(object_type):
+	index = None
+	try:
+		index = _load_index(object_type)
+	finally:
+		with _indexes_lock:
+			for id, name in _pending.pop(object_type, ()):
+				if index is not None:
+					_apply_change(index, id, name)
+			if index is not None:
+				_indexes[object_type] = index
+			elif object_type in _indexes:
+				# Try again after the next refresh period
+				_indexes[object_type].loaded = time.monotonic()
+
+def get_index(object_type):
+	"""
+	Returns the index of an object type, loading it if needed. Stale indexes
+	are returned as is while they are reloaded in a background thread.
+	"""
+	index = _indexes.get(object_type)
+	if index is None:
+		with _indexes_lock:
+			index = _indexes.get(object_type)
+			if index is None:
+				index = _load_index(object_type)
+				_indexes[object_type] = index
+		return index
+
+	refresh = config.get('directory_refresh') or DEFAULT_REFRESH
+	if time.monotonic() - index.loaded > refresh:
+		with _indexes_lock:
+			if object_type not in _pending:
+				_pending[object_type] = []
+				threading.Thread(target=_reload_index, args=(object_type,), daemon=True).start()
+	return index
+
+def search(object_type, query, limit, after=None):
+	"""
+	Searches for objects of the given type by name. Returns a list of up to
+	limit (ID, position) tuples; see DirectoryIndex.search.
+
+	Raises a ValueError if the position passed as after is invalid.
+	"""
+	if after and (len(after) != 4 or after[0] not in (0, 1) or
+	              not isinstance(after[1], (int, float)) or
+	              not isinstance(after[2], str) or not isinstance(after[3], str)):
+		raise ValueError("Invalid cursor")
+	threshold = config.get('directory_similarity_threshold')
+	if threshold is None:
+		threshold = DEFAULT_SIMILARITY_THRESHOLD
+	return get_index(object_type).search(query, limit, after=after, threshold=threshold)
+
+def remove(object_type, id):
+	"""
+	Removes an object from the index. Objects deleted through the ORM are
+	removed automatically; this is for objects removed in other ways.
+	"""
+	if object_type not in DIRECTORY_OBJECTS:
+		return
+	with _indexes_lock:
+		index = _indexes.get(object_type)
+		if index is not None:
+			_apply_change(index, id, None)
+		if object_type in _pending:
+			_pending[object_type].append((id, None))
+
+def clear():
+	"""Drops all indexes; they are loaded again the next time they're used."""
+	with _indexes_lock:
+		_indexes.clear()
+
+def _forget_indexes():
+	"""Resets the locks inherited from the parent after a fork."""
+	global _indexes_lock
+	_indexes_lock = threading.Lock()
+	_pending.clear()
+	for index in _indexes.values():
+		index.lock = threading.RLock()
+
+os.register_at_fork(after_in_child=_forget_indexes)
+
+##
+# Updates
+##
+
+def _record_change(mapper, connection, target):
+	object = DIRECTORY_OBJECTS[target.__tablename__]
+	name = getattr(target, object.directory_key)
+	if getattr(target, object.directory_flag) and name:
+		change = name
+	else:
+		change = None
+	Session.object_session(target).info.setdefault('directory_changes', {})[(object.object_type, target.id)] = change
+
+def _record_delete(mapper, connection, target):
+	Session.object_session(target).info.setdefault('directory_changes', {})[(target.__tablename__, target.id)] = None
+
+for _object_type in DIRECTORY_OBJECTS:
+	_model = models.object_type_to_model(_object_type)
+	event.listen(_model, 'after_insert', _record_change)
+	event.listen(_model, 'after_update', _record_change)
+	event.listen(_model, 'after_delete', _record_delete)
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+	changes = session.info.pop('directory_changes', None)
+	if not changes:
+		return
+	with _indexes_lock:
+		for (object_type, id), name in changes.items():
+			# Indexes that haven't been loaded yet will pick up the change
+			# when they are loaded
+			index = _indexes.get(object_type)
+			if index is None:
+				continue
+			_apply_change(index, id, name)
+			if object_type in _pending:
+				_pending[object_type].append((id, name))
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+	session.info.pop('directory_changes', None)
@@ -0,0 +1,281 @@
+# coding: utf-8
+"""
+Contains the job queue, which runs work that doesn't have to happen while
+handling a request, like removing deleted conferences.
+
+Jobs are stored in the jobs table, so they survive restarts. Every job runs
+a task, registered with the task decorator, with a JSON payload:
+
+    @jobs.task('purge_deleted', queue='deletion')
+    def purge_deleted(payload):
+        ...
+
+    jobs.enqueue('purge_deleted', {"id": object_id, "object_type": "channel"})
+
+Jobs are run by job runners, started with the run-jobs command. Any amount
+of runners can be started, on any machine that can reach the database;
+runners are woken up with NOTIFY when jobs are added, and poll every
+job_poll_interval seconds for jobs that were delayed or are due for a retry.
+
+Runners claim jobs in batches of up to the queue's batch_size with
+SELECT ... FOR UPDATE SKIP LOCKED, so they never wait for each other. A
+claimed job isn't handed out again for job_lease_time seconds; if its
+runner stops before finishing it, another runner picks it up afterwards.
+Tasks have to be safe to run more than once.
+
+Within a queue, jobs with a lower priority run first. Failed jobs are
+retried after a delay that doubles with every attempt, up to the task's
+max_attempts; jobs that fail on their last attempt stay in the table, with
+failed and last_error set.
+
+The amount of jobs from a queue that run at the same time, over all
+runners, is limited by the queue's concurrency: runners have to hold one
+of the queue's advisory locks (one per unit of concurrency) to claim jobs.
+
+Settings (in config.json):
+  - job_queues - dict with queue names as keys and dicts with the following
+                 keys as values:
+                   - concurrency - maximum amount of jobs from the queue
+                                   running at the same time. Defaults to 1.
+                   - batch_size - maximum amount of jobs claimed at once.
+                                  Defaults to 10.
+  - job_lease_time - seconds a claimed job has to finish in before it's
+                     handed out again. Defaults to 600.
+  - job_poll_interval - seconds between checks for delayed jobs. Defaults
+                        to 5.
+"""
+from drywall import config
+from drywall import db
+from drywall import metrics
+
+from sqlalchemy import text
+import contextlib
+import logging
+import random
+import select
+import threading
+import time
+import traceback
+import zlib
+
+# Queue used by tasks that don't name one.
+DEFAULT_QUEUE = "default"
+# Default for the max_attempts argument of task.
+DEFAULT_MAX_ATTEMPTS = 5
+# Defaults for the settings of queues in the job_queues setting.
+DEFAULT_CONCURRENCY = 1
+DEFAULT_BATCH_SIZE = 10
+# Default for the job_lease_time setting.
+DEFAULT_LEASE_TIME = 600
+# Default for the job_poll_interval setting.
+DEFAULT_POLL_INTERVAL = 5
+# Delay before the first retry of a failed job, in seconds; doubles with
+# every attempt, up to RETRY_MAX_DELAY.
+RETRY_BASE_DELAY = 10
+RETRY_MAX_DELAY = 3600
+
+log = logging.getLogger("drywall.jobs")
+
+# Registered tasks; names as keys and (function, queue, max attempts)
+# tuples as values.
+_tasks = {}
+
+def task(name, queue=DEFAULT_QUEUE, max_attempts=DEFAULT_MAX_ATTEMPTS):
+	"""
+	Decorator that registers a function as the task with the given name.
+	The function is called with the payload of each job.
+	"""
+	def decorator(function):
+		_tasks[name] = (function, queue, max_attempts)
+		return function
+	return decorator
+
+def enqueue_many(task_name, payloads, priority=0, delay=0):
+	"""
+	Adds a job running the given task for each of the given payloads, all
+	in one query. Jobs become ready to run after delay seconds. Returns a
+	list with the IDs of the added jobs.
+	"""
+	if task_name not in _tasks:
+		raise ValueError("Unknown task: " + task_name)
+	if not payloads:
+		return []
+	function, queue, max_attempts = _tasks[task_name]
+	return db.add_jobs([{"queue": queue, "task": task_name, "payload": payload, "priority": priority,
+	                     "max_attempts": max_attempts, "delay": delay} for payload in payloads])
+
+def enqueue(task_name, payload=None, priority=0, delay=0):
+	"""
+	Adds a job running the given task with the given payload, which has to
+	be serializable to JSON. Returns the ID of the job.
+	"""
+	return enqueue_many(task_name, [payload], priority=priority, delay=delay)[0]
+
+def get_queues():
+	"""Returns the names of all queues that have tasks or settings."""
+	return sorted(set(queue for function, queue, max_attempts in _tasks.values()) |
+	              set(config.get('job_queues') or {}))
+
+def queue_settings(queue):
+	"""Returns a (concurrency, batch size) tuple for a queue."""
+	settings = (config.get('job_queues') or {}).get(queue) or {}
+	return (settings.get('concurrency') or DEFAULT_CONCURRENCY, settings.get('batch_size') or DEFAULT_BATCH_SIZE)
+
+def retry_delay(attempts):
+	"""Returns the delay before retrying a job that failed the given amount of times, with jitter."""
+	delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempts - 1))
+	return random.uniform(delay / 2, delay)
+
+def _lock_key(queue):
+	"""Returns the advisory lock key (a signed 32-bit integer) for a queue."""
+	key = zlib.crc32(queue.encode('utf-8'))
+	return key - 2 ** 32 if key >= 2 ** 31 else key
+
+@contextlib.contextmanager
+def queue_slot(queue, concurrency):
+	"""
+	Takes one of a queue's concurrency slots for the duration of the block,
+	using a connection of its own. Yields False if all of them are taken.
+	"""
+	key = _lock_key(queue)
+	with db.get_engine().connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+		for slot in range(concurrency):
+			if connection.execute(text("SELECT pg_try_advisory_lock(:key, :slot)"), {"key": key, "slot": slot}).scalar():
+				try:
+					yield True
+				finally:
+					connection.execute(text("SELECT pg_advisory_unlock(:key, :slot)"), {"key": key, "slot": slot})
+				return
+		yield False
+
+def _run_job(queue, job):
+	"""Runs a claimed job and records the outcome. Returns True if it's done."""
+	task_name = job['task']
+	metrics.job_latency.observe(max(0.0, float(job['latency'])), (queue,))
+	start = time.perf_counter()
+	try:
+		if task_name not in _tasks:
+			raise LookupError("Unknown task: " + task_name)
+		_tasks[task_name][0](job['payload'])
+	except Exception:
+		error = traceback.format_exc()
+		if job['attempts'] >= job['max_attempts']:
+			log.exception("Job %s (%s) failed %s times, giving up", job['id'], task_name, job['attempts'])
+			db.fail_job(job['id'], error)
+			status = "failed"
+		else:
+			log.warning("Job %s (%s) failed, retrying", job['id'], task_name, exc_info=True)
+			db.retry_job(job['id'], error, retry_delay(job['attempts']))
+			status = "retried"
+	else:
+		status = "done"
+	metrics.job_duration.observe(time.perf_counter() - start, (queue, task_name))
+	metrics.jobs_total.inc((queue, task_name, status))
+	return status == "done"
+
+class Runner:
+	"""
+	Runs jobs from the given queues (or from all queues). Use run_burst to
+	run jobs until there are none left, or start and stop to run them in
+	the background.
+	"""
+	def __init__(self, queues=None):
+		self.queues = list(queues or get_queues())
+		self._stop = threading.Event()
+		# Set when there may be new jobs in a queue
+		self._wakeups = {queue: threading.Event() for queue in self.queues}
+		self._threads = []
+
+	def run_queue(self, queue):
+		"""
+		Runs jobs from a queue until none are ready, unless all of the
+		queue's slots are taken. Returns the amount of jobs that were run.
+		"""
+		concurrency, batch_size = queue_settings(queue)
+		lease = config.get('job_lease_time') or DEFAULT_LEASE_TIME
+		ran = 0
+		with queue_slot(queue, concurrency) as slot:
+			while slot and not self._stop.is_set():
+				jobs = db.claim_jobs(queue, batch_size, lease)
+				if not jobs:
+					break
+				db.finish_jobs([job['id'] for job in jobs if _run_job(queue, job)])
+				ran += len(jobs)
+		return ran
+
+	def run_burst(self):
+		"""Runs jobs until none are ready in any queue. Returns the amount of jobs that were run."""
+		total = 0
+		while True:
+			ran = sum(self.run_queue(queue) for queue in self.queues)
+			if not ran:
+				return total
+			total += ran
+
+	def _work(self, queue):
+		poll_interval = config.get('job_poll_interval') or DEFAULT_POLL_INTERVAL
+		wakeup = self._wakeups[queue]
+		while not self._stop.is_set():
+			wakeup.clear()
+			try:
+				self.run_queue(queue)
+			except Exception:
+				log.exception("Running jobs from the %s queue failed", queue)
+			wakeup.wait(poll_interval)
+
+	def _listen(self):
+		poll_interval = config.get('job_poll_interval') or DEFAULT_POLL_INTERVAL
+		while not self._stop.is_set():
+			try:
+				connection = db.get_engine().raw_connection()
+				try:
+					driver_connection = connection.driver_connection
+					driver_connection.autocommit = True
+					driver_connection.cursor().execute("LISTEN " + db.JOB_CHANNEL)
+					while not self._stop.is_set():
+						if not select.select([driver_connection], [], [], 1)[0]:
+							continue
+						driver_connection.poll()
+						while driver_connection.notifies:
+							wakeup = self._wakeups.get(driver_connection.notifies.pop(0).payload)
+							if wakeup:
+								wakeup.set()
+				finally:
+					# Don't hand a listening connection back to the pool
+					connection.invalidate()
+			except Exception:
+				log.exception("Listening for new jobs failed")
+				self._stop.wait(poll_interval)
+
+	def start(self):
+		"""
+		Starts running jobs in background threads, one per unit of each
+		queue's concurrency, and a thread that listens for new jobs.
+		"""
+		self._stop.clear()
+		self._threads = [threading.Thread(target=self._listen, name="drywall-jobs-listener", daemon=True)]
+		for queue in self.queues:
+			for i in range(queue_settings(queue)[0]):
+				self._threads.append(threading.Thread(target=self._work, args=(queue,),
+					name="drywall-jobs-" + queue + "-" + str(i), daemon=True))
+		for thread in self._threads:
+			thread.start()
+
+	def stop(self):
+		"""Tells the background threads to stop once their current batch is done."""
+		self._stop.set()
+		for wakeup in self._wakeups.values():
+			wakeup.set()
+
+	def wait(self, timeout=None):
+		"""
+		Waits until stop is called and the background threads are done.
+		Returns False if they're still running after the timeout (in
+		seconds), True otherwise.
+		"""
+		deadline = None if timeout is None else time.monotonic() + timeout
+		if not self._stop.wait(timeout):
+			return False
+		for thread in self._threads:
+			thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+		return not any(thread.is_alive() for thread in self._threads)
@@ -0,0 +1,280 @@
+# coding: utf-8
+"""
+Contains per-request instrumentation and the /metrics endpoint, which exposes
+the collected metrics in the Prometheus text format.
+
+Metrics are kept in memory, per process; when running multiple workers,
+each worker reports its own metrics.
+"""
+from drywall import app
+from drywall import config
+from drywall import db
+
+from flask import Response, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import bisect
+import logging
+import threading
+import time
+from wsgiref import simple_server
+
+# Upper bounds of histogram buckets, in seconds.
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+JOB_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+# Default for the slow_query_threshold setting, in milliseconds.
+DEFAULT_SLOW_QUERY_THRESHOLD = 250
+
+slow_query_log = logging.getLogger("drywall.slow_query")
+
+def _escape(value):
+	"""Escapes a label value for the text format."""
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(label_names, label_values, extra=None):
+	"""Turns label names and values into a {name="value"} string."""
+	pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(label_names, label_values)]
+	if extra:
+		pairs.append(extra)
+	if not pairs:
+		return ""
+	return "{" + ",".join(pairs) + "}"
+
+class Counter:
+	"""A value that only goes up, optionally split by labels."""
+	type = "counter"
+
+	def __init__(self, name, description, labels=()):
+		self.name = name
+		self.description = description
+		self.labels = labels
+		self.values = {}
+		self.lock = threading.Lock()
+
+	def inc(self, labels=(), value=1):
+		"""Increments the value for the given label values."""
+		with self.lock:
+			self.values[labels] = self.values.get(labels, 0) + value
+
+	def dump(self):
+		"""Returns the lines representing this metric in the text format."""
+		with self.lock:
+			values = list(self.values.items())
+		return [self.name + _format_labels(self.labels, labels) + " " + repr(value)
+		        for labels, value in sorted(values)]
+
+class Gauge:
+	"""
+	A value that is read from a function whenever metrics are scraped. With
+	labels, the function returns a dict with label values as keys.
+	"""
+	type = "gauge"
+
+	def __init__(self, name, description, function, labels=()):
+		self.name = name
+		self.description = description
+		self.function = function
+		self.labels = labels
+
+	def dump(self):
+		"""Returns the lines representing this metric in the text format."""
+		value = self.function()
+		if value is None:
+			return []
+		if not self.labels:
+			return [self.name + " " + repr(value)]
+		return [self.name + _format_labels(self.labels, labels) + " " + repr(label_value)
+		        for labels, label_value in sorted(value.items())]
+
+class Histogram:
+	"""Counts observed values in buckets, optionally split by labels."""
+	type = "histogram"
+
+	def __init__(self, name, description, buckets, labels=()):
+		self.name = name
+		self.description = description
+		self.buckets = buckets
+		self.labels = labels
+		# label values: [count per bucket (last one is +Inf), sum]
+		self.values = {}
+		self.lock = threading.Lock()
+
+	def observe(self, value, labels=()):
+		"""Records a value for the given label values."""
+		index = bisect.bisect_left(self.buckets, value)
+		with self.lock:
+			entry = self.values.get(labels)
+			if entry is None:
+				entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0]
+			entry[0][index] += 1
+			entry[1] += value
+
+	def dump(self):
+		"""Returns the lines representing this metric in the text format."""
+		with self.lock:
+			values = [(labels, list(entry[0]), entry[1]) for labels, entry in self.values.items()]
+		lines = []
+		for labels, counts, total in sorted(values):
+			cumulative = 0
+			for bound, count in zip(self.buckets + ('+Inf',), counts):
+				cumulative += count
+				lines.append(self.name + "_bucket" + _format_labels(self.labels, labels, 'le="%s"' % bound) + " " + str(cumulative))
+			lines.append(self.name + "_sum" + _format_labels(self.labels, labels) + " " + repr(total))
+			lines.append(self.name + "_count" + _format_labels(self.labels, labels) + " " + str(cumulative))
+		return lines
+
+def _pool_stat(stat):
+	"""Returns a function that reads a statistic from the connection pool."""
+	def _read():
+		pool = db.get_engine().pool
+		if not hasattr(pool, stat):
+			return None
+		return getattr(pool, stat)()
+	return _read
+
+def _job_queue_stat(index):
+	"""
+	Returns a function that reads a statistic about job queues from the
+	database; see db.get_job_queue_stats.
+	"""
+	def _read():
+		return {(queue,): float(stats[index]) for queue, stats in db.get_job_queue_stats().items()}
+	return _read
+
+##
+# Metrics
+##
+
+requests_total = Counter("drywall_http_requests_total",
+	"Amount of handled HTTP requests.", ("method", "route", "status"))
+request_duration = Histogram("drywall_http_request_duration_seconds",
+	"Time spent handling HTTP requests.", REQUEST_BUCKETS, ("method", "route"))
+request_queries = Counter("drywall_http_request_db_queries_total",
+	"Amount of database queries made while handling HTTP requests.", ("method", "route"))
+request_query_time = Counter("drywall_http_request_db_seconds_total",
+	"Time spent on database queries while handling HTTP requests.", ("method", "route"))
+query_duration = Histogram("drywall_db_query_duration_seconds",
+	"Time spent on database queries.", QUERY_BUCKETS)
+slow_queries = Counter("drywall_db_slow_queries_total",
+	"Amount of database queries that exceeded the slow query threshold.")
+errors = Counter("drywall_errors_total",
+	"Amount of error pings returned, by error code.", ("code",))
+pool_size = Gauge("drywall_db_pool_size",
+	"Size of the database connection pool.", _pool_stat("size"))
+pool_checked_out = Gauge("drywall_db_pool_checked_out",
+	"Amount of database connections currently in use.", _pool_stat("checkedout"))
+pool_overflow = Gauge("drywall_db_pool_overflow",
+	"Amount of database connections opened over the pool size.", _pool_stat("overflow"))
+# Recorded by job runners (see jobs.py), in the process running them.
+job_latency = Histogram("drywall_job_latency_seconds",
+	"Time between jobs becoming ready to run and being picked up.", JOB_BUCKETS, ("queue",))
+job_duration = Histogram("drywall_job_duration_seconds",
+	"Time spent running jobs.", JOB_BUCKETS, ("queue", "task"))
+jobs_total = Counter("drywall_jobs_total",
+	"Amount of attempts at running jobs, by outcome (done, retried or failed).", ("queue", "task", "status"))
+# Read from the database, so every process reports the same values.
+jobs_ready = Gauge("drywall_jobs_ready",
+	"Amount of jobs waiting to be picked up.", _job_queue_stat(0), ("queue",))
+jobs_oldest_ready = Gauge("drywall_jobs_oldest_ready_seconds",
+	"Time since the oldest job waiting to be picked up became ready to run.", _job_queue_stat(1), ("queue",))
+
+registry = [requests_total, request_duration, request_queries, request_query_time,
+            query_duration, slow_queries, errors, pool_size, pool_checked_out,
+            pool_overflow, job_latency, job_duration, jobs_total, jobs_ready,
+            jobs_oldest_ready]
+
+def dump_metrics():
+	"""Returns all metrics in the Prometheus text format."""
+	lines = []
+	for metric in registry:
+		lines.append("# HELP " + metric.name + " " + metric.description)
+		lines.append("# TYPE " + metric.name + " " + metric.type)
+		lines += metric.dump()
+	return "\n".join(lines) + "\n"
+
+def serve(host, port):
+	"""
+	Serves the metrics on the given address from a background thread, for
+	processes that don't handle requests, like job runners. Returns the
+	server.
+	"""
+	def _application(environ, start_response):
+		start_response("200 OK", [("Content-Type", "text/plain; version=0.0.4; charset=utf-8")])
+		return [dump_metrics().encode('utf-8')]
+
+	class _QuietHandler(simple_server.WSGIRequestHandler):
+		def log_message(self, *args):
+			pass
+
+	server = simple_server.make_server(host, port, _application, handler_class=_QuietHandler)
+	threading.Thread(target=server.serve_forever, name="drywall-metrics", daemon=True).start()
+	return server
+
+##
+# Instrumentation
+##
+
+# Per-thread statistics for the request currently being handled.
+_local = threading.local()
+
+# Listeners are attached to the Engine class rather than to db.engine, so
+# that importing this module doesn't create the engine. The start time is
+# kept on the statement's execution context, which is dropped along with
+# it, so failed statements don't leave anything behind on the connection.
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+	context.drywall_query_start = time.perf_counter()
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+	_record_query(context, statement)
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(exception_context):
+	# Failed statements take time too
+	context = exception_context.execution_context
+	if getattr(context, 'drywall_query_start', None) is not None:
+		_record_query(context, exception_context.statement)
+
+def _record_query(context, statement):
+	"""Records the duration of a statement that was just executed."""
+	elapsed = time.perf_counter() - context.drywall_query_start
+	# Errors raised after the statement was executed are not counted again
+	context.drywall_query_start = None
+	query_duration.observe(elapsed)
+	_local.queries = getattr(_local, 'queries', 0) + 1
+	_local.query_time = getattr(_local, 'query_time', 0) + elapsed
+
+	threshold = config.get('slow_query_threshold')
+	if threshold is None:
+		threshold = DEFAULT_SLOW_QUERY_THRESHOLD
+	if threshold and elapsed * 1000 >= threshold:
+		slow_queries.inc()
+		slow_query_log.warning("Slow query (%.1f ms): %s", elapsed * 1000, statement)
+
+@app.before_request
+def _start_request():
+	_local.start = time.perf_counter()
+	_local.queries = 0
+	_local.query_time = 0
+
+@app.after_request
+def _finish_request(response):
+	elapsed = time.perf_counter() - getattr(_local, 'start', time.perf_counter())
+	if request.url_rule:
+		route = request.url_rule.rule
+	else:
+		route = "<unmatched>"
+	labels = (request.method, route)
+	requests_total.inc(labels + (str(response.status_code),))
+	request_duration.observe(elapsed, labels)
+	request_queries.inc(labels, getattr(_local, 'queries', 0))
+	request_query_time.inc(labels, getattr(_local, 'query_time', 0))
+	return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+	"""Returns the collected metrics in the Prometheus text format."""
+	return Response(dump_metrics(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,179 @@
+-- Generated by utils/alchemify.py on 2026-10-19
+
+CREATE TABLE IF NOT EXISTS account (
+	id VARCHAR(255) NOT NULL,
+	username TEXT NOT NULL,
+	short_status INTEGER NOT NULL,
+	status TEXT,
+	bio TEXT,
+	index_user BOOLEAN,
+	email TEXT,
+	bot BOOLEAN,
+	friends VARCHAR(255)[],
+	blocklist VARCHAR(255)[],
+	PRIMARY KEY (id),
+	UNIQUE (username)
+);
+
+CREATE TABLE IF NOT EXISTS instance (
+	id VARCHAR(255) NOT NULL,
+	address TEXT NOT NULL,
+	server_software TEXT NOT NULL,
+	name TEXT NOT NULL,
+	description TEXT,
+	PRIMARY KEY (id)
+);
+
+CREATE TABLE IF NOT EXISTS objects (
+	id VARCHAR(255) NOT NULL,
+	object_type VARCHAR(255) NOT NULL,
+	PRIMARY KEY (id)
+);
+
+CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+	key VARCHAR(255) NOT NULL,
+	tokens FLOAT NOT NULL,
+	rate FLOAT NOT NULL,
+	burst FLOAT NOT NULL,
+	allowed BOOLEAN NOT NULL,
+	updated TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+	PRIMARY KEY (key)
+);
+
+CREATE TABLE IF NOT EXISTS revoked_tokens (
+	jti VARCHAR(255) NOT NULL,
+	expires TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+	PRIMARY KEY (jti)
+);
+
+CREATE INDEX IF NOT EXISTS ix_revoked_tokens_expires ON revoked_tokens (expires);
+
+CREATE TABLE IF NOT EXISTS schema_migrations (
+	version VARCHAR(255) NOT NULL,
+	applied TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+	PRIMARY KEY (version)
+);
+
+CREATE TABLE IF NOT EXISTS users (
+	account_id VARCHAR(255) NOT NULL,
+	email VARCHAR(255) NOT NULL,
+	username VARCHAR(255) NOT NULL,
+	password TEXT NOT NULL,
+	PRIMARY KEY (email),
+	UNIQUE (account_id),
+	UNIQUE (username)
+);
+
+CREATE TABLE IF NOT EXISTS clients (
+	client_id VARCHAR(255) NOT NULL,
+	client_secret VARCHAR(255) NOT NULL,
+	name TEXT NOT NULL,
+	description TEXT,
+	scopes VARCHAR(255)[],
+	owner VARCHAR(255) NOT NULL,
+	type VARCHAR(255) NOT NULL,
+	account_id VARCHAR(255),
+	PRIMARY KEY (client_id),
+	FOREIGN KEY(owner) REFERENCES account (id),
+	FOREIGN KEY(account_id) REFERENCES account (id)
+);
+
+CREATE INDEX IF NOT EXISTS ix_clients_owner ON clients (owner);
+
+CREATE TABLE IF NOT EXISTS conference (
+	id VARCHAR(255) NOT NULL,
+	name TEXT NOT NULL,
+	description TEXT,
+	icon TEXT NOT NULL,
+	owner VARCHAR(255) NOT NULL,
+	index_conference BOOLEAN,
+	permissions SMALLINT NOT NULL,
+	creation_date TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+	channels VARCHAR(255)[],
+	users VARCHAR(255)[],
+	roles VARCHAR(255)[],
+	PRIMARY KEY (id),
+	FOREIGN KEY(owner) REFERENCES account (id)
+);
+
+CREATE TABLE IF NOT EXISTS report (
+	id VARCHAR(255) NOT NULL,
+	target VARCHAR(255) NOT NULL,
+	note TEXT,
+	submission_date TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+	PRIMARY KEY (id),
+	FOREIGN KEY(target) REFERENCES objects (id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS channel (
+	id VARCHAR(255) NOT NULL,
+	name TEXT NOT NULL,
+	permissions SMALLINT NOT NULL,
+	channel_type TEXT NOT NULL,
+	parent_conference VARCHAR(255),
+	members VARCHAR(255)[],
+	icon TEXT,
+	description TEXT,
+	PRIMARY KEY (id),
+	FOREIGN KEY(parent_conference) REFERENCES conference (id)
+);
+
+CREATE TABLE IF NOT EXISTS conference_member (
+	id VARCHAR(255) NOT NULL,
+	user_id VARCHAR(255) NOT NULL,
+	nickname TEXT,
+	parent_conference VARCHAR(255) NOT NULL,
+	roles VARCHAR(255)[],
+	permissions SMALLINT NOT NULL,
+	banned BOOLEAN,
+	PRIMARY KEY (id),
+	FOREIGN KEY(user_id) REFERENCES account (id),
+	FOREIGN KEY(parent_conference) REFERENCES conference (id)
+);
+
+CREATE TABLE IF NOT EXISTS invite (
+	id VARCHAR(255) NOT NULL,
+	code TEXT NOT NULL,
+	conference_id VARCHAR(255) NOT NULL,
+	creator VARCHAR(255) NOT NULL,
+	PRIMARY KEY (id),
+	UNIQUE (code),
+	FOREIGN KEY(conference_id) REFERENCES conference (id),
+	FOREIGN KEY(creator) REFERENCES account (id)
+);
+
+CREATE TABLE IF NOT EXISTS role (
+	id VARCHAR(255) NOT NULL,
+	name TEXT NOT NULL,
+	permissions SMALLINT NOT NULL,
+	color TEXT NOT NULL,
+	description TEXT,
+	parent_conference VARCHAR(255) NOT NULL,
+	PRIMARY KEY (id),
+	FOREIGN KEY(parent_conference) REFERENCES conference (id)
+);
+
+CREATE TABLE IF NOT EXISTS message (
+	id VARCHAR(255) NOT NULL,
+	content TEXT NOT NULL,
+	parent_channel VARCHAR(255) NOT NULL,
+	author VARCHAR(255) NOT NULL,
+	post_date TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+	edit_date TIMESTAMP WITHOUT TIME ZONE,
+	edited BOOLEAN NOT NULL,
+	attached_files VARCHAR(255)[],
+	reactions VARCHAR(255)[],
+	reply_to VARCHAR(255),
+	replies VARCHAR(255)[],
+	search_vector TSVECTOR GENERATED ALWAYS AS (to_tsvector('simple', coalesce(content, ''))) STORED,
+	PRIMARY KEY (id),
+	FOREIGN KEY(parent_channel) REFERENCES channel (id),
+	FOREIGN KEY(author) REFERENCES account (id),
+	FOREIGN KEY(reply_to) REFERENCES message (id)
+);
+
+-- Databases created before full-text search was added don't have this
+-- column yet
+ALTER TABLE "message" ADD COLUMN IF NOT EXISTS search_vector TSVECTOR GENERATED ALWAYS AS (to_tsvector('simple', coalesce(content, ''))) STORED;
+
+CREATE INDEX IF NOT EXISTS ix_message_search_vector ON message USING gin (search_vector);
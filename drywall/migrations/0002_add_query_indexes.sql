@@ -0,0 +1,23 @@
+-- Generated by utils/alchemify.py on 2026-10-19
+
+CREATE INDEX IF NOT EXISTS ix_conference_owner ON conference (owner);
+
+CREATE INDEX IF NOT EXISTS ix_report_target ON report (target);
+
+CREATE INDEX IF NOT EXISTS ix_channel_parent_conference ON channel (parent_conference);
+
+CREATE INDEX IF NOT EXISTS ix_conference_member_parent_conference_user_id ON conference_member (parent_conference, user_id);
+
+CREATE INDEX IF NOT EXISTS ix_conference_member_user_id ON conference_member (user_id);
+
+CREATE INDEX IF NOT EXISTS ix_invite_conference_id ON invite (conference_id);
+
+CREATE INDEX IF NOT EXISTS ix_invite_creator ON invite (creator);
+
+CREATE INDEX IF NOT EXISTS ix_role_parent_conference ON role (parent_conference);
+
+CREATE INDEX IF NOT EXISTS ix_message_author ON message (author);
+
+CREATE INDEX IF NOT EXISTS ix_message_parent_channel_post_date ON message (parent_channel, post_date);
+
+CREATE INDEX IF NOT EXISTS ix_message_reply_to ON message (reply_to);
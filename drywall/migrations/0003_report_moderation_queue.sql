@@ -0,0 +1,30 @@
+-- Generated by utils/alchemify.py on 2026-10-19
+
+ALTER TABLE "report" ADD COLUMN IF NOT EXISTS target_type TEXT;
+
+ALTER TABLE "report" ADD COLUMN IF NOT EXISTS target_conference VARCHAR(255) REFERENCES conference (id) ON DELETE CASCADE;
+
+-- Fill in the new columns for existing reports
+UPDATE "report" SET target_type = objects.object_type FROM objects
+	WHERE objects.id = report.target AND report.target_type IS NULL;
+
+UPDATE "report" SET target_conference = CASE report.target_type
+		WHEN 'conference' THEN report.target
+		WHEN 'channel' THEN (SELECT parent_conference FROM channel WHERE channel.id = report.target)
+		WHEN 'role' THEN (SELECT parent_conference FROM role WHERE role.id = report.target)
+		WHEN 'conference_member' THEN (SELECT parent_conference FROM conference_member WHERE conference_member.id = report.target)
+		WHEN 'invite' THEN (SELECT conference_id FROM invite WHERE invite.id = report.target)
+		WHEN 'message' THEN (SELECT channel.parent_conference FROM message JOIN channel ON channel.id = message.parent_channel
+		                     WHERE message.id = report.target)
+	END
+	WHERE report.target_conference IS NULL;
+
+DROP INDEX IF EXISTS "ix_report_target";
+
+CREATE INDEX IF NOT EXISTS ix_report_submission_date_id ON report (submission_date, id);
+
+CREATE INDEX IF NOT EXISTS ix_report_target_conference_submission_date_id ON report (target_conference, submission_date, id);
+
+CREATE INDEX IF NOT EXISTS ix_report_target_submission_date_id ON report (target, submission_date, id);
+
+CREATE INDEX IF NOT EXISTS ix_report_target_type_submission_date_id ON report (target_type, submission_date, id);
@@ -0,0 +1,5 @@
+-- Generated by utils/alchemify.py on 2026-10-19
+
+ALTER TABLE "objects" ADD COLUMN IF NOT EXISTS deleted TIMESTAMP WITHOUT TIME ZONE;
+
+CREATE INDEX IF NOT EXISTS ix_objects_deleted ON objects (deleted) WHERE deleted IS NOT NULL;
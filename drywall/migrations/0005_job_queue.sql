@@ -0,0 +1,18 @@
+-- Generated by utils/alchemify.py on 2026-10-19
+
+CREATE TABLE IF NOT EXISTS jobs (
+	id BIGSERIAL NOT NULL,
+	queue VARCHAR(255) NOT NULL,
+	task VARCHAR(255) NOT NULL,
+	payload JSONB NOT NULL,
+	priority SMALLINT NOT NULL,
+	attempts INTEGER NOT NULL,
+	max_attempts INTEGER NOT NULL,
+	run_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+	created TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+	last_error TEXT,
+	failed TIMESTAMP WITHOUT TIME ZONE,
+	PRIMARY KEY (id)
+);
+
+CREATE INDEX IF NOT EXISTS ix_jobs_queue_priority_run_at_id ON jobs (queue, priority, run_at, id) WHERE failed IS NULL;
@@ -0,0 +1,27 @@
+-- Generated by utils/alchemify.py on 2026-10-19
+
+-- Counters start at zero, so messages posted before this migration count
+-- as read.
+CREATE TABLE IF NOT EXISTS channel_state (
+	channel_id VARCHAR(255) NOT NULL,
+	message_count BIGINT NOT NULL,
+	last_message VARCHAR(255),
+	last_message_date TIMESTAMP WITHOUT TIME ZONE,
+	PRIMARY KEY (channel_id),
+	FOREIGN KEY(channel_id) REFERENCES channel (id) ON DELETE CASCADE
+);
+
+ALTER TABLE "message" ADD COLUMN IF NOT EXISTS mentions VARCHAR(255)[];
+
+CREATE TABLE IF NOT EXISTS read_state (
+	account_id VARCHAR(255) NOT NULL,
+	channel_id VARCHAR(255) NOT NULL,
+	last_read_message VARCHAR(255),
+	read_count BIGINT NOT NULL,
+	mention_count INTEGER NOT NULL,
+	PRIMARY KEY (account_id, channel_id),
+	FOREIGN KEY(account_id) REFERENCES account (id) ON DELETE CASCADE,
+	FOREIGN KEY(channel_id) REFERENCES channel (id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS ix_read_state_channel_id ON read_state (channel_id);
@@ -0,0 +1,20 @@
+-- Generated by utils/alchemify.py on 2026-10-19
+
+-- Remove duplicate memberships before making the index unique. Banned
+-- members are kept over others, so that bans aren't lost, then the member
+-- with the lowest ID.
+CREATE TEMPORARY TABLE duplicate_members ON COMMIT DROP AS
+SELECT id FROM (
+	SELECT id, row_number() OVER (PARTITION BY parent_conference, user_id ORDER BY banned IS TRUE DESC, id) AS position
+	FROM conference_member
+) members WHERE position > 1;
+
+DELETE FROM objects WHERE id IN (SELECT id FROM report WHERE target IN (SELECT id FROM duplicate_members));
+
+DELETE FROM conference_member WHERE id IN (SELECT id FROM duplicate_members);
+
+DELETE FROM objects WHERE id IN (SELECT id FROM duplicate_members);
+
+DROP INDEX IF EXISTS "ix_conference_member_parent_conference_user_id";
+
+CREATE UNIQUE INDEX IF NOT EXISTS ix_conference_member_parent_conference_user_id ON conference_member (parent_conference, user_id);
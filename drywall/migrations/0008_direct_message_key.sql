@@ -0,0 +1,27 @@
+-- Generated by utils/alchemify.py on 2026-10-19
+
+ALTER TABLE "channel" ADD COLUMN IF NOT EXISTS dm_key TEXT UNIQUE;
+
+-- Direct message members used to be conference member IDs; replace them
+-- with the IDs of their accounts, without duplicates.
+UPDATE channel SET members = ARRAY(
+	SELECT DISTINCT coalesce(conference_member.user_id, member)
+	FROM unnest(channel.members) AS member
+	LEFT JOIN conference_member ON conference_member.id = member
+)
+WHERE channel_type = 'direct_message' AND members IS NOT NULL;
+
+-- Fill in the keys, as computed by objects.direct_message_key. If several
+-- channels have the same members, only the one with the lowest ID gets the key.
+UPDATE channel SET dm_key = keys.dm_key
+FROM (
+	SELECT id, dm_key, row_number() OVER (PARTITION BY dm_key ORDER BY id) AS position
+	FROM (
+		SELECT id, encode(sha256(convert_to(coalesce(
+			(SELECT string_agg(member, ',' ORDER BY member COLLATE "C") FROM unnest(channel.members) AS member),
+			''), 'UTF8')), 'hex') AS dm_key
+		FROM channel
+		WHERE channel_type = 'direct_message'
+	) channels
+) keys
+WHERE channel.id = keys.id AND keys.position = 1;
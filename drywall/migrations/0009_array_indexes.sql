@@ -0,0 +1,23 @@
+-- Generated by utils/alchemify.py on 2026-10-19
+
+CREATE INDEX IF NOT EXISTS ix_account_blocklist ON account USING gin (blocklist);
+
+CREATE INDEX IF NOT EXISTS ix_account_friends ON account USING gin (friends);
+
+CREATE INDEX IF NOT EXISTS ix_conference_channels ON conference USING gin (channels);
+
+CREATE INDEX IF NOT EXISTS ix_conference_roles ON conference USING gin (roles);
+
+CREATE INDEX IF NOT EXISTS ix_conference_users ON conference USING gin (users);
+
+CREATE INDEX IF NOT EXISTS ix_channel_members ON channel USING gin (members);
+
+CREATE INDEX IF NOT EXISTS ix_conference_member_roles ON conference_member USING gin (roles);
+
+CREATE INDEX IF NOT EXISTS ix_message_attached_files ON message USING gin (attached_files);
+
+CREATE INDEX IF NOT EXISTS ix_message_mentions ON message USING gin (mentions);
+
+CREATE INDEX IF NOT EXISTS ix_message_reactions ON message USING gin (reactions);
+
+CREATE INDEX IF NOT EXISTS ix_message_replies ON message USING gin (replies);
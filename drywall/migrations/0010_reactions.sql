@@ -0,0 +1,33 @@
+-- Generated by utils/alchemify.py on 2026-10-19
+
+CREATE TABLE IF NOT EXISTS reaction_counts (
+	message_id VARCHAR(255) NOT NULL,
+	emoji VARCHAR(255) NOT NULL,
+	count INTEGER NOT NULL,
+	PRIMARY KEY (message_id, emoji),
+	FOREIGN KEY(message_id) REFERENCES message (id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS reactions (
+	message_id VARCHAR(255) NOT NULL,
+	emoji VARCHAR(255) NOT NULL,
+	account_id VARCHAR(255) NOT NULL,
+	created TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+	PRIMARY KEY (message_id, emoji, account_id),
+	FOREIGN KEY(message_id) REFERENCES message (id) ON DELETE CASCADE,
+	FOREIGN KEY(account_id) REFERENCES account (id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS ix_reactions_account_id ON reactions (account_id);
+
+-- The old reactions lists don't say who reacted, so they're only kept as
+-- counts; reactions added from now on are counted on top of them.
+INSERT INTO reaction_counts (message_id, emoji, count)
+SELECT message.id, reaction, count(*)
+FROM message, unnest(message.reactions) AS reaction
+GROUP BY message.id, reaction
+ON CONFLICT DO NOTHING;
+
+DROP INDEX IF EXISTS "ix_message_reactions";
+
+ALTER TABLE "message" DROP COLUMN IF EXISTS "reactions";
@@ -0,0 +1,11 @@
+-- Generated by utils/alchemify.py on 2026-10-19
+
+-- Replies are found through reply_to now; the lists kept on the messages
+-- they reply to are dropped.
+ALTER TABLE "message" DROP COLUMN IF EXISTS "replies";
+
+DROP INDEX IF EXISTS "ix_message_replies";
+
+CREATE INDEX IF NOT EXISTS ix_message_reply_to_post_date ON message (reply_to, post_date);
+
+DROP INDEX IF EXISTS "ix_message_reply_to";
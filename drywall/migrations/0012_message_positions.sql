@@ -0,0 +1,18 @@
+-- Generated by utils/alchemify.py on 2026-10-19
+
+CREATE TABLE IF NOT EXISTS message_position (
+	message_id VARCHAR(255) NOT NULL,
+	position BIGINT NOT NULL,
+	PRIMARY KEY (message_id),
+	FOREIGN KEY(message_id) REFERENCES message (id) ON DELETE CASCADE
+);
+
+-- Only the latest message_count messages of each channel were counted, so
+-- only those get a position; older messages count as position 0.
+INSERT INTO message_position (message_id, position)
+SELECT id, message_count - position + 1 FROM (
+	SELECT message.id, channel_state.message_count,
+		row_number() OVER (PARTITION BY message.parent_channel ORDER BY message.post_date DESC, message.id DESC) AS position
+	FROM message JOIN channel_state ON channel_state.channel_id = message.parent_channel
+) messages WHERE position <= message_count
+ON CONFLICT DO NOTHING;
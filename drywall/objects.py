@@ -8,6 +8,7 @@ from drywall import db
 from drywall import utils
 
 import datetime
+import hashlib
 import uuid    # for assign_id function
 
 # Common functions
@@ -28,6 +29,14 @@ def assign_id():
 	id = uuid.uuid4()
 	return str(id)
 
+def direct_message_key(members):
+	"""
+	Returns the key identifying the direct message channel between the
+	given accounts: a hash of their sorted, deduplicated IDs. The order of
+	the members does not matter.
+	"""
+	return hashlib.sha256(",".join(sorted(set(members))).encode('utf-8')).hexdigest()
+
 def __validate_id_key(self, key, value):
 	"""Shorthand function to validate ID keys."""
 	test_object = db.get_object_as_dict_by_id(value)
@@ -36,6 +45,18 @@ def __validate_id_key(self, key, value):
 	elif self.id_key_types[key] != "any" and not test_object['object_type'] == self.id_key_types[key]:
 		raise TypeError("The object given in the key '" + key + "' does not have the correct object type. (is " + test_object['object_type'] + ", should be " + self.id_key_types[key] + ")")
 
+def __validate_id_list_key(self, key, values):
+	"""
+	Shorthand function to validate ID list keys. The object types of all IDs
+	are looked up at once.
+	"""
+	object_types = db.get_object_types(values)
+	for value in values:
+		if value not in object_types:
+			raise TypeError("No object with the ID given in the key '" + key + "' was found. (" + value + ")")
+		elif self.id_key_types[key] != "any" and not object_types[value] == self.id_key_types[key]:
+			raise TypeError("The object given in the key '" + key + "' does not have the correct object type. (is " + object_types[value] + ", should be " + self.id_key_types[key] + ")")
+
 def __strip_invalid_keys(self, object_dict):
 	"""
 	Takes an object dict, removes all invalid values and performs a few
@@ -54,8 +75,7 @@ def __strip_invalid_keys(self, object_dict):
 			if self.key_types[key] == 'id':
 				__validate_id_key(self, key, value)
 			elif self.key_types[key] == 'id_list':
-				for id_value in value:
-					__validate_id_key(self, key, id_value)
+				__validate_id_list_key(self, key, value)
 
 			# Validate unique keys
 			if self.unique_keys:
@@ -82,6 +102,8 @@ def init_object(self, object_dict, force_id=False, patch_dict=False, federated=F
 	- TypeError - "No object with the ID given in the key <key> was found."
 	- TypeError - "The object given in the key <key> does not have the
 	               correct type."
+	- TypeError - "The combination of values in the keys <keys> is already
+	               taken."
 	- ValueError - attempted to rewrite a non-rewritable key
 	- KeyError - missing key
 	"""
@@ -134,6 +156,15 @@ def init_object(self, object_dict, force_id=False, patch_dict=False, federated=F
 	if patch_dict:
 		final_dict.update(final_patch_dict)
 
+	# Check unique key combinations
+	for keys in self.unique_index_keys:
+		if patch_dict and not any(key in patch_dict for key in keys):
+			continue
+		if all(key in final_dict for key in keys):
+			taken = db.get_object_ids_by_keys(self.object_type, {key: final_dict[key] for key in keys})
+			if [taken_id for taken_id in taken if taken_id != final_dict['id']]:
+				raise TypeError("The combination of values in the keys '" + "', '".join(keys) + "' is already taken.")
+
 	return final_dict
 
 def get_object_class_by_type(object_type):
@@ -275,6 +306,11 @@ class Object:
 	default_keys = []
 	nonrewritable_keys = []
 	unique_keys = []
+	search_keys = [] # string keys that are indexed for full-text search
+	index_keys = [] # lists of keys that are queried together; each list gets an index
+	unique_index_keys = [] # lists of keys whose values can only appear together once; each list gets a unique index
+	directory_key = None # string key used to find the object in directory search
+	directory_flag = None # boolean key that has to be set for the object to show up in directory search
 
 	def __init__(self, object_dict, force_id=False, patch_dict=False, federated=False):
 		"""
@@ -317,6 +353,8 @@ class Account(Object):
 	id_key_types = {"friends": "account", "blocklist": "account"}
 	nonrewritable_keys = ["username"]
 	unique_keys = ["username"]
+	directory_key = "username"
+	directory_flag = "index_user"
 
 class Channel(Object):
 	"""
@@ -324,15 +362,23 @@ class Channel(Object):
 	"""
 	type = 'object'
 	object_type = 'channel'
-	valid_keys = ["name", "permissions", "channel_type", "parent_conference", "members", "icon", "description"]
+	valid_keys = ["name", "permissions", "channel_type", "parent_conference", "members", "icon", "description", "dm_key"]
 	required_keys = ["name", "permissions", "channel_type"] # the rest is handled during init
 	default_keys = {"permissions": "21101"}
-	key_types = {"name": "string", "permissions": "permission_map", "channel_type": "string", "parent_conference": "id", "members": "id_list", "icon": "string", "description": "string"}
-	id_key_types = {"parent_conference": "conference", "members": "conference_member"}
+	key_types = {"name": "string", "permissions": "permission_map", "channel_type": "string", "parent_conference": "id", "members": "id_list", "icon": "string", "description": "string", "dm_key": "string"}
+	id_key_types = {"parent_conference": "conference", "members": "account"}
 	nonrewritable_keys = ["channel_type", "parent_conference"]
+	# Set for direct messages only; see direct_message_key
+	unique_keys = ["dm_key"]
 
 	def __init__(self, object_dict, force_id=False, patch_dict=False, federated=False):
 		__doc__ = Object.__doc__ # noqa: F841
+		# The key is derived from the members, so never take it from the dicts.
+		# On PATCH, object_dict is the stored object, so its key can be trusted.
+		stored_dm_key = object_dict.get('dm_key') if patch_dict else None
+		object_dict = {key: value for key, value in object_dict.items() if key != 'dm_key'}
+		if patch_dict:
+			patch_dict = {key: value for key, value in patch_dict.items() if key != 'dm_key'}
 		super().__init__(object_dict, force_id=force_id, patch_dict=patch_dict, federated=federated)
 		__channel_type = self.__dict__['channel_type']
 		if __channel_type == 'text' or __channel_type == 'media':
@@ -343,6 +389,11 @@ class Channel(Object):
 				raise KeyError('members')
 			if 'icon' not in self.__dict__:
 				raise KeyError('icon')
+			dm_key = direct_message_key(self.__dict__['members'])
+			if dm_key != stored_dm_key:
+				if [id for id in db.get_object_ids_by_keys('channel', {'dm_key': dm_key}) if id != self.id]:
+					raise TypeError("A direct message channel with the same members already exists.")
+			self.__dict__['dm_key'] = dm_key
 		else:
 			raise KeyError('invalid channel type ' + __channel_type)
 
@@ -352,12 +403,15 @@ class Message(Object):
 	"""
 	type = 'object'
 	object_type = 'message'
-	valid_keys = ["content", "parent_channel", "author", "post_date", "edit_date", "edited", "attached_files", "reactions", "reply_to", "replies"]
+	valid_keys = ["content", "parent_channel", "author", "post_date", "edit_date", "edited", "attached_files", "reply_to", "mentions"]
 	required_keys = ["content", "parent_channel", "author", "post_date", "edited"]
-	key_types = {"content": "string", "parent_channel": "id", "author": "id", "post_date": "datetime", "edited": "boolean", "edit_date": "datetime", "attached_files": "list", "reactions": "list", "reply_to": "id", "replies": "id_list"}
+	key_types = {"content": "string", "parent_channel": "id", "author": "id", "post_date": "datetime", "edited": "boolean", "edit_date": "datetime", "attached_files": "list", "reply_to": "id", "mentions": "id_list"}
 	default_keys = {"edited": False}
-	id_key_types = {"parent_channel": "channel", "author": "account", "reply_to": "message", "replies": "message"}
-	nonrewritable_keys = ["parent_channel", "author", "post_date", "edit_date", "edited"]
+	id_key_types = {"parent_channel": "channel", "author": "account", "reply_to": "message", "mentions": "account"}
+	nonrewritable_keys = ["parent_channel", "author", "post_date", "edit_date", "edited", "mentions"]
+	search_keys = ["content"]
+	# Replies are listed from the reply_to index; see db.get_replies
+	index_keys = [["parent_channel", "post_date"], ["reply_to", "post_date"]]
 
 	def __init__(self, object_dict, force_id=False, patch_dict=False, federated=False):
 		__doc__ = Object.__doc__ # noqa: F841
@@ -382,6 +436,8 @@ class Conference(Object):
 	key_types = {"name": "string", "description": "string", "icon": "string", "owner": "id", "index_conference": "boolean", "permissions": "permission_map", "creation_date": "datetime", "channels": "id_list", "users": "id_list", "roles": "id_list"}
 	id_key_types = {"owner": "account", "channels": "channel", "users": "account", "roles": "role"}
 	nonrewritable_keys = ["creation_date"]
+	directory_key = "name"
+	directory_flag = "index_conference"
 
 	def __init__(self, object_dict, force_id=False, patch_dict=False, federated=False):
 		__doc__ = Object.__doc__ # noqa: F841
@@ -399,7 +455,10 @@ class ConferenceMember(Object):
 	default_keys = {"banned": False, "roles": [], "permissions": "21101"}
 	key_types = {"user_id": "id", "nickname": "string", "parent_conference": "id", "roles": "id_list", "permissions": "permission_map", "banned": "boolean"}
 	id_key_types = {"user_id": "account", "roles": "role", "parent_conference": "conference"}
-	nonrewritable_keys = []
+	# Moving members between conferences would get around permission checks
+	nonrewritable_keys = ["parent_conference"]
+	# One membership per account and conference; also used to list members
+	unique_index_keys = [["parent_conference", "user_id"]]
 
 class Invite(Object):
 	"""
@@ -425,6 +484,7 @@ class Role(Object):
 	key_types = {"name": "string", "permissions": "permission_map", "color": "string", "description": "string", "parent_conference": "id"}
 	id_key_types = {"parent_conference": "conference"}
 	default_keys = {"color": "100, 100, 100", "permissions": "21101"}
+	nonrewritable_keys = ["parent_conference"]
 
 class Report(Object):
 	"""
@@ -432,16 +492,26 @@ class Report(Object):
 	"""
 	type = 'object'
 	object_type = 'report'
-	valid_keys = ["target", "note", "submission_date"]
+	valid_keys = ["target", "note", "submission_date", "target_type", "target_conference"]
 	required_keys = ["target", "submission_date"]
-	key_types = {"target": "id", "note": "string", "submission_date": "datetime"}
-	id_key_types = {"target": "any"}
-	nonrewritable_keys = ["target"]
+	key_types = {"target": "id", "note": "string", "submission_date": "datetime", "target_type": "string", "target_conference": "id"}
+	id_key_types = {"target": "any", "target_conference": "conference"}
+	nonrewritable_keys = ["target", "target_type", "target_conference"]
+	# target first, so that the latest reports for a target can be found
+	# without going through the others
+	index_keys = [["target", "submission_date", "id"], ["submission_date", "id"],
+	              ["target_type", "submission_date", "id"], ["target_conference", "submission_date", "id"]]
 
 	def __init__(self, object_dict, force_id=False, patch_dict=False, federated=False):
 		__doc__ = Object.__doc__ # noqa: F841
 		super().__init__(object_dict, force_id=force_id, patch_dict=patch_dict, federated=federated)
 		self.__dict__['submission_date'] = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc).isoformat()
+		if not patch_dict:
+			# Used to filter the moderation queue; always taken from the target
+			self.__dict__.pop('target_conference', None)
+			self.__dict__['target_type'], target_conference = db.get_object_type_and_conference(self.__dict__['target'])
+			if target_conference:
+				self.__dict__['target_conference'] = target_conference
 
 
 # Class to object type mapping
@@ -462,10 +532,11 @@ class_to_object = {
 object_types = class_to_object.keys()
 objects = class_to_object.values()
 
-def create_stash(id_list):
+def create_stash(id_list, fields=None):
 	"""
 	Takes up to 100 object IDs and returns a dict containing each ID alongside
-	the content of the associated object.
+	the content of the associated object. If a list of keys is given in
+	fields, only those keys of the objects are included.
 
 	Raises a KeyError with the missing ID if an ID is not found.
 
@@ -477,10 +548,10 @@ def create_stash(id_list):
 	stash = {}
 	stash['type'] = "stash"
 	stash['id_list'] = id_list
+	object_dicts = db.get_objects_as_dicts(id_list, fields=fields)
 	for id in id_list:
-		object_dict = db.get_object_as_dict_by_id(id)
-		if object_dict:
-			stash[id] = object_dict
+		if id in object_dicts:
+			stash[id] = object_dicts[id]
 		else:
 			raise KeyError('ID does not exist: ' + id)
 
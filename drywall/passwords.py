@@ -0,0 +1,148 @@
+# encoding: utf-8
+"""
+Handles password hashing.
+
+Password hashes are slow to compute on purpose, so computing them on the
+request thread would block every other request handled by the same worker.
+Instead, they are computed on a bounded process pool; when too many hashes
+are already waiting to be computed, new ones are turned down right away
+instead of piling up.
+
+The pool's processes are started from a fork server, not forked from the
+worker: forking a worker while its other threads hold locks (for example
+the database pool's or logging's) would leave them locked for good in the
+new process.
+
+Settings (in config.json):
+  - password_hash_method - the hashing method, as understood by werkzeug's
+                           generate_password_hash, including the cost (for
+                           example "pbkdf2:sha256:600000"). Defaults to
+                           werkzeug's default PBKDF2 settings.
+  - password_hash_workers - the amount of processes in the pool. If set to
+                            0, hashes are computed on the calling thread.
+                            Defaults to 2.
+  - password_hash_queue - the maximum amount of hashes that can be computed
+                          or waiting to be computed at once. If set to 0,
+                          there is no limit. Defaults to 32.
+"""
+from drywall import config
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+# We're using these functions for now; if anyone has any suggestions for
+# whether this is secure or not, see issue #3
+from werkzeug.security import check_password_hash
+from werkzeug.security import generate_password_hash
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS
+import multiprocessing
+import os
+import threading
+
+DEFAULT_METHOD = "pbkdf2:sha256:" + str(DEFAULT_PBKDF2_ITERATIONS)
+DEFAULT_WORKERS = 2
+DEFAULT_QUEUE = 32
+# Maximum time to wait for a hash, in seconds.
+HASH_TIMEOUT = 30
+
+_pool = None
+_slots = None
+_pool_lock = threading.Lock()
+
+def get_method():
+	"""Returns the configured hashing method."""
+	method = config.get('password_hash_method') or DEFAULT_METHOD
+	# werkzeug fills in the default iteration count if it's missing; do the
+	# same here, so that needs_rehash can compare the methods directly.
+	if method.startswith('pbkdf2:') and method.count(':') == 1:
+		method = method + ':' + str(DEFAULT_PBKDF2_ITERATIONS)
+	return method
+
+def _get_pool():
+	"""
+	Returns a tuple with the process pool and the semaphore that limits the
+	amount of queued hashes, creating them if needed.
+	"""
+	global _pool, _slots
+	with _pool_lock:
+		if _pool is None:
+			workers = config.get('password_hash_workers')
+			if workers is None:
+				workers = DEFAULT_WORKERS
+			queue = config.get('password_hash_queue')
+			if queue is None:
+				queue = DEFAULT_QUEUE
+			_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("forkserver"))
+			_slots = threading.BoundedSemaphore(queue) if queue else None
+		return (_pool, _slots)
+
+def shutdown_pool():
+	"""
+	Shuts down the process pool. It is created again the next time a hash
+	is computed.
+	"""
+	global _pool, _slots
+	with _pool_lock:
+		if _pool is not None:
+			_pool.shutdown(wait=False)
+		_pool = None
+		_slots = None
+
+def _forget_pool():
+	"""Drops the process pool inherited from the parent after a fork."""
+	global _pool, _slots, _pool_lock
+	_pool = None
+	_slots = None
+	_pool_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_forget_pool)
+
+def _run(function, *args):
+	"""
+	Runs a hashing function on the process pool and returns its result.
+
+	A hash keeps its slot in the queue until it's done, even if waiting for
+	it timed out, so that timed out hashes still count against the limit.
+
+	Raises a ValueError if the pool is too busy.
+	"""
+	if config.get('password_hash_workers') == 0:
+		return function(*args)
+
+	pool, slots = _get_pool()
+	if slots and not slots.acquire(blocking=False):
+		raise ValueError("The server is busy. Please try again in a moment.")
+	try:
+		future = pool.submit(function, *args)
+	except BaseException:
+		if slots:
+			slots.release()
+		raise
+	if slots:
+		future.add_done_callback(lambda future: slots.release())
+	try:
+		return future.result(timeout=HASH_TIMEOUT)
+	except FutureTimeoutError:
+		raise ValueError("The server is busy. Please try again in a moment.")
+
+def hash_password(password):
+	"""
+	Hashes a password with the configured method. Returns the hash.
+
+	Raises a ValueError if the server is too busy to hash the password.
+	"""
+	return _run(generate_password_hash, password, get_method())
+
+def check_password(password_hash, password):
+	"""
+	Checks whether a password matches the given hash. Returns True or False.
+
+	Raises a ValueError if the server is too busy to check the password.
+	"""
+	return _run(check_password_hash, password_hash, password)
+
+def needs_rehash(password_hash):
+	"""
+	Returns True if the given hash was not made with the configured method
+	(for example, because the cost has been changed since), False otherwise.
+	"""
+	return password_hash.split('$', 1)[0] != get_method()
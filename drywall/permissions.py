@@ -0,0 +1,687 @@
+# coding: utf-8
+"""
+Contains the effective permission resolver.
+
+A member's effective permissions in a channel are made up of:
+  - the conference's base permissions,
+  - the member's own permissions,
+  - the permissions of every role assigned to the member,
+all ORed together. Channel-scoped permissions (see CHANNEL_PERMISSIONS) are
+then limited to the ones enabled in the channel's permissions. The owner of
+a conference and members with the edit_conference permission always have
+all permissions; banned members have none. In direct message channels, the
+channel's permissions apply to all of its members.
+
+Resolved permissions are memoized per (account, channel) pair. Whenever a
+conference, channel, role or conference member is inserted, updated or
+deleted, the cached results for the conference it belongs to are dropped
+once the change is committed. This only happens within the current process,
+so cached results also expire after permission_cache_ttl seconds, to pick
+up changes made by other workers.
+
+Settings (in config.json):
+  - permission_cache_ttl - time after which cached results expire, in
+                           seconds. Defaults to 60.
+  - permission_cache_size - maximum amount of cached results. Defaults to
+                            65536.
+"""
+from drywall import config
+from drywall import db
+from drywall import db_models as models
+from drywall import objects
+from drywall import pings
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+import functools
+import threading
+import time
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# Default for the permission_cache_ttl setting, in seconds.
+DEFAULT_CACHE_TTL = 60
+# Default for the permission_cache_size setting.
+DEFAULT_CACHE_SIZE = 65536
+
+ALL_PERMISSIONS = sum(objects.Permissions.shorthands.values())
+# Permissions that can be limited per channel.
+CHANNEL_PERMISSIONS = (objects.Permissions.shorthands['see_channel'] |
+                       objects.Permissions.shorthands['read_channel'] |
+                       objects.Permissions.shorthands['write_channel'] |
+                       objects.Permissions.shorthands['embed'] |
+                       objects.Permissions.shorthands['moderate_messages'] |
+                       objects.Permissions.shorthands['modify_channel'])
+CONFERENCE_PERMISSIONS = ALL_PERMISSIONS & ~CHANNEL_PERMISSIONS
+ADMIN_PERMISSION = objects.Permissions.shorthands['edit_conference']
+# Permissions needed to see messages in a channel.
+READ_PERMISSIONS = (objects.Permissions.shorthands['see_channel'] |
+                    objects.Permissions.shorthands['read_channel'])
+
+# Object types that belong to a conference without being a permission
+# target themselves, with the key pointing at their conference. Requests on
+# them are authorized against that conference.
+CONFERENCE_CHILD_TYPES = {"role": "parent_conference", "conference_member": "parent_conference",
+                          "invite": "conference_id"}
+# The same for object types that belong to a channel.
+CHANNEL_CHILD_TYPES = {"message": "parent_channel"}
+
+# Bit tables: permission value -> tuple of shorthands, and shorthand or
+# scope name -> permission bit.
+SHORTHAND_TABLE = tuple(tuple(name for name, bit in objects.Permissions.shorthands.items() if value & bit)
+                        for value in range(ALL_PERMISSIONS + 1))
+BIT_TABLE = dict(objects.Permissions.shorthands, **objects.Permissions.scopes)
+
+# Cache: {(account ID, target ID): (scope ID, epoch, expiry time, value)}
+# The scope ID is the ID of the conference the target belongs to (or the
+# ID of the channel itself for direct message channels). An entry is valid
+# as long as its scope has not changed since the entry's epoch.
+_cache = {}
+# Audience cache: {(channel ID, permission): (scope ID, epoch, expiry time,
+# tuple of account IDs)}
+_audiences = {}
+# Evaluated members: {conference ID: (scope ID, epoch, expiry time,
+# (conference dict, member tuples, permission values))}
+_member_values = {}
+# Object types of permission targets: {target ID: object type}
+_types = {}
+# Conferences of objects in CONFERENCE_CHILD_TYPES and channels of objects
+# in CHANNEL_CHILD_TYPES: {object ID: conference or channel ID}
+_parents = {}
+# {scope ID: epoch of the last change}
+_changed = {}
+_epoch = 0
+_epoch_lock = threading.Lock()
+
+def to_int(value):
+	"""
+	Turns a permission value, which may be stored as a string or be missing,
+	into an int.
+	"""
+	if not value:
+		return 0
+	return int(value) & ALL_PERMISSIONS
+
+def to_shorthands(value):
+	"""Returns a tuple with the shorthands of the permissions in a value."""
+	return SHORTHAND_TABLE[to_int(value)]
+
+def get_bit(permission):
+	"""
+	Returns the bit for a permission shorthand or scope name, or the value
+	itself if it's already an int.
+
+	Raises a KeyError if the permission does not exist.
+	"""
+	if isinstance(permission, int):
+		return permission
+	return BIT_TABLE[permission]
+
+def _get_cached(cache, key):
+	"""
+	Returns the value of a valid cache entry, or None if there is no valid
+	entry for the key.
+	"""
+	entry = cache.get(key)
+	if entry is not None and entry[2] > time.monotonic() and entry[1] >= _changed.get(entry[0], 0):
+		return entry[3]
+	return None
+
+def _store(cache, key, scope, epoch, value):
+	"""
+	Stores a value in a cache. The epoch must be read before the data the
+	value is based on, so that changes committed in the meantime invalidate
+	the entry.
+	"""
+	if len(cache) >= (config.get('permission_cache_size') or DEFAULT_CACHE_SIZE):
+		cache.clear()
+	ttl = config.get('permission_cache_ttl') or DEFAULT_CACHE_TTL
+	cache[key] = (scope, epoch, time.monotonic() + ttl, value)
+
+##
+# Resolution
+##
+
+def _get_object(object_id, object_type=None):
+	"""
+	Returns the dict of an object, or None if it does not exist or is not of
+	the given object type. If the object type is known (or was cached), this
+	only takes one query.
+	"""
+	known_type = object_type or _types.get(object_id)
+	if known_type is None:
+		object = db.get_object_as_dict_by_id(object_id)
+		if object:
+			_store_type(object_id, object['object_type'])
+		return object
+	if object_type and _types.get(object_id, object_type) != object_type:
+		return None
+	found = db.get_objects_as_dicts_by_ids(known_type, [object_id])
+	if not found:
+		return None
+	_store_type(object_id, known_type)
+	return found[0]
+
+def _store_type(object_id, object_type):
+	"""Caches the object type of an object."""
+	if len(_types) >= (config.get('permission_cache_size') or DEFAULT_CACHE_SIZE):
+		_types.clear()
+	_types[object_id] = object_type
+
+def combine(conference, member, roles):
+	"""
+	Computes conference-wide permissions from a conference dict, a
+	conference member dict (or None if the account is not a member) and a
+	list of role dicts. Roles from other conferences are ignored. The
+	conference owner is not treated specially here.
+	"""
+	if not member or member.get('banned'):
+		return 0
+	value = to_int(conference.get('permissions')) | to_int(member.get('permissions'))
+	for role in roles:
+		if role.get('parent_conference') == conference['id']:
+			value |= to_int(role.get('permissions'))
+	if value & ADMIN_PERMISSION:
+		return ALL_PERMISSIONS
+	return value
+
+def apply_channel(value, channel):
+	"""
+	Limits the channel-scoped permissions in a conference-wide permission
+	value to the ones enabled in a channel.
+	"""
+	if value == ALL_PERMISSIONS:
+		return value
+	return (value & CONFERENCE_PERMISSIONS) | (value & to_int(channel.get('permissions')) & CHANNEL_PERMISSIONS)
+
+def _resolve_conference(account_id, conference):
+	"""Resolves conference-wide permissions from the database."""
+	if conference.get('owner') == account_id:
+		return ALL_PERMISSIONS
+	member = db.get_conference_member(conference['id'], account_id)
+	roles = []
+	if member and member.get('roles'):
+		roles = db.get_objects_as_dicts_by_ids('role', member['roles'])
+	return combine(conference, member, roles)
+
+def _resolve_direct_message(account_id, channel):
+	"""Resolves permissions in a direct message channel."""
+	if account_id not in (channel.get('members') or []):
+		return 0
+	return to_int(channel.get('permissions'))
+
+def _resolve(account_id, target_id):
+	"""
+	Resolves the permissions of an account in a channel or conference.
+	Returns a tuple with the scope ID and the value, which is None if the
+	target does not exist or is not a channel or conference.
+	"""
+	target = _get_object(target_id)
+	if not target:
+		return (target_id, None)
+	if target['object_type'] == 'conference':
+		return (target_id, _resolve_conference(account_id, target))
+	if target['object_type'] != 'channel':
+		return (target_id, None)
+
+	if target['channel_type'] == 'direct_message':
+		return (target_id, _resolve_direct_message(account_id, target))
+	conference_id = target['parent_conference']
+	conference = _get_object(conference_id, 'conference')
+	if not conference:
+		return (conference_id, 0)
+	return (conference_id, apply_channel(_resolve_conference(account_id, conference), target))
+
+def get_permissions(account_id, target_id):
+	"""
+	Returns the effective permissions of an account in a channel or
+	conference, as an int. For conferences, channel-scoped permissions are
+	not limited by any channel.
+
+	Returns None if the target does not exist or is not a channel or
+	conference.
+	"""
+	# This is the same as _get_cached, inlined, since every authorization
+	# check goes through here.
+	entry = _cache.get((account_id, target_id))
+	if entry is not None and entry[2] > time.monotonic() and entry[1] >= _changed.get(entry[0], 0):
+		return entry[3]
+
+	epoch = _epoch
+	scope, value = _resolve(account_id, target_id)
+	_store(_cache, (account_id, target_id), scope, epoch, value)
+	return value
+
+def has_permission(account_id, target_id, permission):
+	"""
+	Returns True if an account has a permission (given as a bit, shorthand
+	or scope name) in a channel or conference, False otherwise.
+	"""
+	return (get_permissions(account_id, target_id) or 0) & get_bit(permission) != 0
+
+def get_readable_channels(account_id, conference_id=None, permission=READ_PERMISSIONS):
+	"""
+	Returns a list with the IDs of all channels an account can read (or has
+	another permission in), optionally limited to one conference.
+
+	Permissions are resolved once per conference, not once per channel.
+	"""
+	permission = get_bit(permission)
+	readable = []
+	for channel_id, parent_conference, channel_permissions in db.get_account_channels(account_id, conference_id):
+		if parent_conference:
+			value = apply_channel(get_permissions(account_id, parent_conference) or 0,
+			                      {'permissions': channel_permissions})
+		else:
+			value = to_int(channel_permissions)
+		if value & permission == permission:
+			readable.append(channel_id)
+	return readable
+
+def get_object_type(target_id):
+	"""
+	Returns the object type of a permission target. Object types never
+	change, so they are cached for as long as possible.
+
+	Returns None if the object does not exist.
+	"""
+	object_type = _types.get(target_id)
+	if object_type is None:
+		object_type = db.get_object_type(target_id)
+		if object_type is None:
+			return None
+		_store_type(target_id, object_type)
+	return object_type
+
+def get_parent_conference(object_id):
+	"""
+	Returns the ID of the conference an object in CONFERENCE_CHILD_TYPES
+	belongs to, or None if it does not exist. Their conference can't be
+	changed, so it is cached like object types.
+	"""
+	conference_id = _parents.get(object_id)
+	if conference_id is None:
+		object_type, conference_id = db.get_object_type_and_conference(object_id)
+		if conference_id is None:
+			return None
+		_store_parent(object_id, conference_id)
+		_store_type(object_id, object_type)
+	return conference_id
+
+def get_parent_channel(object_id):
+	"""
+	Returns the ID of the channel an object in CHANNEL_CHILD_TYPES belongs
+	to, or None if it does not exist. Cached like get_parent_conference.
+	"""
+	channel_id = _parents.get(object_id)
+	if channel_id is None:
+		for object_type, key in CHANNEL_CHILD_TYPES.items():
+			found = db.get_objects_as_dicts_by_ids(object_type, [object_id])
+			if found:
+				channel_id = found[0][key]
+				_store_parent(object_id, channel_id)
+				_store_type(object_id, object_type)
+				break
+	return channel_id
+
+def _store_parent(object_id, parent_id):
+	"""Caches the conference or channel an object belongs to."""
+	if len(_parents) >= (config.get('permission_cache_size') or DEFAULT_CACHE_SIZE):
+		_parents.clear()
+	_parents[object_id] = parent_id
+
+##
+# Bulk evaluation
+##
+
+def _evaluate_python(base, members, role_values):
+	"""Pure Python version of evaluate_members."""
+	values = []
+	for user_id, member_permissions, roles, banned in members:
+		if banned:
+			values.append(0)
+			continue
+		value = base | to_int(member_permissions)
+		for role in roles or ():
+			value |= role_values.get(role, 0)
+		if value & ADMIN_PERMISSION:
+			value = ALL_PERMISSIONS
+		values.append(value)
+	return values
+
+def _evaluate_numpy(base, members, role_values):
+	"""NumPy version of evaluate_members."""
+	# Role permissions are packed into an array, with an empty role at index
+	# 0. Role assignments are stored as one flat array of indexes into it,
+	# with every member's roles followed by the empty role; this way every
+	# member has at least one entry, which reduceat needs.
+	role_index = {role_id: index for index, role_id in enumerate(role_values, 1)}
+	packed_roles = numpy.zeros(len(role_values) + 1, dtype=numpy.uint16)
+	packed_roles[1:] = list(role_values.values())
+
+	count = len(members)
+	role_lists = [member[2] or () for member in members]
+	role_counts = numpy.fromiter(map(len, role_lists), dtype=numpy.intp, count=count)
+	flat_roles = [role_index.get(role, 0) for roles in role_lists for role in roles]
+	# Member n's roles are shifted by n places to make room for the empty
+	# roles before them.
+	assignments = numpy.zeros(len(flat_roles) + count, dtype=numpy.intp)
+	assignments[numpy.arange(len(flat_roles)) + numpy.repeat(numpy.arange(count), role_counts)] = flat_roles
+	offsets = numpy.zeros(count, dtype=numpy.intp)
+	numpy.cumsum(role_counts[:-1] + 1, out=offsets[1:])
+
+	member_permissions = numpy.array([member[1] or 0 for member in members], dtype=numpy.int64)
+	values = (member_permissions & ALL_PERMISSIONS).astype(numpy.uint16)
+	values |= numpy.bitwise_or.reduceat(packed_roles[assignments], offsets)
+	values |= numpy.uint16(base)
+	values[(values & ADMIN_PERMISSION) != 0] = ALL_PERMISSIONS
+	values[numpy.array([bool(member[3]) for member in members])] = 0
+	return values
+
+def evaluate_members(conference, members, role_values):
+	"""
+	Computes the conference-wide permissions of many members at once.
+
+	Arguments:
+	  - conference (required) - the conference's dict
+	  - members (required) - list of (user_id, permissions, roles, banned)
+	                         tuples, as returned by
+	                         db.get_conference_permission_data
+	  - role_values (required) - dict with role IDs as keys and role
+	                             permissions as values
+
+	Returns a sequence of permission values (a NumPy array if NumPy is
+	installed, a list otherwise) in the same order as the members. The
+	conference owner is not treated specially here.
+	"""
+	base = to_int(conference.get('permissions'))
+	role_values = {role: to_int(value) for role, value in role_values.items()}
+	if not members:
+		return []
+	if numpy is not None:
+		return _evaluate_numpy(base, members, role_values)
+	return _evaluate_python(base, members, role_values)
+
+def _filter_audience(values, members, channel, permission):
+	"""
+	Returns the user IDs of the members whose values, limited by the
+	channel's permissions, contain all bits in permission.
+	"""
+	channel_value = to_int(channel.get('permissions')) | CONFERENCE_PERMISSIONS
+	if numpy is not None and isinstance(values, numpy.ndarray):
+		limited = numpy.where(values == ALL_PERMISSIONS, values, values & channel_value)
+		return [members[index][0] for index in numpy.flatnonzero((limited & permission) == permission)]
+	audience = []
+	for member, value in zip(members, values):
+		if value != ALL_PERMISSIONS:
+			value &= channel_value
+		if value & permission == permission:
+			audience.append(member[0])
+	return audience
+
+def get_member_values(conference_id):
+	"""
+	Returns a tuple with the conference's dict, the member tuples from
+	db.get_conference_permission_data and their conference-wide permission
+	values from evaluate_members. The result is cached, so that audiences
+	of all channels in a conference can be found without evaluating the
+	members again.
+
+	Returns None if the conference does not exist.
+	"""
+	member_values = _get_cached(_member_values, conference_id)
+	if member_values is not None:
+		return member_values
+
+	epoch = _epoch
+	conference = _get_object(conference_id, 'conference')
+	if not conference:
+		return None
+	members, role_values = db.get_conference_permission_data(conference_id)
+	member_values = (conference, members, evaluate_members(conference, members, role_values))
+	_store(_member_values, conference_id, conference_id, epoch, member_values)
+	return member_values
+
+def _resolve_audience(channel_id, permission):
+	"""
+	Resolves the audience of a channel from the database. Returns a tuple
+	with the scope ID and a tuple of account IDs.
+	"""
+	channel = _get_object(channel_id, 'channel')
+	if not channel:
+		return (channel_id, ())
+
+	if channel['channel_type'] == 'direct_message':
+		if to_int(channel.get('permissions')) & permission != permission:
+			return (channel_id, ())
+		return (channel_id, tuple(dict.fromkeys(channel.get('members') or [])))
+
+	conference_id = channel['parent_conference']
+	member_values = get_member_values(conference_id)
+	if not member_values:
+		return (conference_id, ())
+	conference, members, values = member_values
+	audience = _filter_audience(values, members, channel, permission)
+	if conference['owner'] not in audience:
+		audience.append(conference['owner'])
+	return (conference_id, tuple(audience))
+
+def get_channel_audience(channel_id, permission=READ_PERMISSIONS):
+	"""
+	Returns a tuple with the IDs of all accounts that have a permission (by
+	default, see_channel and read_channel) in a channel. If the permission
+	value has more than one bit set, accounts need all of them.
+
+	Results are cached the same way as in get_permissions. Returns an empty
+	tuple if the channel does not exist.
+	"""
+	permission = get_bit(permission)
+	audience = _get_cached(_audiences, (channel_id, permission))
+	if audience is not None:
+		return audience
+
+	epoch = _epoch
+	scope, audience = _resolve_audience(channel_id, permission)
+	_store(_audiences, (channel_id, permission), scope, epoch, audience)
+	return audience
+
+def invalidate(scope_id=None):
+	"""
+	Drops cached results for a conference (or direct message channel), or
+	all cached results if no ID is given.
+	"""
+	global _epoch
+	if scope_id is None:
+		_cache.clear()
+		_audiences.clear()
+		_member_values.clear()
+		return
+	with _epoch_lock:
+		_epoch += 1
+		_changed[scope_id] = _epoch
+
+##
+# Authorization
+##
+
+def _check_scopes(token, required, value):
+	"""
+	Returns an error response if the token lacks one of the required scopes,
+	or the permission value (unless it's None) lacks the matching
+	permission. Returns None otherwise.
+	"""
+	for scope in required:
+		if scope is None:
+			continue
+		if scope not in token['scopes']:
+			return pings.response_from_error(3, error_message="The access token does not have the " + scope + " scope")
+		if value is not None and not value & BIT_TABLE[scope]:
+			return pings.response_from_error(3)
+	return None
+
+def _get_target_permissions(account_id, target_id, object_type, parent_id=None):
+	"""
+	Returns the permissions of an account in a target for authorization.
+	Objects in CONFERENCE_CHILD_TYPES and CHANNEL_CHILD_TYPES use the
+	permissions in their conference or channel (looked up if not given),
+	or none if it's gone.
+	"""
+	if object_type in CONFERENCE_CHILD_TYPES:
+		parent_id = parent_id or get_parent_conference(target_id)
+	elif object_type in CHANNEL_CHILD_TYPES:
+		parent_id = parent_id or get_parent_channel(target_id)
+	else:
+		return get_permissions(account_id, target_id)
+	if not parent_id:
+		return 0
+	return get_permissions(account_id, parent_id) or 0
+
+def get_parent_key(object_type):
+	"""
+	Returns the key pointing at the conference or channel that objects of
+	the given type are checked in, or None if they are checked themselves.
+	"""
+	return CONFERENCE_CHILD_TYPES.get(object_type) or CHANNEL_CHILD_TYPES.get(object_type)
+
+def authorize(scopes, target=None, key_scopes=None):
+	"""
+	Decorator for API endpoints that checks whether the request's access
+	token has the scope needed for the request, and whether the token's
+	account has the matching permission in the target conference or channel.
+
+	Arguments:
+	  - scopes (required) - dict with object types of the target as keys
+	                        (None for requests without a target) and dicts
+	                        with HTTP methods as keys and scopes (see
+	                        objects.Permissions.scopes) as values, for
+	                        example {"conference": {"GET": "conference:read"}}.
+	                        A scope of None only requires a valid token.
+	  - target - name of the URL variable with the ID of the target, or a
+	             function that returns the ID; if None, only the token's
+	             scopes are checked
+	  - key_scopes - dict with object types of the target as keys and dicts
+	                 with keys of the request's JSON body as keys and
+	                 additional scopes needed to change them as values
+
+	Targets in CONFERENCE_CHILD_TYPES (roles, conference members and
+	invites) are checked against the permissions in their conference, and
+	targets in CHANNEL_CHILD_TYPES (messages) against the ones in their
+	channel.
+
+	Requests without a valid access token get a 401 response; requests that
+	lack a scope or permission get a 403 response. If the target has an
+	object type not listed in scopes, the request is passed on to the
+	endpoint as is; if the target does not exist, it is treated as if there
+	was no target, which means the endpoint is expected to return the right
+	error.
+
+	Cached permissions are used, so this does not make any queries once the
+	cache is warm.
+	"""
+	def decorator(function):
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			if callable(target):
+				target_id = target()
+			elif target:
+				target_id = kwargs.get(target)
+			else:
+				target_id = None
+
+			object_type = None
+			if target_id is not None:
+				if not isinstance(target_id, str):
+					return function(*args, **kwargs)
+				object_type = get_object_type(target_id)
+			if object_type not in scopes:
+				return function(*args, **kwargs)
+
+			token = g.get('token')
+			if not token:
+				return pings.response_from_error(12)
+			value = None
+			if object_type is not None:
+				value = _get_target_permissions(token['account'], target_id, object_type)
+
+			required = [scopes[object_type].get(request.method)]
+			if key_scopes and object_type in key_scopes and request.method in ('POST', 'PATCH'):
+				body = request.get_json(silent=True)
+				if isinstance(body, dict):
+					required += [scope for key, scope in key_scopes[object_type].items() if key in body]
+			error = _check_scopes(token, required, value)
+			if error:
+				return error
+			return function(*args, **kwargs)
+		return wrapper
+	return decorator
+
+def authorize_objects(scopes, object_dicts, method="GET"):
+	"""
+	Checks whether the request's access token may access every object in a
+	list of object dicts with the given method, the same way authorize
+	checks a single target, with the objects' types as keys of scopes.
+	Objects in CONFERENCE_CHILD_TYPES and CHANNEL_CHILD_TYPES must include
+	the key pointing at their conference or channel (see get_parent_key).
+
+	Returns an error response for the first object that can't be accessed,
+	or None if all of them can.
+	"""
+	token = g.get('token')
+	for object_dict in object_dicts:
+		object_type = object_dict['object_type']
+		if object_type not in scopes:
+			continue
+		if not token:
+			return pings.response_from_error(12)
+		value = _get_target_permissions(token['account'], object_dict['id'], object_type,
+			parent_id=object_dict.get(get_parent_key(object_type)))
+		error = _check_scopes(token, [scopes[object_type].get(method)], value)
+		if error:
+			return error
+	return None
+
+def check_scope(scope, target_id):
+	"""
+	Returns an error response if the request's access token lacks a scope,
+	or its account lacks the matching permission in a conference or
+	channel. Returns None otherwise.
+
+	For checks that depend on the object, which can't be done with
+	authorize.
+	"""
+	token = g.get('token')
+	if not token:
+		return pings.response_from_error(12)
+	return _check_scopes(token, [scope], get_permissions(token['account'], target_id) or 0)
+
+##
+# Invalidation
+##
+
+def _get_scope(target):
+	"""Returns the scope ID for a changed model instance."""
+	if isinstance(target, models.Conference):
+		return target.id
+	if isinstance(target, models.Channel) and not target.parent_conference:
+		return target.id
+	return target.parent_conference
+
+def _record_change(mapper, connection, target):
+	Session.object_session(target).info.setdefault('permission_scopes', set()).add(_get_scope(target))
+
+for _model in (models.Conference, models.Channel, models.Role, models.ConferenceMember):
+	for _event in ('after_insert', 'after_update', 'after_delete'):
+		event.listen(_model, _event, _record_change)
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+	for scope_id in session.info.pop('permission_scopes', ()):
+		invalidate(scope_id)
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+	session.info.pop('permission_scopes', None)
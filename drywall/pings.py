@@ -2,6 +2,7 @@
 """
 This file defines pings.
 """
+from drywall import metrics
 
 import simplejson as json
 from flask import Response
@@ -15,6 +16,7 @@ def response_from_error(error_code, error_message=None):
 	                    will be used
 	"""
 	error = Error(error_code, error_message).__dict__
+	metrics.errors.inc((str(error_code),))
 	error_response_code = error['response_code']
 	return Response(json.dumps(error), status=error_response_code, mimetype='application/json')
 
@@ -60,6 +62,15 @@ class Error:
 		elif error_code == 11:
 			self.error = "Too many objects provided"
 			self.response_code = 400
+		elif error_code == 12:
+			self.error = "Missing, invalid or expired access token"
+			self.response_code = 401
+		elif error_code == 13:
+			self.error = "Invalid query parameter"
+			self.response_code = 400
+		elif error_code == 14:
+			self.error = "Too many requests"
+			self.response_code = 429
 		else:
 			raise TypeError("Wrong error_code")
 
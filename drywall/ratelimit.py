@@ -0,0 +1,265 @@
+# coding: utf-8
+"""
+Contains the rate limiter.
+
+Requests are limited with token buckets: every bucket holds up to "burst"
+tokens and is refilled with "rate" tokens per second. Every request takes a
+token from each bucket that applies to it; if one of them is empty, the
+request is turned down with a 429 response and a Retry-After header.
+
+Buckets are kept per route group and per account, client (both taken from
+the request's access token) and IP address. Route groups are configured
+with the rate_limits setting, for example:
+
+    "rate_limits": {
+        "messages": {
+            "routes": ["POST /api/v1/messages", "POST /api/v1/id"],
+            "account": {"rate": 5, "burst": 50},
+            "ip": {"rate": 10, "burst": 100}
+        }
+    }
+
+Routes are route rules, optionally prefixed with an HTTP method. Each of
+"account", "client" and "ip" is optional; leaving one out means requests
+are not limited by it. A group without a "routes" list applies to all /api/
+routes that are not in another group. Requests to routes that are not in
+any group are let through without any further checks.
+
+IP addresses are taken from the connection, which is the proxy's address
+behind a reverse proxy, unless the trusted_proxies setting is set (see
+drywall.create_app).
+
+Buckets are kept in memory by default, which means that every worker has
+its own set of buckets. To share them between workers, set the
+rate_limit_backend setting to "database"; buckets are then kept in the
+rate_limit_buckets table, at the cost of one query per limited request.
+
+Settings (in config.json):
+  - rate_limits - route groups, as described above. Defaults to
+                  DEFAULT_RATE_LIMITS.
+  - rate_limit_backend - "memory" or "database". Defaults to "memory".
+  - rate_limit_max_buckets - maximum amount of buckets kept in memory.
+                             Defaults to 100000.
+"""
+from drywall import app
+from drywall import config
+from drywall import db
+from drywall import pings
+from drywall import tokens # noqa: F401 - authenticate requests before limiting them
+
+from flask import g, request
+import math
+import os
+import threading
+import time
+
+DEFAULT_RATE_LIMITS = {
+	"messages": {
+		"routes": ["POST /api/v1/messages", "POST /api/v1/id"],
+		"account": {"rate": 5, "burst": 50},
+		"client": {"rate": 50, "burst": 500},
+		"ip": {"rate": 10, "burst": 100}
+	},
+	"stash": {
+		"routes": ["POST /api/v1/stash/request"],
+		"account": {"rate": 2, "burst": 20},
+		"ip": {"rate": 5, "burst": 50}
+	}
+}
+# Default for the rate_limit_max_buckets setting.
+DEFAULT_MAX_BUCKETS = 100000
+# Minimum time between removals of full buckets from the database, in seconds.
+DATABASE_CLEANUP_INTERVAL = 60
+
+BUCKET_KINDS = ("account", "client", "ip")
+
+# Parsed settings: (routes, default group, backend), where routes is a dict
+# with (method or None, route rule) tuples as keys and groups as values, and
+# groups are (name, {kind: (rate, burst)}) tuples.
+_settings = None
+# In-memory buckets: {(group name, kind, value): [tokens, last update]}
+_buckets = {}
+_buckets_lock = threading.Lock()
+_last_cleanup = 0
+
+def parse_limits(limits):
+	"""
+	Parses the rate_limits setting. Returns a (routes, default group) tuple;
+	see _settings.
+
+	Raises a ValueError if the setting is invalid.
+	"""
+	routes = {}
+	default = None
+	for name, group_settings in limits.items():
+		buckets = {}
+		for kind in BUCKET_KINDS:
+			if kind not in group_settings:
+				continue
+			rate = group_settings[kind].get('rate')
+			burst = group_settings[kind].get('burst')
+			if not isinstance(rate, (int, float)) or rate <= 0:
+				raise ValueError("Invalid rate in rate limit group " + name + ": " + str(rate))
+			if not isinstance(burst, (int, float)) or burst < 1:
+				raise ValueError("Invalid burst in rate limit group " + name + ": " + str(burst))
+			buckets[kind] = (float(rate), float(burst))
+		group = (name, buckets)
+		if 'routes' not in group_settings:
+			default = group
+			continue
+		for route in group_settings['routes']:
+			method, _, rule = route.rpartition(' ')
+			routes[(method.upper() or None, rule)] = group
+	return (routes, default)
+
+def configure(limits=None, backend=None):
+	"""
+	Sets the route groups and backend, dropping all in-memory buckets. If
+	not given, they are taken from the rate_limits and rate_limit_backend
+	settings.
+	"""
+	global _settings
+	if limits is None:
+		limits = config.get('rate_limits')
+		if limits is None:
+			limits = DEFAULT_RATE_LIMITS
+	backend = backend or config.get('rate_limit_backend') or "memory"
+	if backend not in ("memory", "database"):
+		raise ValueError("Invalid rate_limit_backend setting: " + str(backend))
+	routes, default = parse_limits(limits)
+	with _buckets_lock:
+		_buckets.clear()
+		_settings = (routes, default, backend)
+
+def _take_memory(buckets):
+	"""
+	Takes a token from each of the given in-memory buckets, if none of them
+	are empty. Takes a list of (key, rate, burst) tuples; returns the time
+	until the request can be retried in seconds, or 0 if it's allowed.
+	"""
+	now = time.monotonic()
+	retry_after = 0
+	with _buckets_lock:
+		states = []
+		for key, rate, burst in buckets:
+			state = _buckets.get(key)
+			if state is None:
+				state = [burst, now]
+			else:
+				state[0] = min(burst, state[0] + (now - state[1]) * rate)
+				state[1] = now
+			if state[0] < 1:
+				retry_after = max(retry_after, (1 - state[0]) / rate)
+			states.append((key, state))
+		if retry_after:
+			return retry_after
+
+		if len(_buckets) + len(states) > (config.get('rate_limit_max_buckets') or DEFAULT_MAX_BUCKETS):
+			_remove_full_buckets(now)
+		for key, state in states:
+			state[0] -= 1
+			_buckets[key] = state
+	return 0
+
+def _remove_full_buckets(now):
+	"""
+	Removes in-memory buckets that have refilled completely, as they are
+	the same as buckets that don't exist yet. If there are still too many
+	buckets afterwards, all of them are removed.
+	"""
+	limits = {}
+	for group in [_settings[1]] + list(_settings[0].values()):
+		if group:
+			limits[group[0]] = group[1]
+	for key, (level, updated) in list(_buckets.items()):
+		rate, burst = limits.get(key[0], {}).get(key[1], (None, None))
+		if rate is None or level + (now - updated) * rate >= burst:
+			del _buckets[key]
+	if len(_buckets) >= (config.get('rate_limit_max_buckets') or DEFAULT_MAX_BUCKETS):
+		_buckets.clear()
+
+def _take_database(buckets):
+	"""
+	Takes a token from each of the given buckets in the database. Takes a
+	list of (key, rate, burst) tuples; returns the time until the request
+	can be retried in seconds, or 0 if it's allowed.
+
+	Unlike with in-memory buckets, tokens are taken from the buckets that
+	are not empty even if the request is turned down.
+	"""
+	global _last_cleanup
+	now = time.monotonic()
+	if now - _last_cleanup > DATABASE_CLEANUP_INTERVAL:
+		_last_cleanup = now
+		db.remove_full_rate_limit_buckets()
+
+	rates = {}
+	database_buckets = []
+	for key, rate, burst in buckets:
+		database_key = ":".join(key)
+		rates[database_key] = rate
+		database_buckets.append((database_key, rate, burst))
+	retry_after = 0
+	for database_key, (level, allowed) in db.take_rate_limit_tokens(database_buckets).items():
+		if not allowed:
+			retry_after = max(retry_after, (1 - level) / rates[database_key])
+	return retry_after
+
+def get_buckets(group):
+	"""
+	Returns a list of (key, rate, burst) tuples for the buckets of the given
+	group that apply to the current request.
+	"""
+	name, limits = group
+	token = g.get('token')
+	buckets = []
+	for kind, (rate, burst) in limits.items():
+		if kind == 'ip':
+			value = request.remote_addr
+		elif token:
+			value = token[kind]
+		else:
+			continue
+		if value:
+			buckets.append(((name, kind, value), rate, burst))
+	return buckets
+
+@app.before_request
+def limit_request():
+	"""
+	Takes tokens from the buckets that apply to the current request. Returns
+	a 429 response if one of them is empty.
+	"""
+	if _settings is None:
+		configure()
+	routes, default, backend = _settings
+	if not routes and not default:
+		return None
+	rule = request.url_rule
+	if rule is None:
+		return None
+	group = routes.get((request.method, rule.rule)) or routes.get((None, rule.rule))
+	if group is None:
+		if not default or not request.path.startswith('/api/'):
+			return None
+		group = default
+
+	buckets = get_buckets(group)
+	if not buckets:
+		return None
+	if backend == "database":
+		retry_after = _take_database(buckets)
+	else:
+		retry_after = _take_memory(buckets)
+	if not retry_after:
+		return None
+	response = pings.response_from_error(14)
+	response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+	return response
+
+def _forget_buckets():
+	"""Resets the lock inherited from the parent after a fork."""
+	global _buckets_lock
+	_buckets_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_forget_buckets)
@@ -0,0 +1,197 @@
+# coding: utf-8
+"""
+Contains code for signed access tokens, used to authenticate API requests.
+
+Access tokens are self-contained: they carry the account ID, client ID,
+scopes and expiry date of the grant, and are signed with a key derived from
+the instance's secret. This means they can be verified without querying the
+database. To make revocation possible, every token has an ID; IDs of revoked
+tokens are kept in the database until the token expires, and a copy of that
+list is cached in memory and refreshed every token_revocation_refresh
+seconds.
+
+Tokens look like this:
+
+    v1.<base64url-encoded JSON payload>.<base64url-encoded HMAC-SHA256>
+"""
+from drywall import app
+from drywall import config
+from drywall import db
+from drywall import objects
+from drywall import pings
+
+from flask import g, request
+import base64
+import datetime
+import hashlib
+import hmac
+import simplejson as json
+import threading
+import time
+import uuid
+
+TOKEN_VERSION = "v1"
+# Default for the access_token_lifetime setting, in seconds.
+DEFAULT_LIFETIME = 3600
+# Default for the token_revocation_refresh setting, in seconds.
+DEFAULT_REVOCATION_REFRESH = 30
+
+_signing_key = None
+
+# Revocation list cache: {token ID: expiry timestamp}
+_revoked = {}
+_revoked_refreshed = None
+_revoked_lock = threading.Lock()
+
+def _b64encode(data):
+	return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def _b64decode(data):
+	return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+def _get_signing_key():
+	"""
+	Returns the key used to sign tokens. It is derived from the instance's
+	secret, so that tokens can't be swapped for other things signed with it.
+	"""
+	global _signing_key
+	if _signing_key is None:
+		if not app.secret_key:
+			raise ValueError("The secret setting is not set in config.json")
+		secret = app.secret_key
+		if isinstance(secret, str):
+			secret = secret.encode('utf-8')
+		_signing_key = hmac.new(secret, b"drywall access token", hashlib.sha256).digest()
+	return _signing_key
+
+def _sign(data):
+	return hmac.new(_get_signing_key(), data, hashlib.sha256).digest()
+
+def issue_token(account_id, client_id, scopes, lifetime=None):
+	"""
+	Issues a signed access token. Returns the token as a string.
+
+	Arguments:
+	  - account_id (required) - ID of the account the token acts as
+	  - client_id (required) - ID of the client the token was issued to
+	  - scopes (required) - list of scopes granted to the token; see
+	                        objects.Permissions.scopes
+	  - lifetime - time after which the token expires, in seconds; defaults
+	               to the access_token_lifetime setting
+
+	Raises a ValueError if one of the scopes is invalid.
+	"""
+	for scope in scopes:
+		if scope not in objects.Permissions.scopes:
+			raise ValueError("Invalid scope: " + str(scope))
+	if not lifetime:
+		lifetime = config.get('access_token_lifetime') or DEFAULT_LIFETIME
+
+	payload = {
+		"jti": uuid.uuid4().hex,
+		"account": account_id,
+		"client": client_id,
+		"scopes": sorted(set(scopes)),
+		"exp": int(time.time() + lifetime)
+	}
+	payload_data = _b64encode(json.dumps(payload, separators=(',', ':')).encode('utf-8'))
+	signed_data = TOKEN_VERSION + "." + payload_data
+	return signed_data + "." + _b64encode(_sign(signed_data.encode('ascii')))
+
+def verify_token(token):
+	"""
+	Verifies an access token. Returns the token's payload, which is a dict
+	with the following keys:
+	  - jti - the token's ID
+	  - account - ID of the account the token acts as
+	  - client - ID of the client the token was issued to
+	  - scopes - list of scopes granted to the token
+	  - exp - expiry date, as a UNIX timestamp
+
+	Raises a ValueError if the token is malformed, has an invalid signature,
+	has expired or has been revoked.
+	"""
+	try:
+		version, payload_data, signature = token.split('.')
+		if version != TOKEN_VERSION:
+			raise ValueError
+		expected_signature = _sign((version + "." + payload_data).encode('ascii'))
+		if not hmac.compare_digest(_b64decode(signature), expected_signature):
+			raise ValueError
+		payload = json.loads(_b64decode(payload_data))
+	except (ValueError, TypeError, UnicodeError):
+		raise ValueError("Invalid access token")
+
+	if payload['exp'] <= time.time():
+		raise ValueError("Access token has expired")
+	if payload['jti'] in _get_revoked():
+		raise ValueError("Access token has been revoked")
+	return payload
+
+def revoke_token(token):
+	"""
+	Revokes an access token. Returns the token's ID.
+
+	It takes up to token_revocation_refresh seconds for other workers to
+	notice the revocation.
+
+	Raises a ValueError if the token is invalid.
+	"""
+	payload = verify_token(token)
+	expires = datetime.datetime.utcfromtimestamp(payload['exp'])
+	db.add_revoked_token(payload['jti'], expires)
+	with _revoked_lock:
+		_revoked[payload['jti']] = payload['exp']
+	return payload['jti']
+
+def _get_revoked():
+	"""
+	Returns the cached revocation list, refreshing it from the database
+	if needed.
+	"""
+	global _revoked, _revoked_refreshed
+	refresh = config.get('token_revocation_refresh') or DEFAULT_REVOCATION_REFRESH
+	if _revoked_refreshed is None or time.monotonic() - _revoked_refreshed > refresh:
+		# Only one thread refreshes the list; the others keep using the
+		# old one in the meantime.
+		if _revoked_lock.acquire(blocking=False):
+			try:
+				revoked = db.get_revoked_tokens()
+				_revoked = {jti: expires.replace(tzinfo=datetime.timezone.utc).timestamp()
+				            for jti, expires in revoked.items()}
+				_revoked_refreshed = time.monotonic()
+			finally:
+				_revoked_lock.release()
+	return _revoked
+
+def has_scope(scope):
+	"""
+	Returns True if the access token used for the current request has the
+	given scope, False otherwise.
+	"""
+	token = g.get('token')
+	return bool(token) and scope in token['scopes']
+
+@app.before_request
+def authenticate_request():
+	"""
+	Verifies the access token passed in the Authorization header of API
+	requests, if any, and stores its payload in flask.g.token.
+
+	Requests without a token are let through with g.token set to None;
+	endpoints that need authentication check for it themselves.
+	"""
+	g.token = None
+	if not request.path.startswith('/api/'):
+		return None
+	authorization = request.headers.get('Authorization')
+	if not authorization:
+		return None
+	auth_type, _, token = authorization.partition(' ')
+	if auth_type.lower() != 'bearer' or not token:
+		return pings.response_from_error(12)
+	try:
+		g.token = verify_token(token.strip())
+	except ValueError as e:
+		return pings.response_from_error(12, error_message=e)
+	return None
@@ -2,6 +2,11 @@
 """
 Common utilities used in various modules.
 """
+from collections import OrderedDict
+import base64
+import simplejson as json
+import threading
+import time
 
 def missing_key_from_list_in_dict(test_list, test_dict):
 	"""
@@ -73,3 +78,78 @@ def powers_to_list(x):
 			powers.append(i)
 		i <<= 1
 	return powers
+
+def encode_cursor(values):
+	"""
+	Takes a list of values identifying the last item of a page and turns it
+	into an opaque cursor string, for use in keyset pagination.
+	"""
+	data = json.dumps(values, separators=(',', ':')).encode('utf-8')
+	return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def decode_cursor(cursor, length):
+	"""
+	Turns a cursor created with encode_cursor back into a list of values.
+
+	Raises a ValueError if the cursor is invalid or does not contain the
+	given amount of values.
+	"""
+	try:
+		values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+	except (ValueError, TypeError, UnicodeError):
+		raise ValueError("Invalid cursor")
+	if not isinstance(values, list) or len(values) != length:
+		raise ValueError("Invalid cursor")
+	return values
+
+class LRUCache:
+	"""
+	A small, thread-safe cache which drops the least recently used entries
+	once it's full.
+
+	Optional arguments:
+	  - maxsize (default: 1024) - maximum amount of entries in the cache
+	  - ttl (default: None) - if set, entries expire after the given amount
+	                          of seconds
+	"""
+	def __init__(self, maxsize=1024, ttl=None):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
+
+	def get(self, key, default=None):
+		"""
+		Returns the cached value for the given key, or the default if the
+		key is not cached.
+		"""
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is None:
+				return default
+			if entry[1] and entry[1] < time.monotonic():
+				del self.entries[key]
+				return default
+			self.entries.move_to_end(key)
+			return entry[0]
+
+	def set(self, key, value):
+		"""Caches a value under the given key."""
+		expires = None
+		if self.ttl:
+			expires = time.monotonic() + self.ttl
+		with self.lock:
+			self.entries[key] = (value, expires)
+			self.entries.move_to_end(key)
+			if len(self.entries) > self.maxsize:
+				self.entries.popitem(last=False)
+
+	def invalidate(self, key):
+		"""Removes the given key from the cache."""
+		with self.lock:
+			self.entries.pop(key, None)
+
+	def clear(self):
+		"""Removes all entries from the cache."""
+		with self.lock:
+			self.entries.clear()
@@ -0,0 +1,11 @@
+# coding: utf-8
+"""
+WSGI entry point for production servers:
+
+    $ gunicorn -c gunicorn.conf.py drywall.wsgi:app
+
+See docs/setup/production.md for more information.
+"""
+from drywall import create_app
+
+app = create_app()
@@ -0,0 +1,47 @@
+# coding: utf-8
+"""
+Gunicorn configuration for drywall. Gunicorn picks this file up by itself
+when started from the directory you cloned drywall into; run_production.sh
+does this for you.
+
+The app is loaded once, in the master process, before the workers are
+forked from it, so the workers share the loaded code instead of importing
+it again. Loading the app doesn't connect to the database, and every
+drywall module that keeps connections, locks or pools resets them after a
+fork (see db._after_fork), so workers never share database connections.
+
+Settings (in config.json); command line options passed to gunicorn take
+precedence over them:
+  - server_bind - address to listen on. Defaults to "127.0.0.1:8000".
+  - server_workers - amount of worker processes. Defaults to twice the
+                     amount of CPU cores, plus one.
+  - server_threads - amount of threads per worker. Defaults to 4. Keep
+                     db_pool_size at least this high, so that threads don't
+                     wait for database connections.
+  - server_keepalive - seconds to keep idle connections open for. Defaults
+                       to 5.
+"""
+# Gunicorn reads every name in this file as a setting, and "config" is one.
+from drywall import config as drywall_config
+
+import gc
+import multiprocessing
+
+bind = drywall_config.get('server_bind') or "127.0.0.1:8000"
+workers = drywall_config.get('server_workers') or multiprocessing.cpu_count() * 2 + 1
+# More than one thread makes gunicorn use the gthread worker, which also
+# supports keep-alive connections.
+threads = drywall_config.get('server_threads') or 4
+keepalive = drywall_config.get('server_keepalive') or 5
+preload_app = True
+
+def when_ready(server):
+	"""
+	Called in the master process after the app is loaded and before the
+	workers are forked. Moves every object that exists at this point into a
+	permanent generation that the garbage collector doesn't scan; otherwise,
+	the collector would touch all of them in each worker and, by updating
+	their reference counts, undo the memory sharing between the workers.
+	"""
+	gc.collect()
+	gc.freeze()
@@ -1,5 +1,9 @@
 #!/bin/sh
-# Minimal startup script for drywall
+# Minimal startup script for drywall, for development.
+# See run_production.sh for production.
 export FLASK_ENV=development
-export FLASK_APP=drywall.api
+export FLASK_APP="drywall:create_app()"
+flask migrate
+flask run-jobs &
+trap 'kill $!' EXIT
 flask run
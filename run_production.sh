@@ -0,0 +1,6 @@
+#!/bin/sh
+# Startup script for drywall in production; see docs/setup/production.md.
+# Options are passed to gunicorn, for example: ./run_production.sh -w 8
+export FLASK_APP="drywall:create_app()"
+flask migrate || exit 1
+exec gunicorn -c gunicorn.conf.py "$@" drywall.wsgi:app
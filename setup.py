@@ -23,5 +23,5 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=require,
-    extras_require={"test": ["pytest", "coverage"]},
+    extras_require={"test": ["pytest", "coverage"], "numpy": ["numpy"], "production": ["gunicorn"]},
 )
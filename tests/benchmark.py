@@ -0,0 +1,512 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Load benchmark for the /api/v1 routes.
+
+Seeds the configured database with a dataset built from the object shapes
+generated by test_objects.generate_objects, then drives every /api/v1 route
+with a configurable amount of concurrent clients. For every route, the
+latency percentiles (p50/p95/p99), requests per second and database queries
+per request are written to a JSON file.
+
+This writes a lot of objects to the database, so only run it against a
+throwaway database (see tests/test_runner.sh for how to set one up). Run it
+from the directory you cloned drywall into:
+
+    $ python3 tests/benchmark.py --concurrency 8 --requests 200
+
+By default, requests are sent to the app in-process through Flask's test
+client. To benchmark a running server instead, pass its address with --url;
+the server must use the same database and secret as the benchmark, and DB
+query counts are not available in this mode. Rate limits are turned off for
+in-process runs; a server has to be started with an empty rate_limits
+setting instead.
+
+Requests are authenticated with an access token for the account that owns
+every seeded conference, so that permission checks pass.
+"""
+from drywall import db
+from drywall import objects
+from drywall import app
+from drywall import ratelimit
+from drywall import tokens
+import drywall.api
+from conftest import QueryCounter
+from test_objects import generate_objects
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib import request as urlrequest
+from urllib.error import HTTPError
+from urllib.parse import quote
+from uuid import uuid4
+import argparse
+import datetime
+import math
+import random
+import simplejson as json
+import sys
+import threading
+import time
+
+# Object types that placeholders in route rules refer to.
+PLACEHOLDER_TYPES = {
+	"object_id": "message",
+	"account_id": "account",
+	"conference_id": "conference",
+	"member_id": "conference_member",
+	"channel_id": "channel",
+	"message_id": "message",
+	"invite_id": "invite",
+	"role_id": "role",
+	"report_id": "report"
+}
+
+# Values for placeholders in route rules that don't refer to objects.
+PLACEHOLDER_VALUES = {
+	"emoji": lambda: random.choice(["👍", "🎉", ":custom:"])
+}
+
+# Object types created by POST requests to collection routes, by the last
+# segment of the route.
+COLLECTION_TYPES = {
+	"id": "message",
+	"accounts": "account",
+	"conferences": "conference",
+	"members": "conference_member",
+	"channels": "channel",
+	"messages": "message",
+	"invites": "invite",
+	"roles": "role",
+	"reports": "report"
+}
+
+# Object types which are created inside of a conference.
+CONFERENCE_CHILD_TYPES = ["conference_member", "channel", "invite", "role"]
+
+# Bodies for PATCH requests, by object type.
+PATCH_BODIES = {
+	"account": lambda: {"bio": "bio_" + str(uuid4())},
+	"conference": lambda: {"name": "name_" + str(uuid4())},
+	"conference_member": lambda: {"nickname": "nickname_" + str(uuid4())},
+	"channel": lambda: {"name": "name_" + str(uuid4())},
+	"message": lambda: {"content": "content_" + str(uuid4())},
+	"invite": lambda: {"code": "code_" + str(uuid4())},
+	"role": lambda: {"name": "name_" + str(uuid4())},
+	"report": lambda: {"note": "note_" + str(uuid4())}
+}
+
+# Query strings for GET routes that need them, by route rule.
+ROUTE_QUERY_STRINGS = {
+	'/api/v1/search/messages': lambda dataset: "q=content",
+	'/api/v1/search/accounts': lambda dataset: "q=username_string_",
+	'/api/v1/search/conferences': lambda dataset: "q=" + quote(db.get_object_as_dict_by_id(dataset.ids['conference'][0])['name'][:3]),
+	'/api/v1/reports': lambda dataset: "conference=" + dataset.ids['conference'][0]
+}
+
+#
+# Dataset
+#
+
+class Dataset:
+	"""
+	Creates and keeps track of the objects used during the benchmark.
+
+	Every object is created from the shape of the matching object generated
+	by test_objects.generate_objects, with IDs pointing to other objects in
+	the dataset and fresh values for unique keys.
+	"""
+	def __init__(self):
+		self.shapes = generate_objects()[0]
+		self.ids = {object_type: [] for object_type in objects.object_types}
+		# Account that owns every conference; requests are made as this account.
+		self.owner = None
+		# conference ID: {object type: [IDs]}
+		self.children = {}
+
+	def example(self, object_type, conference_id=None, **overrides):
+		"""
+		Returns an object dict of the given type, ready to be POSTed or
+		turned into an object.
+		"""
+		object_class = objects.get_object_class_by_type(object_type)
+		object_dict = self.shapes[object_type].copy()
+		object_dict.pop('id', None)
+		for key in object_class.unique_keys:
+			object_dict[key] = key + "_string_" + str(uuid4())
+
+		if not conference_id and self.children:
+			conference_id = random.choice(list(self.children.keys()))
+		children = self.children.get(conference_id, {})
+		if object_type == "conference":
+			object_dict['owner'] = self.owner or random.choice(self.ids['account'])
+		elif object_type == "conference_member":
+			# Every member gets a fresh account unless told otherwise, so
+			# that we never add the same account to a conference twice.
+			if 'user_id' not in overrides:
+				object_dict['user_id'] = self.create("account", track=False)
+			object_dict['parent_conference'] = conference_id
+			object_dict['roles'] = children['role'][:1]
+		elif object_type == "channel":
+			object_dict['parent_conference'] = conference_id
+		elif object_type == "role":
+			object_dict['parent_conference'] = conference_id
+		elif object_type == "invite":
+			object_dict['conference_id'] = conference_id
+			object_dict['creator'] = random.choice(self.ids['account'])
+		elif object_type == "message":
+			object_dict['parent_channel'] = random.choice(children['channel'])
+			# Messages can only be posted and edited by their author
+			object_dict['author'] = self.owner or random.choice(self.ids['account'])
+		elif object_type == "report":
+			object_dict['target'] = random.choice(self.ids['message'])
+
+		object_dict.update(overrides)
+		return object_dict
+
+	def create(self, object_type, conference_id=None, track=True, **overrides):
+		"""
+		Creates an object of the given type in the database. Returns its ID.
+
+		If track is False, the object is not added to the dataset, and thus
+		will not be picked as a target or referenced by other objects.
+		"""
+		object_dict = self.example(object_type, conference_id, **overrides)
+		object = objects.make_object_from_dict(object_dict)
+		db.add_object(object)
+		if track:
+			self.ids[object_type].append(object.id)
+			if object_type in CONFERENCE_CHILD_TYPES:
+				conference_id = object_dict.get('parent_conference') or object_dict.get('conference_id')
+				self.children[conference_id][object_type].append(object.id)
+		return object.id
+
+	def seed(self, conferences, members, channels, messages):
+		"""
+		Seeds the database. Every conference gets the given amount of members
+		and channels, and every channel gets the given amount of messages.
+		"""
+		self.owner = self.create("account")
+		for i in range(max(2, members)):
+			self.create("account")
+		for i in range(conferences):
+			conference_id = self.create("conference")
+			self.children[conference_id] = {t: [] for t in CONFERENCE_CHILD_TYPES}
+			for _i in range(2):
+				self.create("role", conference_id)
+			for account_id in random.sample(self.ids['account'], min(members, len(self.ids['account']))):
+				self.create("conference_member", conference_id, user_id=account_id)
+			for _i in range(channels):
+				self.create("channel", conference_id)
+			for _i in range(2):
+				self.create("invite", conference_id)
+			for _i in range(channels * messages):
+				self.create("message", conference_id)
+
+			# Fill in the conference's ID lists, like clients would
+			children = self.children[conference_id]
+			conference_dict = db.get_object_as_dict_by_id(conference_id)
+			conference_dict['channels'] = children['channel']
+			conference_dict['roles'] = children['role']
+			conference_dict['users'] = [db.get_object_as_dict_by_id(member_id)['user_id'] for member_id in children['conference_member']]
+			db.push_object(conference_id, objects.make_object_from_dict(conference_dict, extend=conference_id))
+		for i in range(conferences * 2):
+			self.create("report")
+
+	def pick(self, object_type, conference_id=None):
+		"""Returns a random ID of an object of the given type."""
+		if conference_id:
+			return random.choice(self.children[conference_id][object_type])
+		return random.choice(self.ids[object_type])
+
+	def counts(self):
+		"""Returns the amount of seeded objects of each type."""
+		return {object_type: len(ids) for object_type, ids in self.ids.items()}
+
+#
+# Routes
+#
+
+class SkipRoute(Exception):
+	"""Raised when no requests can be built for a route."""
+
+def api_routes():
+	"""Returns a list of (rule, method) tuples for every /api/v1 route."""
+	routes = []
+	for rule in app.url_map.iter_rules():
+		if not rule.rule.startswith('/api/v1'):
+			continue
+		for method in sorted(rule.methods - {'HEAD', 'OPTIONS'}):
+			routes.append((rule, method))
+	return sorted(routes, key=lambda route: (route[0].rule, route[1]))
+
+def build_request(dataset, rule, method):
+	"""
+	Builds a request for the given route. Returns a tuple with the filled-in
+	path and the JSON body (or None).
+
+	Raises SkipRoute if the route is not supported by the benchmark.
+	"""
+	path = rule.rule
+	body = None
+	arguments = rule.arguments
+
+	for placeholder in arguments & set(PLACEHOLDER_VALUES.keys()):
+		path = path.replace('<' + placeholder + '>', quote(PLACEHOLDER_VALUES[placeholder]()))
+	arguments = arguments - set(PLACEHOLDER_VALUES.keys())
+
+	unknown = arguments - set(PLACEHOLDER_TYPES.keys())
+	if unknown:
+		raise SkipRoute("unknown placeholders: " + ", ".join(sorted(unknown)))
+
+	# Routes like /api/v1/conferences/<conference_id>(/report) target the
+	# conference itself; the rest of the conference routes target its children.
+	targets_conference = rule.rule.endswith('<conference_id>') or rule.rule.endswith('<conference_id>/report')
+	target_type = None
+	if targets_conference:
+		target_type = 'conference'
+
+	conference_id = None
+	if 'conference_id' in arguments:
+		if targets_conference and method == 'DELETE':
+			# Deleted objects have to be fresh, as other objects may refer
+			# to the seeded ones.
+			conference_id = dataset.create('conference', track=False)
+		else:
+			conference_id = dataset.pick('conference')
+		path = path.replace('<conference_id>', conference_id)
+
+	for placeholder in arguments - {'conference_id'}:
+		target_type = PLACEHOLDER_TYPES[placeholder]
+		if method == 'DELETE':
+			target_id = dataset.create(target_type, conference_id, track=False)
+		elif conference_id and target_type in CONFERENCE_CHILD_TYPES:
+			target_id = dataset.pick(target_type, conference_id)
+		else:
+			target_id = dataset.pick(target_type)
+		path = path.replace('<' + placeholder + '>', target_id)
+
+	if method == 'POST':
+		if rule.rule.endswith('/report'):
+			body = {"note": "note_" + str(uuid4())}
+		elif rule.rule.endswith('/read'):
+			body = {}
+		elif rule.rule == '/api/v1/stash/request':
+			id_list = []
+			for object_type in ['account', 'conference', 'channel', 'message']:
+				id_list += random.sample(dataset.ids[object_type], min(5, len(dataset.ids[object_type])))
+			body = {"id_list": id_list}
+		elif rule.rule == '/api/v1/direct_messages':
+			# After the first request for each account, this finds an existing channel
+			body = {"members": [random.choice([id for id in dataset.ids['account'] if id != dataset.owner])]}
+		else:
+			collection = rule.rule.rstrip('/').split('/')[-1]
+			if collection not in COLLECTION_TYPES:
+				raise SkipRoute("unknown collection: " + collection)
+			body = dataset.example(COLLECTION_TYPES[collection], conference_id)
+	elif method == 'PATCH':
+		if target_type not in PATCH_BODIES:
+			raise SkipRoute("no PATCH body for " + str(target_type))
+		body = PATCH_BODIES[target_type]()
+	elif method == 'GET' and rule.rule in ROUTE_QUERY_STRINGS:
+		path = path + '?' + ROUTE_QUERY_STRINGS[rule.rule](dataset)
+
+	return (path, body)
+
+#
+# Runners
+#
+
+class InProcessRunner:
+	"""Sends requests to the app through Flask's test client."""
+	mode = "in-process"
+
+	def __init__(self, token):
+		app.config['TESTING'] = True
+		self.token = token
+		self.local = threading.local()
+
+	def send(self, method, path, body):
+		"""
+		Sends a request. Returns a tuple with the status code and the amount
+		of queries it took.
+		"""
+		if not hasattr(self.local, 'client'):
+			self.local.client = app.test_client()
+			self.local.client.environ_base['HTTP_AUTHORIZATION'] = "Bearer " + self.token
+		with QueryCounter() as queries:
+			response = self.local.client.open(path, method=method, json=body)
+		return (response.status_code, queries.count)
+
+class HTTPRunner:
+	"""Sends requests to a running server."""
+	mode = "http"
+
+	def __init__(self, url, token):
+		self.url = url.rstrip('/')
+		self.token = token
+
+	def send(self, method, path, body):
+		"""
+		Sends a request. Returns a tuple with the status code and None, as
+		the queries can't be counted from here.
+		"""
+		data = None
+		headers = {"Authorization": "Bearer " + self.token}
+		if body is not None:
+			data = json.dumps(body).encode('utf-8')
+			headers['Content-Type'] = 'application/json'
+		http_request = urlrequest.Request(self.url + path, data=data, headers=headers, method=method)
+		try:
+			with urlrequest.urlopen(http_request) as response:
+				response.read()
+				return (response.status, None)
+		except HTTPError as e:
+			return (e.code, None)
+
+#
+# Statistics
+#
+
+def percentile(sorted_values, percent):
+	"""
+	Returns the given percentile of a sorted list using the nearest-rank
+	method. Returns None if the list is empty.
+	"""
+	if not sorted_values:
+		return None
+	rank = max(0, math.ceil(percent / 100 * len(sorted_values)) - 1)
+	return sorted_values[rank]
+
+def summarize(timings):
+	"""Turns a list of timings (in seconds) to a dict of latencies in ms."""
+	timings = sorted(t * 1000 for t in timings)
+	if not timings:
+		return None
+	return {
+		"mean": round(sum(timings) / len(timings), 3),
+		"p50": round(percentile(timings, 50), 3),
+		"p95": round(percentile(timings, 95), 3),
+		"p99": round(percentile(timings, 99), 3),
+		"max": round(timings[-1], 3)
+	}
+
+def run_route(runner, prepared, concurrency):
+	"""
+	Sends the prepared requests with the given concurrency. Returns a dict
+	with the results.
+	"""
+	def _send(request_info):
+		method, path, body = request_info
+		start = time.perf_counter()
+		status, queries = runner.send(method, path, body)
+		return (time.perf_counter() - start, status, queries)
+
+	start = time.perf_counter()
+	with ThreadPoolExecutor(max_workers=concurrency) as executor:
+		results = list(executor.map(_send, prepared))
+	elapsed = time.perf_counter() - start
+
+	timings = [result[0] for result in results]
+	errors = len([result for result in results if result[1] >= 400])
+	queries = [result[2] for result in results if result[2] is not None]
+	return {
+		"requests": len(results),
+		"errors": errors,
+		"rps": round(len(results) / elapsed, 2) if elapsed else None,
+		"latency_ms": summarize(timings),
+		"queries_per_request": {
+			"mean": round(sum(queries) / len(queries), 2),
+			"max": max(queries)
+		} if queries else None
+	}
+
+def main():
+	parser = argparse.ArgumentParser(description="Load benchmark for the drywall API.")
+	parser.add_argument('--concurrency', type=int, default=4,
+	                    help="amount of concurrent clients (default: 4)")
+	parser.add_argument('--requests', type=int, default=100,
+	                    help="amount of measured requests per route (default: 100)")
+	parser.add_argument('--warmup', type=int, default=10,
+	                    help="amount of unmeasured requests per route (default: 10)")
+	parser.add_argument('--conferences', type=int, default=4,
+	                    help="amount of seeded conferences (default: 4)")
+	parser.add_argument('--members', type=int, default=25,
+	                    help="amount of members per conference (default: 25)")
+	parser.add_argument('--channels', type=int, default=4,
+	                    help="amount of channels per conference (default: 4)")
+	parser.add_argument('--messages', type=int, default=50,
+	                    help="amount of messages per channel (default: 50)")
+	parser.add_argument('--route', action='append', default=[],
+	                    help="only benchmark routes containing this string (can be repeated)")
+	parser.add_argument('--url', default=None,
+	                    help="benchmark a running server at this address instead of the app in-process")
+	parser.add_argument('--output', default='benchmark.json',
+	                    help="file to write the results to (default: benchmark.json)")
+	args = parser.parse_args()
+
+	drywall.create_app()
+	db.init_db()
+	drywall.api.push_instance()
+
+	print("Seeding the database...", file=sys.stderr)
+	dataset = Dataset()
+	dataset.seed(args.conferences, args.members, args.channels, args.messages)
+
+	token = tokens.issue_token(dataset.owner, "benchmark", list(objects.Permissions.scopes),
+	                           lifetime=7 * 24 * 3600)
+	if args.url:
+		runner = HTTPRunner(args.url, token)
+	else:
+		# Every request comes from the same account and address, so rate
+		# limits would turn most of them down.
+		ratelimit.configure({})
+		runner = InProcessRunner(token)
+
+	results = []
+	skipped = []
+	total_requests = 0
+	total_errors = 0
+	total_time = 0
+	for rule, method in api_routes():
+		if args.route and not [r for r in args.route if r in rule.rule]:
+			continue
+		try:
+			prepared = []
+			for i in range(args.warmup + args.requests):
+				path, body = build_request(dataset, rule, method)
+				prepared.append((method, path, body))
+		except SkipRoute as e:
+			skipped.append({"method": method, "route": rule.rule, "reason": str(e)})
+			continue
+
+		print("  * " + method + " " + rule.rule, file=sys.stderr)
+		if args.warmup:
+			run_route(runner, prepared[:args.warmup], args.concurrency)
+		result = run_route(runner, prepared[args.warmup:], args.concurrency)
+		results.append({"method": method, "route": rule.rule, **result})
+		total_requests += result['requests']
+		total_errors += result['errors']
+		if result['rps']:
+			total_time += result['requests'] / result['rps']
+
+	report = {
+		"drywall_version": drywall.api.VERSION,
+		"date": datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc).isoformat(),
+		"mode": runner.mode,
+		"concurrency": args.concurrency,
+		"requests_per_route": args.requests,
+		"dataset": dataset.counts(),
+		"totals": {
+			"requests": total_requests,
+			"errors": total_errors,
+			"rps": round(total_requests / total_time, 2) if total_time else None
+		},
+		"routes": results,
+		"skipped": skipped
+	}
+	with open(args.output, 'w') as output:
+		output.write(json.dumps(report, indent=2))
+	print("Results written to " + args.output, file=sys.stderr)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Benchmark for containment and overlap queries on list keys.
+
+Seeds the configured database with accounts that have friends and
+messages that mention accounts and have attached files, then times the
+list operators of db.get_object_by_key_value_pair (@>, && and <@) on
+those keys, first with the GIN indexes generated by utils/alchemify.py
+and then without them (the indexes are dropped in a transaction that is
+rolled back afterwards). Inserting a batch of messages is timed the same
+way, since every GIN index makes writes to its key more expensive.
+
+The defaults are meant to resemble a busy instance: most messages don't
+mention anyone or have files, while accounts have a few dozen friends.
+
+Results are written to a JSON file. This writes a lot of objects to the
+database, so only run it against a throwaway database:
+
+    $ python3 tests/benchmark_arrays.py --accounts 20000 --messages 200000
+"""
+from drywall import db
+from drywall import db_models as models
+
+from sqlalchemy import insert, select, text
+from uuid import uuid4
+import argparse
+import datetime
+import random
+import simplejson as json
+import sys
+import time
+
+# Size of the batches rows are inserted in.
+CHUNK_SIZE = 5000
+
+def new_id():
+	return str(uuid4())
+
+def insert_rows(connection, model, rows):
+	"""Inserts rows into the table of a model, in chunks."""
+	for start in range(0, len(rows), CHUNK_SIZE):
+		connection.execute(insert(model.__table__), rows[start:start + CHUNK_SIZE])
+
+def make_messages(channel_ids, account_ids, file_ids, count, args):
+	"""Returns rows for count messages, mentioning accounts and attaching files as often as configured."""
+	now = datetime.datetime.utcnow()
+	rows = []
+	for i in range(count):
+		mentions = []
+		if random.random() < args.mention_rate:
+			mentions = random.sample(account_ids, random.randint(1, args.max_mentions))
+		attached_files = []
+		if random.random() < args.file_rate:
+			attached_files = [random.choice(file_ids)]
+		rows.append({"id": new_id(), "content": "benchmark", "parent_channel": random.choice(channel_ids),
+			"author": random.choice(account_ids), "post_date": now, "edited": False,
+			"mentions": mentions, "attached_files": attached_files})
+	return rows
+
+def seed(connection, args):
+	"""
+	Seeds the database with the given amount of accounts and messages, in
+	one conference. Rows are inserted directly, skipping object validation,
+	since validating every ID would take longer than the benchmark itself.
+	Returns a tuple with the channel IDs, account IDs and attachment IDs.
+	"""
+	account_ids = [new_id() for i in range(args.accounts)]
+	conference_id = new_id()
+	channel_ids = [new_id() for i in range(args.channels)]
+	# Attachments are only referenced by ID here
+	file_ids = [new_id() for i in range(max(1, args.messages // 20))]
+
+	insert_rows(connection, models.Objects, [{"id": id, "object_type": "account"} for id in account_ids] +
+		[{"id": conference_id, "object_type": "conference"}] +
+		[{"id": id, "object_type": "channel"} for id in channel_ids])
+	insert_rows(connection, models.Account, [{"id": id, "username": "arrays_" + id, "short_status": 0,
+		"friends": random.sample(account_ids, min(args.friends, len(account_ids)))} for id in account_ids])
+	connection.execute(insert(models.Conference.__table__), {"id": conference_id, "name": "Benchmark",
+		"icon": "icon", "owner": account_ids[0], "permissions": 1, "creation_date": datetime.datetime.utcnow()})
+	insert_rows(connection, models.Channel, [{"id": id, "name": "benchmark", "channel_type": "text",
+		"parent_conference": conference_id, "permissions": 1} for id in channel_ids])
+
+	messages = make_messages(channel_ids, account_ids, file_ids, args.messages, args)
+	insert_rows(connection, models.Objects, [{"id": message['id'], "object_type": "message"} for message in messages])
+	insert_rows(connection, models.Message, messages)
+	return (channel_ids, account_ids, file_ids)
+
+def get_cases(account_ids, file_ids):
+	"""
+	Returns a dict with case names as keys and (model, key, operator,
+	function returning a random value) tuples as values.
+	"""
+	return {
+		"message_mentions_contains": (models.Message, "mentions", "contains",
+			lambda: [random.choice(account_ids)]),
+		"message_mentions_overlaps": (models.Message, "mentions", "overlaps",
+			lambda: random.sample(account_ids, 5)),
+		"message_attached_files_contains": (models.Message, "attached_files", "contains",
+			lambda: [random.choice(file_ids)]),
+		"account_friends_contains": (models.Account, "friends", "contains",
+			lambda: [random.choice(account_ids)]),
+		"account_friends_contains_two": (models.Account, "friends", "contains",
+			lambda: random.sample(account_ids, 2)),
+		"account_friends_overlaps": (models.Account, "friends", "overlaps",
+			lambda: random.sample(account_ids, 10)),
+		"account_friends_contained_by": (models.Account, "friends", "contained_by",
+			lambda: random.sample(account_ids, 10))
+	}
+
+def time_case(connection, case, samples, repeat):
+	"""
+	Runs the query for a case with every sampled value, repeat times.
+	Returns a tuple with the best mean time per query in ms, the mean
+	amount of matches and whether the plan uses an index.
+	"""
+	model, key, operator, values = case
+	column = getattr(model, key)
+	queries = [select(model.id).where(db.KEY_OPERATORS[operator](column, value)) for value in samples]
+	best = None
+	matches = 0
+	for i in range(repeat):
+		start = time.perf_counter()
+		matches = sum(len(connection.execute(query).all()) for query in queries)
+		elapsed = (time.perf_counter() - start) * 1000 / len(queries)
+		if best is None or elapsed < best:
+			best = elapsed
+	compiled = queries[0].compile(connection)
+	plan = "\n".join(row[0] for row in connection.exec_driver_sql("EXPLAIN " + str(compiled),
+		compiled.params if isinstance(compiled.params, dict) else ()))
+	return (round(best, 3), round(matches / len(queries), 1), "Index" in plan)
+
+def time_insert(connection, rows):
+	"""Inserts message rows and returns the time it took, in ms."""
+	start = time.perf_counter()
+	insert_rows(connection, models.Objects, [{"id": row['id'], "object_type": "message"} for row in rows])
+	insert_rows(connection, models.Message, rows)
+	return round((time.perf_counter() - start) * 1000, 3)
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark for containment and overlap queries on list keys.")
+	parser.add_argument('--accounts', type=int, default=20000,
+	                    help="amount of accounts (default: 20000)")
+	parser.add_argument('--friends', type=int, default=50,
+	                    help="amount of friends of every account (default: 50)")
+	parser.add_argument('--channels', type=int, default=50,
+	                    help="amount of channels the messages are spread over (default: 50)")
+	parser.add_argument('--messages', type=int, default=200000,
+	                    help="amount of messages (default: 200000)")
+	parser.add_argument('--mention-rate', type=float, default=0.1,
+	                    help="share of messages that mention accounts (default: 0.1)")
+	parser.add_argument('--max-mentions', type=int, default=3,
+	                    help="maximum amount of accounts mentioned by a message (default: 3)")
+	parser.add_argument('--file-rate', type=float, default=0.05,
+	                    help="share of messages with an attached file (default: 0.05)")
+	parser.add_argument('--samples', type=int, default=20,
+	                    help="amount of random values queried for every case (default: 20)")
+	parser.add_argument('--insert-batch', type=int, default=5000,
+	                    help="amount of messages in the timed insert (default: 5000)")
+	parser.add_argument('--repeat', type=int, default=5,
+	                    help="amount of runs for every case; the best one is kept (default: 5)")
+	parser.add_argument('--output', default='benchmark_arrays.json',
+	                    help="file to write the results to (default: benchmark_arrays.json)")
+	args = parser.parse_args()
+
+	db.init_db()
+	engine = db.get_engine()
+	print("Seeding the database...", file=sys.stderr)
+	with engine.begin() as connection:
+		channel_ids, account_ids, file_ids = seed(connection, args)
+	# Also moves the seeded rows out of the GIN indexes' pending lists, as
+	# autovacuum would on a live instance
+	with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+		connection.exec_driver_sql("VACUUM ANALYZE account")
+		connection.exec_driver_sql("VACUUM ANALYZE message")
+
+	cases = get_cases(account_ids, file_ids)
+	samples = {name: [case[3]() for i in range(args.samples)] for name, case in cases.items()}
+	insert_batch = make_messages(channel_ids, account_ids, file_ids, args.insert_batch, args)
+	# The GIN indexes on list keys of the benchmarked tables
+	index_names = [index.name for model in [models.Account, models.Message] for index in model.__table__.indexes
+	               if index.dialect_options['postgresql']['using'] == 'gin' and index.name != 'ix_message_search_vector']
+
+	results = {}
+	for indexed in [True, False]:
+		label = "indexed" if indexed else "unindexed"
+		print("Timing queries (" + label + ")...", file=sys.stderr)
+		with engine.connect() as connection:
+			transaction = connection.begin()
+			try:
+				if not indexed:
+					for index_name in index_names:
+						connection.execute(text('DROP INDEX IF EXISTS "' + index_name + '"'))
+				for name, case in cases.items():
+					query_ms, matches, uses_index = time_case(connection, case, samples[name], args.repeat)
+					results.setdefault(name, {"operator": case[2], "mean_matches": matches})
+					results[name][label + "_ms"] = query_ms
+					results[name][label + "_uses_index"] = uses_index
+				results.setdefault("insert_messages", {"batch": args.insert_batch})
+				results["insert_messages"][label + "_ms"] = time_insert(connection,
+					[dict(row, id=new_id()) for row in insert_batch])
+			finally:
+				# Restores the dropped indexes and removes the inserted messages
+				transaction.rollback()
+
+	for result in results.values():
+		if result.get("indexed_ms"):
+			result["speedup"] = round(result["unindexed_ms"] / result["indexed_ms"], 1)
+
+	report = {
+		"date": datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc).isoformat(),
+		"accounts": args.accounts,
+		"friends": args.friends,
+		"messages": args.messages,
+		"mention_rate": args.mention_rate,
+		"file_rate": args.file_rate,
+		"results": results
+	}
+	with open(args.output, 'w') as output:
+		output.write(json.dumps(report, indent=2))
+	print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+	main()
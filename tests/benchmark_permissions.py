@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Benchmark for bulk permission evaluation.
+
+Seeds the configured database with one conference with many members and
+roles, then compares ways of finding out which members can read a
+channel:
+  - per_member - calling permissions.get_permissions for every member with
+                 a cold cache (only a sample of the members is timed; the
+                 total is extrapolated),
+  - audience - permissions.get_channel_audience with a cold cache, which
+               loads the conference's permission data in one go and
+               evaluates every member at once,
+  - audience_other_channel - the same for another channel in the same
+                             conference, which reuses the evaluated members
+                             and only applies the channel's permissions,
+  - evaluation only - the in-memory part of the above, with NumPy and with
+                      the pure Python fallback.
+
+Results are written to a JSON file. This writes a lot of objects to the
+database, so only run it against a throwaway database:
+
+    $ python3 tests/benchmark_permissions.py --members 20000 --roles 20
+"""
+from drywall import db
+from drywall import db_models as models
+from drywall import permissions
+
+from sqlalchemy.orm import Session
+from uuid import uuid4
+import argparse
+import datetime
+import random
+import simplejson as json
+import sys
+import time
+
+def new_id():
+	return str(uuid4())
+
+def seed(member_count, role_count, roles_per_member):
+	"""
+	Seeds a conference with the given amount of members and roles, plus two
+	text channels. Objects are inserted directly through the ORM, skipping
+	object validation, since validating every ID would take longer than the
+	benchmark itself. Returns a tuple with the channel IDs, the conference
+	ID and a list of account IDs of the members.
+	"""
+	owner_id = new_id()
+	conference_id = new_id()
+	channel_ids = [new_id(), new_id()]
+	role_ids = [new_id() for i in range(role_count)]
+	account_ids = [new_id() for i in range(member_count)]
+
+	with Session(db.engine) as session:
+		session.add(models.Account(id=owner_id, username="owner_" + owner_id, short_status=0))
+		session.add(models.Objects(id=owner_id, object_type="account"))
+		session.flush()
+		session.add(models.Conference(id=conference_id, name="Benchmark", icon="icon",
+			owner=owner_id, permissions=1, creation_date=datetime.datetime.utcnow(),
+			roles=role_ids))
+		session.add(models.Objects(id=conference_id, object_type="conference"))
+		session.flush()
+		for channel_id in channel_ids:
+			session.add(models.Channel(id=channel_id, name="benchmark", channel_type="text",
+				parent_conference=conference_id, permissions=permissions.CHANNEL_PERMISSIONS))
+			session.add(models.Objects(id=channel_id, object_type="channel"))
+		for role_id in role_ids:
+			session.add(models.Role(id=role_id, name="role", color="100, 100, 100",
+				parent_conference=conference_id, permissions=random.choice([0, 2, 4, 6, 512])))
+			session.add(models.Objects(id=role_id, object_type="role"))
+		session.flush()
+
+		for account_id in account_ids:
+			member_id = new_id()
+			session.add(models.Account(id=account_id, username="member_" + account_id, short_status=0))
+			session.add(models.Objects(id=account_id, object_type="account"))
+			session.add(models.ConferenceMember(id=member_id, user_id=account_id,
+				parent_conference=conference_id, permissions=random.choice([0, 0, 2]),
+				roles=random.sample(role_ids, min(roles_per_member, len(role_ids))),
+				banned=random.random() < 0.01))
+			session.add(models.Objects(id=member_id, object_type="conference_member"))
+		session.commit()
+	return (channel_ids, conference_id, account_ids)
+
+def timed(function, repeat):
+	"""Runs a function repeat times and returns the best time, in ms."""
+	best = None
+	for i in range(repeat):
+		start = time.perf_counter()
+		function()
+		elapsed = (time.perf_counter() - start) * 1000
+		if best is None or elapsed < best:
+			best = elapsed
+	return round(best, 3)
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark for bulk permission evaluation.")
+	parser.add_argument('--members', type=int, default=20000,
+	                    help="amount of members in the conference (default: 20000)")
+	parser.add_argument('--roles', type=int, default=20,
+	                    help="amount of roles in the conference (default: 20)")
+	parser.add_argument('--roles-per-member', type=int, default=3,
+	                    help="amount of roles assigned to every member (default: 3)")
+	parser.add_argument('--sample', type=int, default=500,
+	                    help="amount of members timed on the per-member path (default: 500)")
+	parser.add_argument('--repeat', type=int, default=5,
+	                    help="amount of runs for the bulk paths; the best one is kept (default: 5)")
+	parser.add_argument('--output', default='benchmark_permissions.json',
+	                    help="file to write the results to (default: benchmark_permissions.json)")
+	args = parser.parse_args()
+
+	db.init_db()
+	print("Seeding the database...", file=sys.stderr)
+	channel_ids, conference_id, account_ids = seed(args.members, args.roles, args.roles_per_member)
+
+	print("Timing the per-member path...", file=sys.stderr)
+	channel_id = channel_ids[0]
+	sample = random.sample(account_ids, min(args.sample, len(account_ids)))
+	permissions.invalidate()
+	start = time.perf_counter()
+	expected = set()
+	for account_id in sample:
+		if permissions.get_permissions(account_id, channel_id) & permissions.READ_PERMISSIONS == permissions.READ_PERMISSIONS:
+			expected.add(account_id)
+	per_member = (time.perf_counter() - start) * 1000 / len(sample)
+
+	print("Timing the bulk path...", file=sys.stderr)
+	def _audience():
+		permissions.invalidate()
+		return permissions.get_channel_audience(channel_id)
+	audience = set(_audience())
+	if expected != audience.intersection(sample):
+		raise Exception("Bulk and per-member results differ")
+	audience_time = timed(_audience, args.repeat)
+
+	def _audience_other_channel():
+		permissions._audiences.clear()
+		return permissions.get_channel_audience(channel_ids[1])
+	other_channel_time = timed(_audience_other_channel, args.repeat)
+
+	print("Timing evaluation only...", file=sys.stderr)
+	conference = db.get_object_as_dict_by_id(conference_id)
+	members, role_values = db.get_conference_permission_data(conference_id)
+	evaluation = {}
+	numpy = permissions.numpy
+	if numpy is not None:
+		evaluation['numpy'] = timed(lambda: permissions.evaluate_members(conference, members, role_values), args.repeat)
+	permissions.numpy = None
+	try:
+		evaluation['python'] = timed(lambda: permissions.evaluate_members(conference, members, role_values), args.repeat)
+	finally:
+		permissions.numpy = numpy
+
+	report = {
+		"date": datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc).isoformat(),
+		"members": args.members,
+		"roles": args.roles,
+		"roles_per_member": args.roles_per_member,
+		"audience_size": len(audience),
+		"per_member_ms": {
+			"per_member": round(per_member, 3),
+			"all_members_extrapolated": round(per_member * args.members, 3)
+		},
+		"audience_ms": audience_time,
+		"audience_other_channel_ms": other_channel_time,
+		"evaluation_only_ms": evaluation
+	}
+	with open(args.output, 'w') as output:
+		output.write(json.dumps(report, indent=2))
+	print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+	main()
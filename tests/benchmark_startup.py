@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Benchmark for worker startup.
+
+Starts a fresh interpreter for every run and measures, in it:
+  - import - importing drywall.api,
+  - create_app - calling drywall.create_app,
+  - first_request - the first request to /api/v1/instance, which opens the
+                    first database connection,
+  - fork_first_request - forking the process after the first request and
+                         making a request in the child, the way a pre-fork
+                         server's workers start.
+The time it takes to start an interpreter that does nothing is measured as
+well, for reference. For every step, the median and the best time are
+written to a JSON file.
+
+The database has to be set up (flask init-db) before running this:
+
+    $ python3 tests/benchmark_startup.py --runs 20
+"""
+import argparse
+import datetime
+import os
+import simplejson as json
+import statistics
+import subprocess
+import sys
+import time
+
+def child():
+	"""Measures the startup steps in this process and prints the results."""
+	results = {}
+	start = time.perf_counter()
+	import drywall
+	import drywall.api # noqa: F401
+	results['import'] = time.perf_counter() - start
+
+	start = time.perf_counter()
+	app = drywall.create_app()
+	results['create_app'] = time.perf_counter() - start
+
+	client = app.test_client()
+	start = time.perf_counter()
+	response = client.get('/api/v1/instance')
+	results['first_request'] = time.perf_counter() - start
+	if response.status_code != 200:
+		raise Exception("First request failed: " + response.status)
+
+	read_end, write_end = os.pipe()
+	start = time.perf_counter()
+	pid = os.fork()
+	if pid == 0:
+		os.close(read_end)
+		status = app.test_client().get('/api/v1/instance').status_code
+		os.write(write_end, str(status).encode('ascii'))
+		os._exit(0)
+	os.close(write_end)
+	status = os.read(read_end, 16)
+	results['fork_first_request'] = time.perf_counter() - start
+	os.waitpid(pid, 0)
+	if status != b"200":
+		raise Exception("First request in the forked process failed: " + status.decode('ascii'))
+
+	print(json.dumps({step: elapsed * 1000 for step, elapsed in results.items()}))
+
+def run(arguments):
+	"""Runs the given Python arguments in a new interpreter. Returns the output and the time it took."""
+	start = time.perf_counter()
+	output = subprocess.run([sys.executable] + arguments, check=True, capture_output=True, text=True).stdout
+	return (output, (time.perf_counter() - start) * 1000)
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark for worker startup.")
+	parser.add_argument('--runs', type=int, default=10,
+	                    help="amount of fresh interpreters to measure (default: 10)")
+	parser.add_argument('--output', default='benchmark_startup.json',
+	                    help="file to write the results to (default: benchmark_startup.json)")
+	parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+	args = parser.parse_args()
+	if args.child:
+		child()
+		return
+
+	steps = {"interpreter": [], "total": []}
+	for i in range(args.runs):
+		print("Run " + str(i + 1) + "/" + str(args.runs) + "...", file=sys.stderr)
+		steps["interpreter"].append(run(["-c", "pass"])[1])
+		output, total = run([os.path.abspath(__file__), "--child"])
+		steps["total"].append(total)
+		for step, elapsed in json.loads(output).items():
+			steps.setdefault(step, []).append(elapsed)
+
+	report = {
+		"date": datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc).isoformat(),
+		"runs": args.runs,
+		"steps_ms": {step: {"median": round(statistics.median(times), 3), "best": round(min(times), 3)}
+		             for step, times in steps.items()}
+	}
+	with open(args.output, 'w') as output:
+		output.write(json.dumps(report, indent=2))
+	print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,57 @@
+# coding: utf-8
+"""
+Sets up the app and the test database before any tests are collected, and
+provides the query_counter fixture.
+"""
+import pytest
+
+import drywall
+from drywall import api
+from drywall import db
+
+from sqlalchemy import event
+import threading
+
+drywall.create_app()
+db.init_db()
+api.push_instance()
+
+class QueryCounter:
+	"""
+	Counts the SQL statements issued against drywall.db.engine by the current
+	thread while in a with block:
+
+	    with QueryCounter() as counter:
+	        client.get('/api/v1/instance')
+	    assert counter.count <= 1
+
+	Statements issued by other threads (like background workers) are not
+	counted, so several threads can count their own statements at once.
+	"""
+	# The counter of the with block each thread is in
+	_active = threading.local()
+
+	def __init__(self):
+		self.count = 0
+		self.statements = []
+		self._outer = None
+
+	def __enter__(self):
+		self._outer = getattr(QueryCounter._active, 'counter', None)
+		QueryCounter._active.counter = self
+		return self
+
+	def __exit__(self, *args):
+		QueryCounter._active.counter = self._outer
+
+@event.listens_for(db.engine, "before_cursor_execute")
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+	counter = getattr(QueryCounter._active, 'counter', None)
+	if counter is not None:
+		counter.count += 1
+		counter.statements.append(statement)
+
+@pytest.fixture
+def query_counter():
+	"""Provides the QueryCounter class; see its docstring for usage."""
+	return QueryCounter
@@ -5,10 +5,17 @@ Tests for the API portions of the code.
 For authentication pages, see tests/test_auth.py.
 """
 import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import ProgrammingError
+from uuid import uuid4
 
 import drywall
 import drywall.api
+import drywall.db
+import drywall.deletion
 import drywall.objects
+import drywall.tokens
+from conftest import QueryCounter
 from test_objects import generate_objects
 
 #
@@ -19,6 +26,12 @@ from test_objects import generate_objects
 def client():
     drywall.app.config['TESTING'] = True
     with drywall.app.test_client() as client:
+        # The pregenerated account owns all conferences created by the tests,
+        # so it's allowed to do everything.
+        token = drywall.tokens.issue_token(_pregenerated_id('account'), "test_client",
+                                           list(drywall.objects.Permissions.scopes))
+        drywall.tokens.verify_token(token)
+        client.environ_base['HTTP_AUTHORIZATION'] = "Bearer " + token
         yield client
 
 class PregeneratedObjects:
@@ -174,6 +187,106 @@ def _endpoint_sanity_checks(_endpoint, method, action, object_type_dict=None):
 		else:
 			assert action(wrong_endpoint).status == "400 BAD REQUEST"
 
+#
+# Query budgets
+#
+
+# The maximum amount of SQL statements each API route may issue while handling
+# a request made by the tests below. If a change raises the amount of queries
+# a route makes, the tests fail; if it lowers it, lower the budget as well.
+# Budgets of routes protected by permissions.authorize include resolving
+# permissions with a cold cache.
+QUERY_BUDGETS = {
+	('POST', '/api/v1/accounts'): 4,
+	('DELETE', '/api/v1/accounts/<account_id>'): 6,
+	('GET', '/api/v1/accounts/<account_id>'): 2,
+	('PATCH', '/api/v1/accounts/<account_id>'): 12,
+	('POST', '/api/v1/accounts/<account_id>/report'): 8,
+	('POST', '/api/v1/channels'): 5,
+	('DELETE', '/api/v1/channels/<channel_id>'): 7,
+	('GET', '/api/v1/channels/<channel_id>'): 4,
+	('PATCH', '/api/v1/channels/<channel_id>'): 15,
+	('POST', '/api/v1/channels/<channel_id>/report'): 10,
+	('POST', '/api/v1/channels/<channel_id>/read'): 8,
+	('POST', '/api/v1/conferences'): 5,
+	('DELETE', '/api/v1/conferences/<conference_id>'): 7,
+	('GET', '/api/v1/conferences/<conference_id>'): 4,
+	('PATCH', '/api/v1/conferences/<conference_id>'): 14,
+	('POST', '/api/v1/conferences/<conference_id>/channels'): 7,
+	('DELETE', '/api/v1/conferences/<conference_id>/channels/<channel_id>'): 10,
+	('GET', '/api/v1/conferences/<conference_id>/channels/<channel_id>'): 3,
+	('PATCH', '/api/v1/conferences/<conference_id>/channels/<channel_id>'): 15,
+	('POST', '/api/v1/conferences/<conference_id>/channels/<channel_id>/report'): 12,
+	('POST', '/api/v1/conferences/<conference_id>/invites'): 11,
+	('DELETE', '/api/v1/conferences/<conference_id>/invites/<invite_id>'): 9,
+	('GET', '/api/v1/conferences/<conference_id>/invites/<invite_id>'): 3,
+	('PATCH', '/api/v1/conferences/<conference_id>/invites/<invite_id>'): 19,
+	('POST', '/api/v1/conferences/<conference_id>/invites/<invite_id>/report'): 12,
+	('GET', '/api/v1/conferences/<conference_id>/members'): 4,
+	('POST', '/api/v1/conferences/<conference_id>/members'): 14,
+	('DELETE', '/api/v1/conferences/<conference_id>/members/<member_id>'): 9,
+	('GET', '/api/v1/conferences/<conference_id>/members/<member_id>'): 3,
+	('PATCH', '/api/v1/conferences/<conference_id>/members/<member_id>'): 19,
+	('POST', '/api/v1/conferences/<conference_id>/members/<member_id>/report'): 12,
+	('POST', '/api/v1/conferences/<conference_id>/report'): 9,
+	('POST', '/api/v1/conferences/<conference_id>/roles'): 7,
+	('DELETE', '/api/v1/conferences/<conference_id>/roles/<role_id>'): 9,
+	('GET', '/api/v1/conferences/<conference_id>/roles/<role_id>'): 3,
+	('PATCH', '/api/v1/conferences/<conference_id>/roles/<role_id>'): 15,
+	('POST', '/api/v1/conferences/<conference_id>/roles/<role_id>/report'): 12,
+	('POST', '/api/v1/direct_messages'): 3,
+	('POST', '/api/v1/id'): 9,
+	('DELETE', '/api/v1/id/<object_id>'): 7,
+	('GET', '/api/v1/id/<object_id>'): 5,
+	('PATCH', '/api/v1/id/<object_id>'): 17,
+	('POST', '/api/v1/id/<object_id>/report'): 8,
+	('GET', '/api/v1/instance'): 2,
+	('POST', '/api/v1/invites'): 9,
+	('DELETE', '/api/v1/invites/<invite_id>'): 6,
+	('GET', '/api/v1/invites/<invite_id>'): 4,
+	('PATCH', '/api/v1/invites/<invite_id>'): 18,
+	('POST', '/api/v1/invites/<invite_id>/report'): 8,
+	('POST', '/api/v1/messages'): 11,
+	('DELETE', '/api/v1/messages/<message_id>'): 7,
+	('GET', '/api/v1/messages/<message_id>'): 4,
+	('PATCH', '/api/v1/messages/<message_id>'): 15,
+	('POST', '/api/v1/messages/<message_id>/report'): 9,
+	('PUT', '/api/v1/messages/<message_id>/reactions/<emoji>'): 4,
+	('GET', '/api/v1/messages/<message_id>/replies'): 6,
+	('DELETE', '/api/v1/messages/<message_id>/reactions/<emoji>'): 4,
+	('POST', '/api/v1/reports'): 8,
+	('DELETE', '/api/v1/reports/<report_id>'): 6,
+	('GET', '/api/v1/reports/<report_id>'): 2,
+	('PATCH', '/api/v1/reports/<report_id>'): 14,
+	('GET', '/api/v1/reports'): 4,
+	('POST', '/api/v1/roles'): 5,
+	('DELETE', '/api/v1/roles/<role_id>'): 6,
+	('GET', '/api/v1/roles/<role_id>'): 5,
+	('PATCH', '/api/v1/roles/<role_id>'): 14,
+	('POST', '/api/v1/roles/<role_id>/report'): 9,
+	('GET', '/api/v1/search/messages'): 4,
+	('GET', '/api/v1/search/accounts'): 2,
+	('GET', '/api/v1/search/conferences'): 2,
+	('POST', '/api/v1/stash/request'): 6,
+	('GET', '/api/v1/unread'): 4
+}
+
+def _check_query_budget(method, endpoint, counter):
+	"""
+	Checks whether the amount of queries counted by the given QueryCounter
+	fits into the query budget of the route matching the endpoint.
+	"""
+	adapter = drywall.app.url_map.bind('localhost')
+	rule = adapter.match(endpoint.split('?')[0], method=method, return_rule=True)[0]
+	budget = QUERY_BUDGETS[(method, rule.rule)]
+	try:
+		assert counter.count <= budget
+	except AssertionError as e:
+		print("Route " + method + " " + rule.rule + " made " + str(counter.count) +
+		      " queries (budget: " + str(budget) + "):")
+		print("\n".join(counter.statements))
+		raise e
+
 #
 # General test shorthands
 #
@@ -212,9 +325,12 @@ def endpoint_get(flask_client, endpoint, object_type=None, use_posted=False):
 			expected_object_dict = _pregenerated_dict(_object_type)
 		else:
 			expected_object_dict = _pregenerated_dict('message')
+	if expected_object_dict['object_type'] == 'message':
+		expected_object_dict = {**expected_object_dict, "reaction_counts": {}}
 
 	# First, test the endpoint in question:
-	result = get(endpoint)
+	with QueryCounter() as counter:
+		result = get(endpoint)
 	try:
 		assert result.status == "200 OK"
 		assert result.json == expected_object_dict
@@ -223,6 +339,8 @@ def endpoint_get(flask_client, endpoint, object_type=None, use_posted=False):
 		print("Data:\n" + str(result.json))
 		raise e
 
+	_check_query_budget('GET', endpoint, counter)
+
 	# Then, perform the usual checks, such as 404, wrong object type, etc.
 	_endpoint_sanity_checks(original_endpoint, 'GET', get, object_type)
 
@@ -250,7 +368,8 @@ def endpoint_post(flask_client, endpoint, object_type=None, data=None,
 		else:
 			data = _pregenerated_example_dict('message')
 
-	result = post(endpoint, json=data)
+	with QueryCounter() as counter:
+		result = post(endpoint, json=data)
 	try:
 		assert result.status == "201 CREATED"
 		assert result.json['id'] != data['id']
@@ -262,6 +381,8 @@ def endpoint_post(flask_client, endpoint, object_type=None, data=None,
 	if posts_object:
 		PostedObjectDicts.items[result.json['object_type']] = result.json
 
+	_check_query_budget('POST', endpoint, counter)
+
 	# Then, perform the usual checks, such as 404, wrong object type, etc.
 	_endpoint_sanity_checks(endpoint, 'POST', post, {None: object_type})
 
@@ -297,7 +418,8 @@ def endpoint_patch(flask_client, endpoint, object_type=None, data=None):
 		data = {}
 
 	try:
-		result = patch(endpoint, json=data)
+		with QueryCounter() as counter:
+			result = patch(endpoint, json=data)
 		assert result.status == "200 OK"
 		assert result.json['id'] == original_object_dict['id']
 		assert result.json != original_object_dict
@@ -308,6 +430,8 @@ def endpoint_patch(flask_client, endpoint, object_type=None, data=None):
 		print("Returned data:\n" + str(result.json))
 		raise e
 
+	_check_query_budget('PATCH', endpoint, counter)
+
 	# Then, perform the usual checks, such as 404, wrong object type, etc.
 	_endpoint_sanity_checks(original_endpoint, 'PATCH', patch, object_type)
 
@@ -336,7 +460,8 @@ def endpoint_report(flask_client, endpoint, object_type):
 	data = _pregenerated_dict('report')
 
 	# Perform the action
-	result = report(endpoint, json=data)
+	with QueryCounter() as counter:
+		result = report(endpoint, json=data)
 	try:
 		assert result.status == "201 CREATED"
 		assert result.json['id'] != data['id']
@@ -346,6 +471,8 @@ def endpoint_report(flask_client, endpoint, object_type):
 		print("Returned data:\n" + str(result.json))
 		raise e
 
+	_check_query_budget('POST', endpoint, counter)
+
 	# Then, perform the usual checks, such as 404, wrong object type, etc.
 	_endpoint_sanity_checks(original_endpoint, 'POST', report, object_type)
 
@@ -378,9 +505,14 @@ def endpoint_delete(flask_client, endpoint, object_type=None):
 		target_id = _posted_id('message')
 
 	# First, test the endpoint in question:
-	result = delete(endpoint)
+	with QueryCounter() as counter:
+		result = delete(endpoint)
 	try:
-		assert result.status == "200 OK"
+		if _object_type in drywall.deletion.CASCADE_TYPES:
+			# Removed in the background
+			assert result.status == "202 ACCEPTED"
+		else:
+			assert result.status == "200 OK"
 	except AssertionError as e:
 		print("Filled endpoint: " + endpoint)
 		print("Returned data:\n" + str(result.json))
@@ -393,6 +525,8 @@ def endpoint_delete(flask_client, endpoint, object_type=None):
 	else:
 		del PostedObjectDicts.items['message']
 
+	_check_query_budget('DELETE', endpoint, counter)
+
 	# Then, perform the usual checks, such as 404, wrong object type, etc.
 	_endpoint_sanity_checks(original_endpoint, 'DELETE', delete, object_type)
 
@@ -468,18 +602,22 @@ def endpoint_conference_child(flask_client, method, endpoint, object_type, data=
 # pytest tests
 #
 
-def test_special_endpoints(client):
+def test_special_endpoints(client, query_counter):
 	"""Test /api/v1/instance and /api/v1/stash/request."""
 	# /api/v1/instance
 	print("  * Testing: GET /api/v1/instance")
-	instance_result = client.get('/api/v1/instance')
+	with query_counter() as counter:
+		instance_result = client.get('/api/v1/instance')
+	_check_query_budget('GET', '/api/v1/instance', counter)
 	assert instance_result.status == "200 OK"
 	assert instance_result.json == drywall.db.get_object_as_dict_by_id('0')
 
 	# /api/v1/stash/request
 	print("  * Testing: POST /api/v1/stash/request")
 	stash_data = {"id_list": [_pregenerated_id('account'), _pregenerated_id('message')]}
-	stash_result = client.post('/api/v1/stash/request', json=stash_data)
+	with query_counter() as counter:
+		stash_result = client.post('/api/v1/stash/request', json=stash_data)
+	_check_query_budget('POST', '/api/v1/stash/request', counter)
 	assert stash_result.status == "200 OK"
 	assert stash_result.json == {
 		"type": "stash",
@@ -487,6 +625,17 @@ def test_special_endpoints(client):
 		_pregenerated_id('account'): _pregenerated_dict('account'),
 		_pregenerated_id('message'): _pregenerated_dict('message')
 	}
+	# The budget doesn't depend on the amount of objects of the same type
+	message_ids = []
+	for i in range(20):
+		message = _pregenerated_example_dict('message').copy()
+		message.pop('id')
+		message_ids.append(drywall.db.add_object(drywall.objects.make_object_from_dict(message))['id'])
+	with query_counter() as counter:
+		stash_result = client.post('/api/v1/stash/request', json={"id_list": message_ids})
+	_check_query_budget('POST', '/api/v1/stash/request', counter)
+	assert stash_result.status == "200 OK"
+	assert [stash_result.json[id]['id'] for id in message_ids] == message_ids
 
 def test_api_id(client):
 	"""Test API endpoints related to objects and IDs."""
@@ -496,11 +645,22 @@ def test_api_id(client):
 	endpoint_report(client, '/api/v1/id/<id>/report', {'<id>': None})
 	endpoint_delete(client, '/api/v1/id/<id>', {'<id>': None})
 
-def test_api_accounts(client):
+def test_api_accounts(client, query_counter):
 	"""Test API endpoints related to accounts."""
 	endpoint_post(client, '/api/v1/accounts', 'account')
 	endpoint_get(client, '/api/v1/accounts/<account_id>', {"<account_id>": "account"})
 	endpoint_patch(client, '/api/v1/accounts/<account_id>', {"<account_id>": "account"}, {"bio": "new_bio"})
+	# ID lists are validated with a constant amount of queries
+	friends = [drywall.db.add_object(drywall.objects.make_object_from_dict(
+		{"object_type": "account", "username": "friend_" + str(uuid4())}))['id'] for i in range(20)]
+	endpoint = '/api/v1/accounts/' + _pregenerated_id('account')
+	with query_counter() as counter:
+		patch_result = client.patch(endpoint, json={"friends": friends})
+	_check_query_budget('PATCH', endpoint, counter)
+	assert patch_result.status == "200 OK"
+	assert patch_result.json['friends'] == friends
+	assert client.patch(endpoint, json={"friends": friends + [_pregenerated_id('message')]}).status == "400 BAD REQUEST"
+	assert client.patch(endpoint, json={"friends": friends + ["fakeid"]}).status == "400 BAD REQUEST"
 	endpoint_report(client, '/api/v1/accounts/<account_id>/report', {"<account_id>": "account"})
 	endpoint_delete(client, '/api/v1/accounts/<account_id>', {"<account_id>": "account"})
 
@@ -610,3 +770,518 @@ def test_api_reports(client):
 	endpoint_get(client, '/api/v1/reports/<report_id>', {"<report_id>": "report"})
 	endpoint_patch(client, '/api/v1/reports/<report_id>', {"<report_id>": "report"}, {"note": "new_note"})
 	endpoint_delete(client, '/api/v1/reports/<report_id>', {"<report_id>": "report"})
+
+def test_api_report_list(client, query_counter, monkeypatch):
+	"""Test GET /api/v1/reports."""
+	conference = _pregenerated_example_dict('conference').copy()
+	conference.pop('id')
+	conference_id = client.post('/api/v1/conferences', json=conference).json['id']
+	channel = _pregenerated_example_dict('channel').copy()
+	channel.pop('id')
+	channel_id = client.post('/api/v1/conferences/' + conference_id + '/channels', json=channel).json['id']
+	message = _pregenerated_example_dict('message').copy()
+	message.pop('id')
+	message['parent_channel'] = channel_id
+	message_id = client.post('/api/v1/messages', json=message).json['id']
+	reports = []
+	for endpoint in ['/api/v1/messages/' + message_id, '/api/v1/messages/' + message_id, '/api/v1/channels/' + channel_id]:
+		post_result = client.post(endpoint + '/report', json={"note": "spam"})
+		assert post_result.status == "201 CREATED"
+		assert post_result.json['target_conference'] == conference_id
+		reports.append(post_result.json['id'])
+
+	print("  * Testing: GET /api/v1/reports")
+	endpoint = '/api/v1/reports?conference=' + conference_id
+	with query_counter() as counter:
+		list_result = client.get(endpoint)
+	_check_query_budget('GET', endpoint, counter)
+	assert list_result.status == "200 OK"
+	assert list_result.json['type'] == "report_list"
+	# Newest first
+	assert [report['id'] for report in list_result.json['results']] == reports[::-1]
+	assert list_result.json['results'][0] == drywall.db.get_object_as_dict_by_id(reports[2])
+	assert list_result.json['results'][0]['target_type'] == "channel"
+	assert not list_result.json['next_cursor']
+
+	# Pagination
+	ids = []
+	cursor = ''
+	while True:
+		page = client.get(endpoint + '&limit=1' + cursor).json
+		ids += [report['id'] for report in page['results']]
+		if not page['next_cursor']:
+			break
+		cursor = '&cursor=' + page['next_cursor']
+	assert ids == reports[::-1]
+
+	# Filters and grouping
+	assert len(client.get(endpoint + '&target_type=message').json['results']) == 2
+	assert client.get(endpoint + '&target_type=account').json['results'] == []
+	with query_counter() as counter:
+		group_result = client.get(endpoint + '&group=true')
+	_check_query_budget('GET', endpoint, counter)
+	assert [(group['target'], group['report_count'], group['latest_report']['id'])
+	        for group in group_result.json['results']] == [(channel_id, 1, reports[2]), (message_id, 2, reports[1])]
+	first_page = client.get(endpoint + '&group=true&limit=1').json
+	second_page = client.get(endpoint + '&group=true&limit=1&cursor=' + first_page['next_cursor']).json
+	assert [group['target'] for group in second_page['results']] == [message_id]
+	assert not second_page['next_cursor']
+
+	# Listing all reports is limited to instance moderators
+	assert client.get('/api/v1/reports').status == "403 FORBIDDEN"
+	monkeypatch.setitem(drywall.config.config_file, 'instance_moderators', [_pregenerated_id('account')])
+	all_reports = client.get('/api/v1/reports?target_type=channel&limit=100').json['results']
+	assert reports[2] in [report['id'] for report in all_reports]
+
+	# Errors
+	other_token = drywall.tokens.issue_token(str(uuid4()), "test_client", list(drywall.objects.Permissions.scopes))
+	assert client.get(endpoint, headers={"Authorization": "Bearer " + other_token}).status == "403 FORBIDDEN"
+	assert client.get(endpoint, headers={"Authorization": ""}).status == "401 UNAUTHORIZED"
+	assert client.get('/api/v1/reports?conference=fakeid').status == "404 NOT FOUND"
+	assert client.get('/api/v1/reports?conference=' + channel_id).status == "400 BAD REQUEST"
+	assert client.get(endpoint + '&target_type=fake').status == "400 BAD REQUEST"
+	assert client.get(endpoint + '&cursor=garbage').status == "400 BAD REQUEST"
+	assert client.get(endpoint + '&cursor=' + drywall.utils.encode_cursor(["yesterday", "id"])).status == "400 BAD REQUEST"
+
+def test_api_member_list(client, query_counter, monkeypatch):
+	"""Test GET /api/v1/conferences/<conference_id>/members."""
+	conference = _pregenerated_example_dict('conference').copy()
+	conference.pop('id')
+	conference_id = client.post('/api/v1/conferences', json=conference).json['id']
+	members = {}
+	for i in range(3):
+		account_id = generate_objects()[1]['account']
+		post_result = client.post('/api/v1/conferences/' + conference_id + '/members',
+			json={"object_type": "conference_member", "user_id": account_id})
+		assert post_result.status == "201 CREATED"
+		members[account_id] = post_result.json['id']
+	# Accounts can only be members once
+	duplicate_result = client.post('/api/v1/conferences/' + conference_id + '/members',
+		json={"object_type": "conference_member", "user_id": account_id})
+	assert duplicate_result.status == "400 BAD REQUEST"
+	# Members added between the check and the insert or update, for
+	# example by two concurrent joins, are reported the same way
+	monkeypatch.setattr(drywall.db, 'get_object_ids_by_keys', lambda object_type, keys: [])
+	race_result = client.post('/api/v1/conferences/' + conference_id + '/members',
+		json={"object_type": "conference_member", "user_id": account_id})
+	assert race_result.status == "400 BAD REQUEST"
+	assert race_result.json['error_code'] == 10
+	other_member = next(member_id for user_id, member_id in members.items() if user_id != account_id)
+	race_result = client.patch('/api/v1/conferences/' + conference_id + '/members/' + other_member,
+		json={"user_id": account_id})
+	assert race_result.status == "400 BAD REQUEST"
+	assert race_result.json['error_code'] == 10
+	monkeypatch.undo()
+
+	print("  * Testing: GET /api/v1/conferences/<conference_id>/members")
+	endpoint = '/api/v1/conferences/' + conference_id + '/members'
+	with query_counter() as counter:
+		list_result = client.get(endpoint)
+	_check_query_budget('GET', endpoint, counter)
+	assert list_result.status == "200 OK"
+	assert list_result.json['type'] == "member_list"
+	assert [member['user_id'] for member in list_result.json['results']] == sorted(members)
+	assert list_result.json['results'][0] == drywall.db.get_object_as_dict_by_id(members[min(members)])
+	assert not list_result.json['next_cursor']
+
+	# Pagination
+	ids = []
+	cursor = ''
+	while True:
+		page = client.get(endpoint + '?limit=2' + cursor).json
+		ids += [member['id'] for member in page['results']]
+		if not page['next_cursor']:
+			break
+		cursor = '&cursor=' + page['next_cursor']
+	assert ids == [members[account_id] for account_id in sorted(members)]
+
+	# Lookup by account
+	assert [member['id'] for member in client.get(endpoint + '?user_id=' + account_id).json['results']] == [members[account_id]]
+	assert client.get(endpoint + '?user_id=fakeid').json['results'] == []
+
+	# Errors
+	assert client.get('/api/v1/conferences/fakeid/members').status == "404 NOT FOUND"
+	assert client.get(endpoint + '?cursor=garbage').status == "400 BAD REQUEST"
+	assert client.get(endpoint + '?limit=0').status == "400 BAD REQUEST"
+	assert client.get(endpoint, headers={"Authorization": ""}).status == "401 UNAUTHORIZED"
+
+def test_api_unread(client, query_counter):
+	"""Test GET /api/v1/unread and POST /api/v1/channels/<channel_id>/read."""
+	channel = _pregenerated_example_dict('channel').copy()
+	channel.pop('id')
+	channel_id = client.post('/api/v1/conferences/' + _pregenerated_id('conference') + '/channels', json=channel).json['id']
+	author = generate_objects()[1]['account']
+	reader = _pregenerated_id('account')
+	posted = []
+	for mentions in [[], [reader, author], []]:
+		message = _pregenerated_example_dict('message').copy()
+		message.pop('id')
+		message.update({"parent_channel": channel_id, "author": author, "mentions": mentions})
+		# The author isn't in the conference, so this can't go through the API
+		posted.append(drywall.db.add_object(drywall.objects.make_object_from_dict(message))['id'])
+
+	print("  * Testing: GET /api/v1/unread")
+	endpoint = '/api/v1/unread?conference=' + _pregenerated_id('conference')
+	with query_counter() as counter:
+		unread_result = client.get(endpoint)
+	_check_query_budget('GET', endpoint, counter)
+	assert unread_result.status == "200 OK"
+	assert unread_result.json['type'] == "unread_counts"
+	assert {"channel": channel_id, "unread_count": 3, "mention_count": 1, "last_read_message": None,
+	        "last_message": posted[2]} in unread_result.json['results']
+	assert channel_id in [result['channel'] for result in client.get('/api/v1/unread').json['results']]
+	# Authors have read their own messages
+	assert drywall.db.get_unread_counts(author, [channel_id]) == []
+
+	print("  * Testing: POST /api/v1/channels/<channel_id>/read")
+	endpoint = '/api/v1/channels/' + channel_id + '/read'
+	with query_counter() as counter:
+		read_result = client.post(endpoint, json={"message": posted[0]})
+	_check_query_budget('POST', endpoint, counter)
+	# Unread messages are counted from the stored positions
+	assert any('message_position' in statement for statement in counter.statements)
+	assert read_result.status == "200 OK"
+	assert read_result.json == {"type": "read_state", "channel": channel_id, "unread_count": 2,
+	                            "mention_count": 1, "last_read_message": posted[0]}
+	assert drywall.db.get_unread_counts(reader, [channel_id])[0]['unread_count'] == 2
+	assert client.post(endpoint, json={"message": posted[1]}).json['mention_count'] == 0
+	assert client.post(endpoint).json['last_read_message'] == posted[2]
+	assert drywall.db.get_unread_counts(reader, [channel_id]) == []
+
+	# Errors
+	assert client.post(endpoint, json={"message": "fakeid"}).status == "404 NOT FOUND"
+	assert client.post(endpoint, json={"message": channel_id}).status == "400 BAD REQUEST"
+	assert client.post(endpoint, json={"message": _pregenerated_id('message')}).status == "400 BAD REQUEST"
+	assert client.post('/api/v1/channels/fakeid/read').status == "404 NOT FOUND"
+	assert client.get('/api/v1/unread?conference=' + channel_id).status == "400 BAD REQUEST"
+	assert client.get('/api/v1/unread', headers={"Authorization": ""}).status == "401 UNAUTHORIZED"
+
+def test_api_direct_messages(client, query_counter, monkeypatch):
+	"""Test POST /api/v1/direct_messages."""
+	account_id = _pregenerated_id('account')
+	others = [generate_objects()[1]['account'] for i in range(2)]
+
+	print("  * Testing: POST /api/v1/direct_messages")
+	endpoint = '/api/v1/direct_messages'
+	create_result = client.post(endpoint, json={"members": others, "name": "Group"})
+	assert create_result.status == "201 CREATED"
+	channel = create_result.json
+	assert channel['channel_type'] == "direct_message"
+	assert channel['name'] == "Group"
+	assert sorted(channel['members']) == sorted([account_id] + others)
+	# The same members in any order, with or without the account itself,
+	# get the same channel
+	with query_counter() as counter:
+		get_result = client.post(endpoint, json={"members": [others[1], account_id, others[0]]})
+	_check_query_budget('POST', endpoint, counter)
+	assert get_result.status == "200 OK"
+	assert get_result.json == drywall.db.get_object_as_dict_by_id(channel['id'])
+	assert client.post(endpoint, json={"members": others[::-1]}).json['id'] == channel['id']
+	other_result = client.post(endpoint, json={"members": others[:1]})
+	assert other_result.status == "201 CREATED"
+	assert other_result.json['id'] != channel['id']
+	assert client.get('/api/v1/channels/' + channel['id']).status == "200 OK"
+
+	# Channels with the same members can't be added any other way
+	duplicate = {"object_type": "channel", "channel_type": "direct_message", "name": "Duplicate",
+	             "icon": "", "members": others + [account_id]}
+	assert client.post('/api/v1/channels', json=duplicate).status == "400 BAD REQUEST"
+	# The key is public, so passing it must not skip the check
+	duplicate['dm_key'] = drywall.objects.direct_message_key(others + [account_id])
+	assert client.post('/api/v1/channels', json=duplicate).status == "400 BAD REQUEST"
+	assert client.patch('/api/v1/channels/' + other_result.json['id'], json={"members": others + [account_id]}).status == "400 BAD REQUEST"
+	assert client.patch('/api/v1/channels/' + other_result.json['id'], json={"name": "Renamed"}).status == "200 OK"
+	# A channel added between the check and the insert is reported the same way
+	monkeypatch.setattr(drywall.db, 'get_object_ids_by_keys', lambda object_type, keys: [])
+	race_result = client.post('/api/v1/channels', json=duplicate)
+	assert race_result.status == "400 BAD REQUEST"
+	assert race_result.json['error_code'] == 10
+	monkeypatch.undo()
+
+	# Deleted channels make room for new ones
+	assert client.delete('/api/v1/channels/' + other_result.json['id']).status == "202 ACCEPTED"
+	assert client.post(endpoint, json={"members": others[:1]}).status == "201 CREATED"
+
+	# Errors
+	assert client.post(endpoint, json={"members": [account_id]}).status == "400 BAD REQUEST"
+	assert client.post(endpoint, json={"members": "notalist"}).status == "400 BAD REQUEST"
+	assert client.post(endpoint, json={"members": ["fakeid"]}).status == "400 BAD REQUEST"
+	assert client.post(endpoint, json={"members": [_pregenerated_id('conference')]}).status == "400 BAD REQUEST"
+	assert client.post(endpoint).status == "400 BAD REQUEST"
+	assert client.post(endpoint, json={"members": others}, headers={"Authorization": ""}).status == "401 UNAUTHORIZED"
+
+def test_api_reactions(client, query_counter):
+	"""Test PUT and DELETE /api/v1/messages/<message_id>/reactions/<emoji>."""
+	message = _pregenerated_example_dict('message').copy()
+	message.pop('id')
+	message_id = client.post('/api/v1/messages', json=message).json['id']
+	endpoint = '/api/v1/messages/' + message_id + '/reactions/'
+	other_account = generate_objects()[1]['account']
+	other_token = drywall.tokens.issue_token(other_account, "test_client", list(drywall.objects.Permissions.scopes))
+
+	print("  * Testing: PUT /api/v1/messages/<message_id>/reactions/<emoji>")
+	with query_counter() as counter:
+		put_result = client.put(endpoint + '👍')
+	_check_query_budget('PUT', endpoint + '👍', counter)
+	assert put_result.status == "200 OK"
+	assert put_result.json == {"type": "reaction", "message": message_id, "emoji": "👍", "count": 1, "reacted": True}
+	# Reacting twice doesn't count twice
+	assert client.put(endpoint + '👍').json['count'] == 1
+	assert client.put(endpoint + ':custom:').json['count'] == 1
+	drywall.db.add_reaction(message_id, ':custom:', other_account)
+	assert client.put(endpoint + '👍', headers={"Authorization": "Bearer " + other_token}).status == "403 FORBIDDEN"
+	drywall.db.add_reaction(message_id, '👍', other_account)
+	drywall.db.add_reaction(message_id, '🎉', other_account)
+
+	get_result = client.get('/api/v1/messages/' + message_id)
+	assert get_result.json['reaction_counts'] == {"👍": 2, ":custom:": 2, "🎉": 1}
+	assert list(get_result.json['reaction_counts']) == [":custom:", "👍", "🎉"]
+	assert client.get('/api/v1/id/' + message_id).json['reaction_counts'] == get_result.json['reaction_counts']
+
+	print("  * Testing: DELETE /api/v1/messages/<message_id>/reactions/<emoji>")
+	with query_counter() as counter:
+		delete_result = client.delete(endpoint + '👍')
+	_check_query_budget('DELETE', endpoint + '👍', counter)
+	assert delete_result.status == "200 OK"
+	assert delete_result.json == {"type": "reaction", "message": message_id, "emoji": "👍", "count": 1, "reacted": False}
+	assert client.delete(endpoint + '👍').json['count'] == 1
+	assert client.delete(endpoint + '🎉').json['count'] == 1
+	drywall.db.remove_reaction(message_id, '🎉', other_account)
+	assert client.get('/api/v1/messages/' + message_id).json['reaction_counts'] == {":custom:": 2, "👍": 1}
+
+	# Errors
+	assert client.put('/api/v1/messages/fakeid/reactions/👍').status == "404 NOT FOUND"
+	assert client.put('/api/v1/messages/' + _pregenerated_id('account') + '/reactions/👍').status == "400 BAD REQUEST"
+	assert client.put(endpoint + 'x' * 65).status == "400 BAD REQUEST"
+	assert client.put(endpoint + '👍', headers={"Authorization": ""}).status == "401 UNAUTHORIZED"
+
+def test_api_replies(client, query_counter):
+	"""Test GET /api/v1/messages/<message_id>/replies."""
+	message = _pregenerated_example_dict('message').copy()
+	message.pop('id')
+	parent_id = client.post('/api/v1/messages', json=message).json['id']
+	replies = []
+	for i in range(3):
+		reply = dict(message, reply_to=parent_id)
+		replies.append(client.post('/api/v1/messages', json=reply).json['id'])
+	# A reply in a channel the account can't read
+	other_ids = generate_objects()[1]
+	hidden_reply = drywall.objects.make_object_from_dict({"object_type": "message", "content": "hidden",
+		"parent_channel": other_ids['channel'], "author": other_ids['account'], "post_date": "dummy",
+		"edited": False, "reply_to": parent_id})
+	drywall.db.add_object(hidden_reply)
+	# Replying doesn't touch the message that is replied to
+	assert 'replies' not in drywall.db.get_object_as_dict_by_id(parent_id)
+
+	print("  * Testing: GET /api/v1/messages/<message_id>/replies")
+	endpoint = '/api/v1/messages/' + parent_id + '/replies'
+	with query_counter() as counter:
+		list_result = client.get(endpoint)
+	_check_query_budget('GET', endpoint, counter)
+	assert list_result.status == "200 OK"
+	assert list_result.json['type'] == "reply_list"
+	assert [reply['id'] for reply in list_result.json['results']] == replies
+	assert list_result.json['results'][0] == drywall.db.get_object_as_dict_by_id(replies[0])
+	assert not list_result.json['next_cursor']
+	assert drywall.db.get_replies(parent_id)[-1]['id'] == hidden_reply.id
+
+	# Pagination
+	ids = []
+	cursor = ''
+	while True:
+		page = client.get(endpoint + '?limit=2' + cursor).json
+		ids += [reply['id'] for reply in page['results']]
+		if not page['next_cursor']:
+			break
+		cursor = '&cursor=' + page['next_cursor']
+	assert ids == replies
+	assert client.get('/api/v1/messages/' + replies[0] + '/replies').json['results'] == []
+
+	# Errors
+	assert client.get('/api/v1/messages/fakeid/replies').status == "404 NOT FOUND"
+	assert client.get('/api/v1/messages/' + _pregenerated_id('account') + '/replies').status == "400 BAD REQUEST"
+	assert client.get('/api/v1/messages/' + hidden_reply.id + '/replies').status == "403 FORBIDDEN"
+	assert client.get(endpoint + '?cursor=garbage').status == "400 BAD REQUEST"
+	assert client.get(endpoint + '?limit=0').status == "400 BAD REQUEST"
+	assert client.get(endpoint, headers={"Authorization": ""}).status == "401 UNAUTHORIZED"
+
+def test_api_search(client, query_counter):
+	"""Test /api/v1/search/messages."""
+	word = "searchtest" + uuid4().hex
+	posted = []
+	for content in [word + " alpha", word + " " + word + " beta", "unrelated gamma"]:
+		message = _pregenerated_example_dict('message').copy()
+		message.pop('id')
+		message['content'] = content
+		message['parent_channel'] = _pregenerated_id('channel')
+		post_result = client.post('/api/v1/messages', json=message)
+		assert post_result.status == "201 CREATED"
+		posted.append(post_result.json['id'])
+
+	print("  * Testing: GET /api/v1/search/messages")
+	endpoint = '/api/v1/search/messages?q=' + word
+	with query_counter() as counter:
+		search_result = client.get(endpoint)
+	_check_query_budget('GET', endpoint, counter)
+	assert search_result.status == "200 OK"
+	assert search_result.json['type'] == "search_results"
+	results = search_result.json['results']
+	# The message with the word in it twice ranks higher
+	assert [message['id'] for message in results] == [posted[1], posted[0]]
+	assert results[0] == drywall.db.get_object_as_dict_by_id(posted[1])
+	assert not search_result.json['next_cursor']
+
+	# Pagination
+	first_page = client.get(endpoint + '&limit=1').json
+	assert [message['id'] for message in first_page['results']] == [posted[1]]
+	second_page = client.get(endpoint + '&limit=1&cursor=' + first_page['next_cursor']).json
+	assert [message['id'] for message in second_page['results']] == [posted[0]]
+	assert not second_page['next_cursor']
+
+	# Filters
+	for query_string, count in [('&channel=' + _pregenerated_id('channel'), 2),
+	                            ('&conference=' + _pregenerated_id('conference'), 2),
+	                            ('&author=' + _pregenerated_id('account'), 2),
+	                            ('&author=fakeid', 0),
+	                            ('&before=2000-01-01T00:00:00%2B00:00', 0),
+	                            ('&before=2999-01-01', 2)]:
+		assert len(client.get(endpoint + query_string).json['results']) == count
+
+	# Errors
+	assert client.get('/api/v1/search/messages').status == "400 BAD REQUEST"
+	assert client.get(endpoint + '&limit=0').status == "400 BAD REQUEST"
+	assert client.get(endpoint + '&before=yesterday').status == "400 BAD REQUEST"
+	assert client.get(endpoint + '&cursor=garbage').status == "400 BAD REQUEST"
+	assert client.get(endpoint + '&channel=fakeid').status == "404 NOT FOUND"
+	assert client.get(endpoint + '&channel=' + posted[0]).status == "400 BAD REQUEST"
+	assert client.get(endpoint, headers={"Authorization": ""}).status == "401 UNAUTHORIZED"
+
+def test_api_directory_search(client, query_counter):
+	"""Test /api/v1/search/accounts and /api/v1/search/conferences."""
+	prefix = "dirtest" + uuid4().hex[:8]
+	account_ids = []
+	for username, index_user in [(prefix + "_a", True), (prefix + "_b", True), (prefix + "_c", False)]:
+		account = _pregenerated_example_dict('account').copy()
+		account.pop('id')
+		account.update({"username": username, "index_user": index_user})
+		post_result = client.post('/api/v1/accounts', json=account)
+		assert post_result.status == "201 CREATED"
+		account_ids.append(post_result.json['id'])
+	conference = _pregenerated_example_dict('conference').copy()
+	conference.pop('id')
+	conference.update({"name": prefix + " Conference", "index_conference": True})
+	conference_id = client.post('/api/v1/conferences', json=conference).json['id']
+
+	for endpoint, expected in [('/api/v1/search/accounts?q=' + prefix.upper(), account_ids[:2]),
+	                           ('/api/v1/search/conferences?q=' + prefix, [conference_id])]:
+		print("  * Testing: GET " + endpoint.split('?')[0])
+		with query_counter() as counter:
+			search_result = client.get(endpoint)
+		_check_query_budget('GET', endpoint, counter)
+		assert search_result.status == "200 OK"
+		assert search_result.json['type'] == "search_results"
+		assert [result['id'] for result in search_result.json['results']] == expected
+		assert not search_result.json['next_cursor']
+
+	# Pagination
+	endpoint = '/api/v1/search/accounts?q=' + prefix
+	first_page = client.get(endpoint + '&limit=1').json
+	assert first_page['results'] == [drywall.db.get_object_as_dict_by_id(account_ids[0])]
+	second_page = client.get(endpoint + '&limit=1&cursor=' + first_page['next_cursor']).json
+	assert [result['id'] for result in second_page['results']] == [account_ids[1]]
+
+	# Changes made by other workers are not in this worker's index yet, but
+	# accounts that left the directory and deleted conferences are left out
+	with drywall.db.get_engine().begin() as connection:
+		connection.execute(text("UPDATE account SET index_user = false WHERE id = :id"), {"id": account_ids[1]})
+	drywall.db.tombstone_object(conference_id)
+	assert [result['id'] for result in client.get(endpoint).json['results']] == account_ids[:1]
+	assert client.get('/api/v1/search/conferences?q=' + prefix).json['results'] == []
+
+	# Errors
+	assert client.get('/api/v1/search/accounts').status == "400 BAD REQUEST"
+	assert client.get(endpoint + '&limit=101').status == "400 BAD REQUEST"
+	assert client.get(endpoint + '&cursor=garbage').status == "400 BAD REQUEST"
+	assert client.get(endpoint, headers={"Authorization": ""}).status == "401 UNAUTHORIZED"
+
+def test_query_budgets():
+	"""Check that every API route has a query budget, and vice versa."""
+	routes = []
+	for rule in drywall.app.url_map.iter_rules():
+		if rule.rule.startswith('/api/v1'):
+			for method in rule.methods - {'HEAD', 'OPTIONS'}:
+				routes.append((method, rule.rule))
+	assert sorted(routes) == sorted(QUERY_BUDGETS.keys())
+
+def test_metrics(client):
+	"""Test the /metrics endpoint."""
+	print("  * Testing: GET /metrics")
+	client.get('/api/v1/instance')
+	client.get('/api/v1/id/fakeid')
+	metrics_result = client.get('/metrics')
+	assert metrics_result.status == "200 OK"
+	assert metrics_result.mimetype == "text/plain"
+	metrics_text = metrics_result.get_data(as_text=True)
+	assert 'drywall_http_requests_total{method="GET",route="/api/v1/instance",status="200"}' in metrics_text
+	assert 'drywall_http_request_duration_seconds_bucket{method="GET",route="/api/v1/instance",le="+Inf"}' in metrics_text
+	assert 'drywall_errors_total{code="4"}' in metrics_text
+	assert 'drywall_db_query_duration_seconds_count' in metrics_text
+
+	# Failed statements are timed as well
+	def query_count():
+		return sum(sum(entry[0]) for entry in drywall.metrics.query_duration.values.values())
+	count = query_count()
+	with drywall.db.get_engine().connect() as connection:
+		with pytest.raises(ProgrammingError):
+			connection.execute(text("SELECT * FROM nonexistent_table"))
+	assert query_count() == count + 1
+
+def test_api_fields(client, query_counter):
+	"""Test the fields query parameter on GET and stash requests."""
+	account_id = _pregenerated_id('account')
+	print("  * Testing: GET /api/v1/accounts/<account_id>?fields=")
+	with query_counter() as counter:
+		result = client.get('/api/v1/accounts/' + account_id + '?fields=username,short_status')
+	_check_query_budget('GET', '/api/v1/accounts/<account_id>', counter)
+	assert result.status == "200 OK"
+	assert result.json == {"id": account_id, "type": "object", "object_type": "account",
+		"username": _pregenerated_dict('account')['username'],
+		"short_status": _pregenerated_dict('account')['short_status']}
+	# Only the requested columns are read
+	assert not any('bio' in statement for statement in counter.statements)
+
+	# Reaction counts are only looked up when they're requested
+	message_id = _pregenerated_id('message')
+	with query_counter() as counter:
+		result = client.get('/api/v1/messages/' + message_id + '?fields=content')
+	assert result.json == {"id": message_id, "type": "object", "object_type": "message",
+		"content": _pregenerated_dict('message')['content']}
+	assert not any('reaction_counts' in statement for statement in counter.statements)
+	result = client.get('/api/v1/messages/' + message_id + '?fields=reaction_counts')
+	assert result.json['reaction_counts'] == {}
+	assert 'content' not in result.json
+
+	# Conference children
+	member = _pregenerated_dict('conference_member')
+	result = client.get('/api/v1/conferences/' + member['parent_conference'] + '/members/' +
+		member['id'] + '?fields=user_id')
+	assert result.json == {"id": member['id'], "type": "object", "object_type": "conference_member",
+		"user_id": member['user_id']}
+
+	print("  * Testing: POST /api/v1/stash/request?fields=")
+	stash_data = {"id_list": [account_id, message_id]}
+	with query_counter() as counter:
+		result = client.post('/api/v1/stash/request?fields=username,author', json=stash_data)
+	_check_query_budget('POST', '/api/v1/stash/request', counter)
+	assert result.status == "200 OK"
+	assert result.json == {"type": "stash", "id_list": [account_id, message_id],
+		account_id: {"id": account_id, "type": "object", "object_type": "account",
+			"username": _pregenerated_dict('account')['username']},
+		message_id: {"id": message_id, "type": "object", "object_type": "message",
+			"author": _pregenerated_dict('message')['author']}}
+
+	# Errors
+	assert client.get('/api/v1/accounts/' + account_id + '?fields=username,fake').status == "400 BAD REQUEST"
+	assert client.post('/api/v1/stash/request?fields=fake', json=stash_data).status == "400 BAD REQUEST"
+	stash_data['id_list'].append('fakeid')
+	assert client.post('/api/v1/stash/request?fields=username', json=stash_data).status == "404 NOT FOUND"
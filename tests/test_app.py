@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Tests for the app factory and the database commands.
+"""
+import drywall
+from drywall import db
+
+from sqlalchemy import inspect, text
+import gc
+import os
+import runpy
+import subprocess
+import sys
+
+def test_lazy_import():
+	"""Tests that importing drywall needs neither a config file nor a database."""
+	env = dict(os.environ, DRYWALL_CONFIG="/nonexistent/config.json")
+	code = ("import drywall, drywall.api, drywall.db, drywall.metrics\n"
+	        "assert drywall.db._engine is None\n"
+	        "try:\n"
+	        "	drywall.create_app()\n"
+	        "except FileNotFoundError:\n"
+	        "	print('no config')\n")
+	result = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True)
+	assert result.returncode == 0, result.stderr
+	assert result.stdout.strip() == "no config"
+
+def test_create_app():
+	"""Tests that the app factory can be called more than once."""
+	assert drywall.create_app() is drywall.app
+	assert drywall.create_app() is drywall.app
+	assert drywall.app.secret_key
+	assert 'init-db' in drywall.app.cli.commands
+
+def test_production_entry_point():
+	"""Tests the WSGI module and the gunicorn configuration."""
+	from drywall import wsgi
+	assert wsgi.app is drywall.app
+	client = wsgi.app.test_client()
+	assert client.get('/api/v1/instance').status == "200 OK"
+
+	settings = runpy.run_path(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gunicorn.conf.py"))
+	assert settings['preload_app'] is True
+	assert settings['workers'] >= 1
+	assert settings['threads'] >= 1
+	# Gunicorn would treat a module called "config" as its config setting
+	assert 'config' not in settings
+	settings['when_ready'](None)
+	assert gc.get_freeze_count() > 0
+	gc.unfreeze()
+
+def test_migrate():
+	"""Tests applying migrations with the migrate command."""
+	runner = drywall.app.test_cli_runner()
+	result = runner.invoke(args=['migrate'])
+	assert result.exit_code == 0
+	assert "The database is up to date." in result.output
+
+	# Forget a migration and undo part of it; applying it again completes it
+	version = "0002_add_query_indexes"
+	with db.engine.begin() as connection:
+		connection.execute(text("DELETE FROM schema_migrations WHERE version = :version"), {"version": version})
+		connection.execute(text("DROP INDEX IF EXISTS ix_message_author"))
+	result = runner.invoke(args=['migrate'])
+	assert result.exit_code == 0
+	assert "Applied migration " + version in result.output
+	inspector = inspect(db.engine)
+	assert "ix_message_author" in [index['name'] for index in inspector.get_indexes("message")]
+	result = runner.invoke(args=['migrate'])
+	assert "The database is up to date." in result.output
+
+	result = runner.invoke(args=['init-db'])
+	assert result.exit_code == 0
+	assert db.get_object_as_dict_by_id("0")['object_type'] == "instance"
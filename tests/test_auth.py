@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Tests for authentication and password handling.
+"""
+import pytest
+
+from drywall import auth
+from drywall import config
+from drywall import db
+from drywall import passwords
+from drywall import tokens
+import drywall.api
+
+from uuid import uuid4
+import time
+from werkzeug.security import generate_password_hash
+
+def test_passwords():
+	"""Tests password hashing."""
+	password_hash = passwords.hash_password("password")
+	assert password_hash.startswith(passwords.get_method() + "$")
+	assert passwords.check_password(password_hash, "password")
+	assert not passwords.check_password(password_hash, "wrong_password")
+	assert not passwords.needs_rehash(password_hash)
+
+	old_hash = generate_password_hash("password", method="pbkdf2:sha256:1000")
+	assert passwords.check_password(old_hash, "password")
+	assert passwords.needs_rehash(old_hash)
+
+def test_passwords_queue_limit(monkeypatch):
+	"""Tests whether hashes are turned down once the queue is full."""
+	monkeypatch.setitem(config.config_file, 'password_hash_workers', 1)
+	monkeypatch.setitem(config.config_file, 'password_hash_queue', 1)
+	monkeypatch.setattr(passwords, 'HASH_TIMEOUT', 0.5)
+	passwords.shutdown_pool()
+	try:
+		# Pool processes aren't forked from the (threaded) worker
+		assert passwords._get_pool()[0]._mp_context.get_start_method() == "forkserver"
+		# A timed out hash keeps its slot until it's done
+		with pytest.raises(ValueError):
+			passwords._run(time.sleep, 2)
+		with pytest.raises(ValueError):
+			passwords.hash_password("password")
+		# Wait for the slot to be released
+		assert passwords._slots.acquire(timeout=30)
+		passwords._slots.release()
+		monkeypatch.setattr(passwords, 'HASH_TIMEOUT', 30)
+		assert passwords.hash_password("password")
+	finally:
+		passwords.shutdown_pool()
+
+	# No limit
+	monkeypatch.setitem(config.config_file, 'password_hash_queue', 0)
+	try:
+		assert passwords.hash_password("password")
+	finally:
+		passwords.shutdown_pool()
+
+def test_authenticate_user(monkeypatch):
+	"""Tests logging in, including rehashing outdated password hashes."""
+	username = "auth_test_" + str(uuid4())
+	email = username + "@example.com"
+	auth.register_user(username, email, "password")
+
+	assert auth.authenticate_user(email, "password")['username'] == username
+	with pytest.raises(ValueError):
+		auth.authenticate_user(email, "wrong_password")
+	with pytest.raises(ValueError):
+		auth.authenticate_user("nonexistent_" + email, "password")
+
+	old_hash = db.get_user_by_email(email)['password']
+	monkeypatch.setitem(config.config_file, 'password_hash_method', "pbkdf2:sha256:1000")
+	auth.authenticate_user(email, "password")
+	new_hash = db.get_user_by_email(email)['password']
+	assert new_hash != old_hash
+	assert new_hash.startswith("pbkdf2:sha256:1000$")
+	assert auth.authenticate_user(email, "password")['password'] == new_hash
+
+def test_tokens(monkeypatch):
+	"""Tests issuing, verifying and revoking access tokens."""
+	token = tokens.issue_token("account_id", "client_id", ["channel:read", "channel:write"])
+	payload = tokens.verify_token(token)
+	assert payload['account'] == "account_id"
+	assert payload['client'] == "client_id"
+	assert payload['scopes'] == ["channel:read", "channel:write"]
+	assert payload['exp'] > time.time()
+
+	with pytest.raises(ValueError):
+		tokens.issue_token("account_id", "client_id", ["fake:scope"])
+
+	# Tampered tokens
+	version, payload_data, signature = token.split('.')
+	forged_payload = tokens._b64encode(b'{"account":"other_account"}')
+	for bad_token in ["", "garbage", token + "x", token.replace("v1.", "v2."),
+	                  ".".join([version, forged_payload, signature])]:
+		with pytest.raises(ValueError):
+			tokens.verify_token(bad_token)
+
+	# Expired tokens
+	monkeypatch.setattr(time, "time", lambda: payload['exp'] + 1)
+	with pytest.raises(ValueError):
+		tokens.verify_token(token)
+	monkeypatch.undo()
+
+	# Revoked tokens
+	tokens.revoke_token(token)
+	with pytest.raises(ValueError):
+		tokens.verify_token(token)
+	assert payload['jti'] in drywall.db.get_revoked_tokens()
+
+def test_token_authentication():
+	"""Tests access token handling in API requests."""
+	drywall.app.config['TESTING'] = True
+	client = drywall.app.test_client()
+	token = tokens.issue_token("account_id", "client_id", ["conference:read"])
+	assert client.get('/api/v1/instance').status == "200 OK"
+	assert client.get('/api/v1/instance', headers={"Authorization": "Bearer " + token}).status == "200 OK"
+	assert client.get('/api/v1/instance', headers={"Authorization": "Bearer " + token + "x"}).status == "401 UNAUTHORIZED"
+	assert client.get('/api/v1/instance', headers={"Authorization": "Basic " + token}).status == "401 UNAUTHORIZED"
@@ -3,9 +3,17 @@
 """
 This file contains tests for all database backends.
 """
+import pytest
+
 from drywall import objects
 from drywall import db
 from test_objects import generate_objects
+from uuid import uuid4
+import os
+import subprocess
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 class PregeneratedObjects:
     """Contains pregenerated objects and their IDs."""
@@ -65,3 +73,95 @@ def test_db():
 
 	# db.remove_user("mail@example.com")
 	# assert db.get_user_by_email("mail@example.com") == None
+
+def test_array_operators():
+	"""Tests the list operators of get_object_by_key_value_pair."""
+	ids = []
+	for friends in [[], [0], [0, 1]]:
+		account = objects.make_object_from_dict({"object_type": "account", "username": "arraytest_" + str(uuid4()),
+			"friends": [ids[index] for index in friends]})
+		db.add_object(account)
+		ids.append(account.id)
+
+	def get(value, operator, **kwargs):
+		matches = db.get_object_by_key_value_pair("account", {"friends": value}, operator=operator, **kwargs) or []
+		return sorted(match['id'] for match in matches if match['id'] in ids)
+
+	assert get(ids[0], "contains") == sorted(ids[1:])
+	assert get([ids[0], ids[1]], "contains") == [ids[2]]
+	assert get([ids[1], "fakeid"], "overlaps") == [ids[2]]
+	assert get(["fakeid"], "overlaps") == []
+	assert get([ids[0]], "contained_by") == sorted(ids[:2])
+	assert len(db.get_object_by_key_value_pair("account", {"friends": ids[0]}, operator="contains", limit_objects=1)) == 1
+
+	with pytest.raises(ValueError):
+		get(ids[0], "fakeoperator")
+	with pytest.raises(ValueError):
+		db.get_object_by_key_value_pair("account", {"username": ["arraytest"]}, operator="overlaps")
+
+def test_fields():
+	"""Tests loading only some keys of objects."""
+	ids = generate_objects()[1]
+	account = db.get_object_as_dict_by_id(ids['account'])
+	assert db.get_object_as_dict_by_id(ids['account'], fields=["username", "content"]) == {"id": ids['account'],
+		"type": "object", "object_type": "account", "username": account['username']}
+	assert db.get_object_as_dict_by_id(ids['account'], fields=[]) == {"id": ids['account'],
+		"type": "object", "object_type": "account"}
+
+	object_dicts = db.get_objects_as_dicts([ids['account'], ids['message'], ids['channel'], "fakeid"], fields=["content"])
+	assert object_dicts[ids['account']] == {"id": ids['account'], "type": "object", "object_type": "account"}
+	assert object_dicts[ids['message']]['content'] == db.get_object_as_dict_by_id(ids['message'])['content']
+	assert set(object_dicts) == {ids['account'], ids['message'], ids['channel']}
+	assert db.get_objects_as_dicts([ids['account']])[ids['account']] == account
+	# Deleted objects are skipped
+	db.tombstone_object(ids['channel'])
+	assert ids['channel'] not in db.get_objects_as_dicts([ids['channel']])
+
+def test_clients():
+	"""Tests the OAuth client functions."""
+	owner_id = PregeneratedObjects.ids['account']
+	client_id = str(uuid4())
+	client_dict = {"client_id": client_id, "client_secret": "secret",
+		"name": "Test client", "description": "Test description",
+		"scopes": {"account:read": True, "channel:write": True},
+		"owner": owner_id, "type": "userapp", "account_id": None}
+
+	assert not db.get_client_by_id(client_id)
+	assert db.add_client(client_dict) == client_dict
+	assert db.get_client_by_id(client_id) == client_dict
+	assert client_dict in db.get_clients_for_user(owner_id, "owner")
+	assert db.get_clients_for_user("fakeid", "owner") == []
+
+	# Make sure cached clients can't be modified through returned dicts
+	db.get_client_by_id(client_id)['scopes']['conference:moderate'] = True
+	assert db.get_client_by_id(client_id) == client_dict
+
+	client_dict['name'] = "Edited client"
+	client_dict['scopes'] = {"account:read": True}
+	db.update_client(client_id, client_dict)
+	assert db.get_client_by_id(client_id) == client_dict
+
+	db.remove_client(client_id)
+	assert not db.get_client_by_id(client_id)
+	assert client_dict not in db.get_clients_for_user(owner_id, "owner")
+
+def run_alchemify(*arguments):
+	"""Runs utils/alchemify.py with the given arguments."""
+	return subprocess.run([sys.executable, os.path.join(ROOT_DIR, "utils", "alchemify.py")] + list(arguments),
+		cwd=ROOT_DIR, env=dict(os.environ, PYTHONPATH=ROOT_DIR), capture_output=True, text=True)
+
+def test_models_up_to_date():
+	"""Tests that the models and migrations match the object definitions."""
+	result = run_alchemify()
+	assert result.returncode == 0
+	with open(os.path.join(ROOT_DIR, "drywall", "db_models.py"), 'r') as models_file:
+		assert result.stdout == models_file.read()
+	result = run_alchemify("--check")
+	assert result.returncode == 0, result.stderr
+
+def test_migrations_applied():
+	"""Tests that all migrations are recorded as applied."""
+	assert db.migrate() == []
+	versions = [version for version, path in db.get_migrations()]
+	assert versions[0] == "0001_initial"
+	assert versions == sorted(set(versions))
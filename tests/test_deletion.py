@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Tests for removing deleted conferences and channels in the background.
+"""
+import pytest
+
+import drywall
+from drywall import db
+from drywall import deletion
+from drywall import jobs
+from drywall import objects
+from drywall import permissions
+from drywall import tokens
+import drywall.api # noqa: F401
+from test_objects import generate_objects
+
+def add_messages(channel_id, author_id, count):
+	"""Adds messages to a channel and returns their IDs."""
+	ids = []
+	for i in range(count):
+		message = objects.make_object_from_dict({"object_type": "message", "content": "message " + str(i),
+			"parent_channel": channel_id, "author": author_id, "post_date": "dummy", "edited": False})
+		db.add_object(message)
+		ids.append(message.id)
+	return ids
+
+def test_purge_conference(monkeypatch):
+	"""Tests removing a conference with everything in it, in batches."""
+	monkeypatch.setitem(drywall.config.config_file, 'deletion_batch_size', 2)
+	ids = generate_objects()[1]
+	message_ids = add_messages(ids['channel'], ids['account'], 5) + [ids['message']]
+	# A message in another conference that replies to a removed message
+	other_ids = generate_objects()[1]
+	reply = objects.make_object_from_dict({"object_type": "message", "content": "reply",
+		"parent_channel": other_ids['channel'], "author": ids['account'], "post_date": "dummy",
+		"edited": False, "reply_to": message_ids[0]})
+	db.add_object(reply)
+
+	assert permissions.get_permissions(ids['account'], ids['channel'])
+
+	deletion.delete(ids['conference'], 'conference')
+	# Deleted objects are gone right away, but still take up their IDs
+	assert db.get_object_as_dict_by_id(ids['conference']) is None
+	assert db.get_object_as_dict_by_id(ids['channel']) is None
+	assert db.get_objects_as_dicts_by_ids('channel', [ids['channel']]) == []
+	# No permissions are left in them, even if they were cached
+	assert not permissions.get_permissions(ids['account'], ids['channel'])
+	assert not permissions.get_permissions(ids['account'], ids['conference'])
+	assert db.id_taken(ids['conference'])
+	assert (ids['channel'], 'channel') in db.get_tombstones()
+	# They can't be referenced by new objects
+	with pytest.raises(TypeError):
+		add_messages(ids['channel'], ids['account'], 1)
+
+	assert deletion.purge_pending(throttle=False) >= 2
+	for object_type in ['conference', 'channel', 'role', 'conference_member', 'invite', 'report']:
+		assert not db.id_taken(ids[object_type])
+	for message_id in message_ids:
+		assert not db.id_taken(message_id)
+	assert db.get_tombstones() == []
+	assert 'reply_to' not in db.get_object_as_dict_by_id(reply.id)
+	# Objects outside of the conference are kept
+	assert db.id_taken(ids['account'])
+	assert db.id_taken(other_ids['conference'])
+
+def test_delete_api():
+	"""Tests deleting a conference through the API and the purge_deleted job."""
+	drywall.app.config['TESTING'] = True
+	ids = generate_objects()[1]
+	add_messages(ids['channel'], ids['account'], 3)
+	token = tokens.issue_token(ids['account'], "test_client", list(objects.Permissions.scopes))
+	with drywall.app.test_client() as client:
+		client.environ_base['HTTP_AUTHORIZATION'] = "Bearer " + token
+		result = client.delete('/api/v1/channels/' + ids['channel'])
+		assert result.status == "202 ACCEPTED"
+		assert result.json == {"id": ids['channel']}
+		assert client.get('/api/v1/channels/' + ids['channel']).status == "404 NOT FOUND"
+		assert client.delete('/api/v1/channels/' + ids['channel']).status == "404 NOT FOUND"
+		assert jobs.Runner(['deletion']).run_burst() >= 1
+		assert not db.id_taken(ids['channel'])
+		assert not db.id_taken(ids['message'])
+		assert db.id_taken(ids['conference'])
+
+		assert client.delete('/api/v1/conferences/' + ids['conference']).status == "202 ACCEPTED"
+		assert jobs.Runner(['deletion']).run_burst() >= 1
+		assert not db.id_taken(ids['conference'])
+		assert not db.id_taken(ids['role'])
+
+def test_purge_command():
+	"""Tests the purge-deleted command."""
+	conference_id = generate_objects()[1]['conference']
+	db.tombstone_object(conference_id)
+	result = drywall.app.test_cli_runner().invoke(args=['purge-deleted'])
+	assert result.exit_code == 0
+	assert not db.id_taken(conference_id)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Tests for the directory search index.
+"""
+import pytest
+
+from drywall import db
+from drywall import directory
+from drywall import objects
+
+from datetime import datetime
+from uuid import uuid4
+
+def add_account(username, index_user=True):
+	"""Creates an account and returns its ID."""
+	account = objects.make_object_from_dict({"object_type": "account", "username": username,
+		"index_user": index_user})
+	db.add_object(account)
+	return account.id
+
+def test_trigrams():
+	"""Tests splitting names into trigrams."""
+	assert directory.get_trigrams("Cat") == {"  c", " ca", "cat", "at "}
+	assert directory.get_trigrams("a b") == {"  a", " a ", "  b", " b "}
+	assert directory.get_trigrams("!!!") == set()
+
+def test_index_search():
+	"""Tests prefix and fuzzy matching and pagination on an index."""
+	index = directory.DirectoryIndex([("1", "john"), ("2", "Johnny"), ("3", "jon"),
+	                                  ("4", "jane"), ("5", "Johanna")])
+	# Prefix matches come first, followed by similar names
+	assert [id for id, position in index.search("joh", 10)] == ["5", "1", "2", "3"]
+	# "johm" does not start any name, but is close to "john"
+	assert [id for id, position in index.search("johm", 10)][0] == "1"
+	assert index.search("xyz", 10) == []
+
+	# Pages continue where the last one stopped, across both kinds of matches
+	pages = []
+	after = None
+	while True:
+		page = index.search("john", 1, after=after)
+		if not page:
+			break
+		pages.append(page[0][0])
+		after = page[0][1]
+	assert pages == [id for id, position in index.search("john", 10)]
+	assert pages[:2] == ["1", "2"]
+
+	index.remove("1")
+	index.add("4", "johnathan")
+	assert [id for id, position in index.search("john", 2)] == ["4", "2"]
+	index.remove("fakeid")
+
+def test_index_updates():
+	"""Tests that changes made through the ORM are applied to the index."""
+	# Long enough that names from other tests are never similar enough to match
+	prefix = "dirtest" + uuid4().hex
+	listed = add_account(prefix + "_listed")
+	unlisted = add_account(prefix + "_unlisted", index_user=False)
+	assert [id for id, position in directory.search("account", prefix, 10)] == [listed]
+
+	db.push_object(unlisted, objects.make_object_from_dict({"index_user": True}, extend=unlisted))
+	db.push_object(listed, objects.make_object_from_dict({"index_user": False}, extend=listed))
+	assert [id for id, position in directory.search("account", prefix, 10)] == [unlisted]
+
+	db.delete_object(unlisted)
+	assert directory.search("account", prefix, 10) == []
+
+	# A reloaded index gives the same results
+	conference = objects.make_object_from_dict({"object_type": "conference", "name": prefix + " Conference",
+		"icon": "icon", "owner": listed, "creation_date": datetime.utcnow(), "permissions": 1,
+		"index_conference": True})
+	db.add_object(conference)
+	directory.clear()
+	assert [id for id, position in directory.search("conference", prefix + " conf", 10)] == [conference.id]
+
+def test_invalid_cursor():
+	"""Tests that invalid positions are turned down."""
+	for after in [[2, 0, "a", "b"], [0, 0, "a"], [1, "a", 0, "b"]]:
+		with pytest.raises(ValueError):
+			directory.search("account", "a", 10, after=after)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Tests for the job queue.
+"""
+import pytest
+
+import drywall
+from drywall import db
+from drywall import jobs
+from drywall import metrics
+
+from sqlalchemy import text
+from uuid import uuid4
+import threading
+
+@pytest.fixture
+def queue():
+	"""Returns the name of a new queue; tasks registered on it are removed afterwards."""
+	name = "test-" + str(uuid4())
+	yield name
+	for task_name in [task_name for task_name, task in jobs._tasks.items() if task[1] == name]:
+		del jobs._tasks[task_name]
+
+def get_job(id):
+	with db.get_engine().connect() as connection:
+		return connection.execute(text("SELECT * FROM jobs WHERE id = :id"), {"id": id}).mappings().first()
+
+def test_run_jobs(queue):
+	"""Tests running jobs in order of priority."""
+	ran = []
+	jobs.task(queue + "-task", queue=queue)(ran.append)
+	with pytest.raises(ValueError):
+		jobs.enqueue(queue + "-unknown")
+	low = jobs.enqueue(queue + "-task", {"n": 1}, priority=5)
+	jobs.enqueue_many(queue + "-task", [{"n": 2}, {"n": 3}])
+	jobs.enqueue(queue + "-task", {"n": 4}, delay=3600)
+	assert 'drywall_jobs_ready{queue="' + queue + '"} 3.0' in metrics.dump_metrics()
+
+	assert jobs.Runner([queue]).run_burst() == 3
+	assert ran == [{"n": 2}, {"n": 3}, {"n": 1}]
+	# Finished jobs are removed; delayed ones wait
+	assert get_job(low) is None
+	assert jobs.Runner([queue]).run_burst() == 0
+	assert 'drywall_jobs_total{queue="' + queue + '",task="' + queue + '-task",status="done"} 3' in metrics.dump_metrics()
+	assert 'drywall_job_latency_seconds_count{queue="' + queue + '"} 3' in metrics.dump_metrics()
+
+def test_retry(queue):
+	"""Tests retrying failed jobs, and giving up on them."""
+	def fail(payload):
+		raise RuntimeError("failed on purpose")
+	jobs.task(queue + "-fail", queue=queue, max_attempts=2)(fail)
+	id = jobs.enqueue(queue + "-fail")
+
+	assert jobs.Runner([queue]).run_burst() == 1
+	job = get_job(id)
+	assert job['attempts'] == 1
+	assert "failed on purpose" in job['last_error']
+	assert job['failed'] is None
+	# The retry is delayed
+	assert db.claim_jobs(queue, 10, 60) == []
+
+	with db.get_engine().begin() as connection:
+		connection.execute(text("UPDATE jobs SET run_at = run_at - interval '1 hour' WHERE id = :id"), {"id": id})
+	assert jobs.Runner([queue]).run_burst() == 1
+	job = get_job(id)
+	assert job['attempts'] == 2
+	assert job['failed'] is not None
+	assert jobs.Runner([queue]).run_burst() == 0
+	dump = metrics.dump_metrics()
+	assert 'drywall_jobs_total{queue="' + queue + '",task="' + queue + '-fail",status="retried"} 1' in dump
+	assert 'drywall_jobs_total{queue="' + queue + '",task="' + queue + '-fail",status="failed"} 1' in dump
+
+def test_claim(queue):
+	"""Tests that claimed and locked jobs aren't handed out twice."""
+	jobs.task(queue + "-task", queue=queue)(lambda payload: None)
+	first, second = jobs.enqueue_many(queue + "-task", [1, 2])
+	with db.get_engine().connect() as connection:
+		connection.execute(text("SELECT id FROM jobs WHERE id = :id FOR UPDATE"), {"id": first})
+		claimed = db.claim_jobs(queue, 10, 60)
+		assert [job['id'] for job in claimed] == [second]
+		assert claimed[0]['attempts'] == 1
+		assert claimed[0]['payload'] == 2
+		assert db.claim_jobs(queue, 10, 60) == []
+	assert [job['id'] for job in db.claim_jobs(queue, 10, 60)] == [first]
+	db.finish_jobs([first, second])
+
+def test_concurrency(queue):
+	"""Tests that runners can't run more jobs from a queue at once than its concurrency allows."""
+	jobs.task(queue + "-task", queue=queue)(lambda payload: None)
+	jobs.enqueue(queue + "-task")
+	with jobs.queue_slot(queue, 1) as slot:
+		assert slot
+		with jobs.queue_slot(queue, 1) as other_slot:
+			assert not other_slot
+		assert jobs.Runner([queue]).run_burst() == 0
+	assert jobs.Runner([queue]).run_burst() == 1
+
+def test_background_runner(queue):
+	"""Tests that a running runner picks up new jobs."""
+	done = threading.Event()
+	jobs.task(queue + "-task", queue=queue)(lambda payload: done.set())
+	runner = jobs.Runner([queue])
+	runner.start()
+	try:
+		jobs.enqueue(queue + "-task")
+		assert done.wait(timeout=30)
+	finally:
+		runner.stop()
+	assert runner.wait(timeout=30)
+
+def test_run_jobs_command(queue):
+	"""Tests the run-jobs command."""
+	ran = []
+	jobs.task(queue + "-task", queue=queue)(ran.append)
+	jobs.enqueue(queue + "-task", "payload")
+	result = drywall.create_app().test_cli_runner().invoke(args=['run-jobs', '--burst', '--queue', queue])
+	assert result.exit_code == 0
+	assert "Ran 1 jobs." in result.output
+	assert ran == ["payload"]
@@ -132,6 +132,13 @@ def test_validate_objects():
 		key_lists.append(object.default_keys)
 		# - unique keys
 		key_lists.append(object.unique_keys)
+		# - search keys
+		key_lists.append(object.search_keys)
+		# - index keys (which can also include the ID)
+		key_lists += [[key for key in index_keys if key != 'id'] for index_keys in object.index_keys]
+		key_lists += object.unique_index_keys
+		# - directory keys
+		key_lists.append([key for key in [object.directory_key, object.directory_flag] if key])
 		# ...
 		for list in key_lists:
 			for key in list:
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Tests for the effective permission resolver.
+"""
+import pytest
+
+import drywall
+from drywall import db
+from drywall import objects
+from drywall import permissions
+from drywall import tokens
+import drywall.api
+
+from datetime import datetime
+from uuid import uuid4
+
+def add_object(object_dict):
+	"""Creates an object from a dict, adds it to the database and returns its ID."""
+	object = objects.make_object_from_dict(object_dict)
+	db.add_object(object)
+	return object.id
+
+def patch_object(id, patch_dict):
+	"""Patches the object with the given ID."""
+	db.push_object(id, objects.make_object_from_dict(patch_dict, extend=id))
+
+def make_conference():
+	"""
+	Creates a conference with an owner, a member with one role, and a text
+	channel. Returns a dict with the IDs of the created objects.
+	"""
+	ids = {}
+	for account in ['owner', 'member', 'outsider']:
+		ids[account] = add_object({"object_type": "account", "username": "permtest_" + str(uuid4())})
+	ids['conference'] = add_object({"object_type": "conference", "name": "Permission test",
+		"icon": "icon", "owner": ids['owner'], "creation_date": datetime.utcnow(),
+		"permissions": 1})
+	ids['role'] = add_object({"object_type": "role", "name": "Writer", "permissions": 6,
+		"parent_conference": ids['conference']})
+	ids['conference_member'] = add_object({"object_type": "conference_member",
+		"user_id": ids['member'], "parent_conference": ids['conference'],
+		"roles": [ids['role']], "permissions": 0})
+	ids['channel'] = add_object({"object_type": "channel", "name": "test", "channel_type": "text",
+		"parent_conference": ids['conference'], "permissions": 3})
+	return ids
+
+def test_permission_tables():
+	"""Tests the precomputed bit tables."""
+	assert permissions.ALL_PERMISSIONS == 8191
+	assert permissions.to_int("21101") == 21101 & 8191
+	assert permissions.to_int(None) == 0
+	assert permissions.to_shorthands(6) == ('read_channel', 'write_channel')
+	assert permissions.get_bit('kick') == 512
+	assert permissions.get_bit('channel:write') == 4
+	for value in [0, 1, 95, 4097, 8191]:
+		assert set(permissions.to_shorthands(value)) == set(objects.Permissions(value).value_to_shorthands())
+
+def test_permission_resolution():
+	"""Tests effective permissions of owners, members and outsiders."""
+	ids = make_conference()
+
+	# Conference base (1) | role (6); write_channel is not enabled in the channel
+	assert permissions.get_permissions(ids['member'], ids['conference']) == 7
+	assert permissions.get_permissions(ids['member'], ids['channel']) == 3
+	assert permissions.has_permission(ids['member'], ids['channel'], 'channel:read')
+	assert not permissions.has_permission(ids['member'], ids['channel'], 'channel:write')
+
+	assert permissions.get_permissions(ids['owner'], ids['channel']) == permissions.ALL_PERMISSIONS
+	assert permissions.get_permissions(ids['outsider'], ids['channel']) == 0
+	assert permissions.get_permissions(ids['member'], 'fakeid') is None
+	assert permissions.get_permissions(ids['member'], ids['role']) is None
+	assert not permissions.has_permission(ids['member'], 'fakeid', 'channel:read')
+
+def test_permission_cache(query_counter):
+	"""Tests memoization and invalidation of resolved permissions."""
+	ids = make_conference()
+	assert permissions.get_permissions(ids['member'], ids['channel']) == 3
+
+	with query_counter() as counter:
+		assert permissions.get_permissions(ids['member'], ids['channel']) == 3
+	assert counter.count == 0
+
+	# Patching roles, channels and members drops cached results
+	patch_object(ids['role'], {"permissions": 6 | 512})
+	assert permissions.get_permissions(ids['member'], ids['channel']) == 3 | 512
+
+	patch_object(ids['channel'], {"permissions": 7})
+	assert permissions.get_permissions(ids['member'], ids['channel']) == 7 | 512
+
+	patch_object(ids['conference_member'], {"banned": True})
+	assert permissions.get_permissions(ids['member'], ids['channel']) == 0
+
+	patch_object(ids['conference_member'], {"banned": False, "permissions": 4096})
+	assert permissions.get_permissions(ids['member'], ids['channel']) == permissions.ALL_PERMISSIONS
+
+	db.delete_object(ids['conference_member'])
+	assert permissions.get_permissions(ids['member'], ids['channel']) == 0
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_channel_audience(monkeypatch, use_numpy):
+	"""Tests bulk permission evaluation, with and without NumPy."""
+	if use_numpy:
+		pytest.importorskip("numpy")
+	else:
+		monkeypatch.setattr(permissions, "numpy", None)
+	ids = make_conference()
+	reader = add_object({"object_type": "account", "username": "permtest_" + str(uuid4())})
+	add_object({"object_type": "conference_member", "user_id": reader,
+		"parent_conference": ids['conference'], "permissions": 2})
+	banned = add_object({"object_type": "account", "username": "permtest_" + str(uuid4())})
+	add_object({"object_type": "conference_member", "user_id": banned,
+		"parent_conference": ids['conference'], "permissions": 2, "banned": True})
+	moderators = add_object({"object_type": "role", "name": "Moderator", "permissions": 4096,
+		"parent_conference": ids['conference']})
+	admin = add_object({"object_type": "account", "username": "permtest_" + str(uuid4())})
+	add_object({"object_type": "conference_member", "user_id": admin,
+		"parent_conference": ids['conference'], "roles": [moderators], "permissions": 0})
+	permissions.invalidate()
+
+	audience = permissions.get_channel_audience(ids['channel'])
+	assert set(audience) == {ids['owner'], ids['member'], reader, admin}
+	assert set(permissions.get_channel_audience(ids['channel'], 'channel:write')) == {ids['owner'], admin}
+	for account in [ids['owner'], ids['member'], ids['outsider'], reader, banned, admin]:
+		assert (account in audience) == permissions.has_permission(account, ids['channel'], permissions.READ_PERMISSIONS)
+
+	# Cached until the conference changes
+	assert permissions.get_channel_audience(ids['channel']) is audience
+	patch_object(ids['channel'], {"permissions": 1})
+	assert set(permissions.get_channel_audience(ids['channel'])) == {ids['owner'], admin}
+	assert permissions.get_channel_audience('fakeid') == ()
+
+def test_authorization():
+	"""Tests the authorization checks on API endpoints."""
+	ids = make_conference()
+	drywall.app.config['TESTING'] = True
+	client = drywall.app.test_client()
+	all_scopes = list(objects.Permissions.scopes)
+	def auth(account, scopes=all_scopes):
+		return {"Authorization": "Bearer " + tokens.issue_token(account, "test_client", scopes)}
+	conference_endpoint = '/api/v1/conferences/' + ids['conference']
+	channel_endpoint = '/api/v1/channels/' + ids['channel']
+
+	assert client.get(conference_endpoint).status == "401 UNAUTHORIZED"
+	assert client.get(conference_endpoint, headers=auth(ids['owner'])).status == "200 OK"
+	assert client.get(conference_endpoint, headers=auth(ids['member'])).status == "200 OK"
+	assert client.get(conference_endpoint, headers=auth(ids['outsider'])).status == "403 FORBIDDEN"
+	assert client.get(conference_endpoint, headers=auth(ids['owner'], ["channel:read"])).status == "403 FORBIDDEN"
+	assert client.patch(conference_endpoint, json={"name": "new_name"},
+	                    headers=auth(ids['member'])).status == "403 FORBIDDEN"
+	assert client.patch(conference_endpoint, json={"name": "new_name"},
+	                    headers=auth(ids['owner'])).status == "200 OK"
+
+	# Channel permissions are limited by the channel
+	assert client.get(channel_endpoint, headers=auth(ids['member'])).status == "200 OK"
+	assert client.get('/api/v1/id/' + ids['channel'], headers=auth(ids['member'])).status == "200 OK"
+	assert client.patch(channel_endpoint, json={"name": "new_name"},
+	                    headers=auth(ids['member'])).status == "403 FORBIDDEN"
+
+	# Assigning roles needs the role:moderate scope and permission
+	member_endpoint = conference_endpoint + '/members/' + ids['conference_member']
+	patch_object(ids['role'], {"permissions": 6 | 256})
+	assert client.patch(member_endpoint, json={"nickname": "nick"},
+	                    headers=auth(ids['member'])).status == "200 OK"
+	assert client.patch(member_endpoint, json={"roles": []},
+	                    headers=auth(ids['member'])).status == "403 FORBIDDEN"
+
+	# Missing objects and objects of other types are left to the endpoint
+	assert client.get('/api/v1/conferences/fakeid', headers=auth(ids['owner'])).status == "404 NOT FOUND"
+	assert client.get('/api/v1/conferences/' + ids['role'], headers=auth(ids['owner'])).status == "400 BAD REQUEST"
+	assert client.get('/api/v1/id/' + ids['role']).status == "401 UNAUTHORIZED"
+
+def test_child_authorization():
+	"""Tests that roles, members and invites are checked in their conference on every route."""
+	ids = make_conference()
+	ids['invite'] = add_object({"object_type": "invite", "code": "permtest_" + str(uuid4()),
+		"conference_id": ids['conference'], "creator": ids['owner']})
+	drywall.app.config['TESTING'] = True
+	client = drywall.app.test_client()
+	all_scopes = list(objects.Permissions.scopes)
+	def auth(account, scopes=all_scopes):
+		return {"Authorization": "Bearer " + tokens.issue_token(account, "test_client", scopes)}
+
+	for endpoint in ['/api/v1/id/' + ids['role'], '/api/v1/roles/' + ids['role'],
+	                 '/api/v1/id/' + ids['conference_member'], '/api/v1/id/' + ids['invite'],
+	                 '/api/v1/invites/' + ids['invite']]:
+		assert client.get(endpoint).status == "401 UNAUTHORIZED"
+		assert client.get(endpoint, headers=auth(ids['outsider'])).status == "403 FORBIDDEN"
+		assert client.get(endpoint, headers=auth(ids['member'])).status == "200 OK"
+		assert client.post(endpoint + '/report', json={"note": "test"}).status == "401 UNAUTHORIZED"
+
+	# Changing roles and members needs the same scopes and permissions as
+	# on the conference's endpoints
+	assert client.patch('/api/v1/roles/' + ids['role'], json={"permissions": 8191}).status == "401 UNAUTHORIZED"
+	assert client.patch('/api/v1/id/' + ids['role'], json={"permissions": 8191},
+	                    headers=auth(ids['member'])).status == "403 FORBIDDEN"
+	assert client.patch('/api/v1/id/' + ids['conference_member'], json={"banned": True, "roles": []}).status == "401 UNAUTHORIZED"
+	assert client.patch('/api/v1/id/' + ids['conference_member'], json={"roles": []},
+	                    headers=auth(ids['member'], ["conference_member:moderate_nick"])).status == "403 FORBIDDEN"
+	assert client.patch('/api/v1/id/' + ids['role'], json={"permissions": 7},
+	                    headers=auth(ids['owner'])).status == "200 OK"
+	assert permissions.get_permissions(ids['member'], ids['conference']) == 7
+	# Objects can't be moved into other conferences
+	other_conference = add_object({"object_type": "conference", "name": "Other", "icon": "icon",
+		"owner": ids['member'], "creation_date": datetime.utcnow(), "permissions": 1})
+	assert client.patch('/api/v1/id/' + ids['role'], json={"parent_conference": other_conference},
+	                    headers=auth(ids['owner'])).status == "400 BAD REQUEST"
+
+	# Creating objects in a conference through the generic and top-level routes
+	member_dict = {"object_type": "conference_member", "user_id": ids['outsider'],
+	               "parent_conference": ids['conference'], "permissions": 8191}
+	assert client.post('/api/v1/id', json=member_dict).status == "401 UNAUTHORIZED"
+	assert client.post('/api/v1/id', json=member_dict, headers=auth(ids['outsider'])).status == "403 FORBIDDEN"
+	role_dict = {"object_type": "role", "name": "Admin", "permissions": 8191, "parent_conference": ids['conference']}
+	for endpoint in ['/api/v1/id', '/api/v1/roles']:
+		assert client.post(endpoint, json=role_dict).status == "401 UNAUTHORIZED"
+		assert client.post(endpoint, json=role_dict, headers=auth(ids['member'])).status == "403 FORBIDDEN"
+	invite_dict = {"object_type": "invite", "code": "permtest_" + str(uuid4()),
+	               "conference_id": ids['conference'], "creator": ids['outsider']}
+	assert client.post('/api/v1/invites', json=invite_dict).status == "401 UNAUTHORIZED"
+	assert client.post('/api/v1/invites', json=invite_dict, headers=auth(ids['outsider'])).status == "403 FORBIDDEN"
+	assert client.post('/api/v1/id', json=role_dict, headers=auth(ids['owner'])).status == "201 CREATED"
+
+	# Stashes are checked per object
+	stash = {"id_list": [ids['member'], ids['role'], ids['channel']]}
+	assert client.post('/api/v1/stash/request', json={"id_list": [ids['member']]}).status == "200 OK"
+	assert client.post('/api/v1/stash/request', json=stash).status == "401 UNAUTHORIZED"
+	assert client.post('/api/v1/stash/request', json=stash, headers=auth(ids['outsider'])).status == "403 FORBIDDEN"
+	result = client.post('/api/v1/stash/request?fields=name', json=stash, headers=auth(ids['member']))
+	assert result.status == "200 OK"
+	assert result.json[ids['role']] == {"id": ids['role'], "type": "object", "object_type": "role", "name": "Writer"}
+
+def test_message_authorization():
+	"""Tests that messages are checked in their channel on every route."""
+	ids = make_conference()
+	message_dict = {"object_type": "message", "content": "test", "parent_channel": ids['channel'],
+	                "author": ids['owner'], "post_date": datetime.utcnow(), "edited": False}
+	message_id = add_object(message_dict)
+	drywall.app.config['TESTING'] = True
+	client = drywall.app.test_client()
+	def auth(account, scopes=list(objects.Permissions.scopes)):
+		return {"Authorization": "Bearer " + tokens.issue_token(account, "test_client", scopes)}
+
+	for endpoint in ['/api/v1/messages/' + message_id, '/api/v1/id/' + message_id]:
+		assert client.get(endpoint).status == "401 UNAUTHORIZED"
+		assert client.get(endpoint, headers=auth(ids['outsider'])).status == "403 FORBIDDEN"
+		assert client.get(endpoint, headers=auth(ids['member'], ["conference:read"])).status == "403 FORBIDDEN"
+		assert client.get(endpoint, headers=auth(ids['member'])).status == "200 OK"
+		assert client.post(endpoint + '/report', json={"note": "test"}).status == "401 UNAUTHORIZED"
+		assert client.post(endpoint + '/report', json={"note": "test"},
+		                   headers=auth(ids['outsider'])).status == "403 FORBIDDEN"
+		# Only the author can edit the message, and the member can't
+		# moderate messages in the channel
+		assert client.patch(endpoint, json={"content": "edited"}, headers=auth(ids['member'])).status == "403 FORBIDDEN"
+		assert client.delete(endpoint, headers=auth(ids['member'])).status == "403 FORBIDDEN"
+		assert client.patch(endpoint, json={"content": "edited"}, headers=auth(ids['owner'])).status == "200 OK"
+	stash = {"id_list": [message_id]}
+	assert client.post('/api/v1/stash/request', json=stash).status == "401 UNAUTHORIZED"
+	assert client.post('/api/v1/stash/request', json=stash, headers=auth(ids['outsider'])).status == "403 FORBIDDEN"
+	result = client.post('/api/v1/stash/request?fields=content', json=stash, headers=auth(ids['member']))
+	assert result.json[message_id] == {"id": message_id, "type": "object", "object_type": "message", "content": "edited"}
+
+	# Messages can only be posted into channels the account can write in,
+	# as the account itself
+	new_message = message_dict.copy()
+	new_message['post_date'] = new_message['post_date'].isoformat()
+	for endpoint in ['/api/v1/messages', '/api/v1/id']:
+		assert client.post(endpoint, json=new_message).status == "401 UNAUTHORIZED"
+		assert client.post(endpoint, json=new_message, headers=auth(ids['member'])).status == "403 FORBIDDEN"
+		assert client.post(endpoint, json=new_message, headers=auth(ids['outsider'])).status == "403 FORBIDDEN"
+		assert client.post(endpoint, json=dict(new_message, author=ids['member']),
+		                   headers=auth(ids['owner'])).status == "403 FORBIDDEN"
+		assert client.post(endpoint, json=new_message, headers=auth(ids['owner'])).status == "201 CREATED"
+
+	# Moderators can delete other accounts' messages
+	patch_object(ids['role'], {"permissions": 22})
+	patch_object(ids['channel'], {"permissions": 19})
+	assert client.patch('/api/v1/messages/' + message_id, json={"content": "moderated"},
+	                    headers=auth(ids['member'])).status == "403 FORBIDDEN"
+	assert client.delete('/api/v1/messages/' + message_id, headers=auth(ids['member'], ["channel:read"])).status == "403 FORBIDDEN"
+	assert client.delete('/api/v1/messages/' + message_id, headers=auth(ids['member'])).status == "200 OK"
+	assert client.get('/api/v1/messages/' + message_id, headers=auth(ids['member'])).status == "404 NOT FOUND"
+
+def test_authorization_warm_path(query_counter):
+	"""Tests that authorization makes no queries once the cache is warm."""
+	ids = make_conference()
+	drywall.app.config['TESTING'] = True
+	client = drywall.app.test_client()
+	token = tokens.issue_token(ids['member'], "test_client", list(objects.Permissions.scopes))
+	tokens.verify_token(token)
+	client.environ_base['HTTP_AUTHORIZATION'] = "Bearer " + token
+	endpoint = '/api/v1/conferences/' + ids['conference'] + '/channels/' + ids['channel']
+
+	assert client.get(endpoint).status == "200 OK"
+	with query_counter() as counter:
+		assert client.get(endpoint).status == "200 OK"
+	# Only the endpoint's own queries: the conference and the channel
+	assert counter.count == 3
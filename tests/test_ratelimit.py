@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Tests for the rate limiter.
+"""
+import pytest
+
+import drywall
+from drywall import objects
+from drywall import ratelimit
+from drywall import tokens
+import drywall.api # noqa: F401
+
+from uuid import uuid4
+
+TEST_LIMITS = {
+	"test": {
+		"routes": ["GET /api/v1/instance"],
+		"account": {"rate": 1, "burst": 2},
+		"ip": {"rate": 1, "burst": 3}
+	}
+}
+
+@pytest.fixture
+def client():
+	drywall.app.config['TESTING'] = True
+	with drywall.app.test_client() as client:
+		yield client
+	ratelimit.configure()
+
+def get_instance(client, ip, account=None):
+	"""Requests /api/v1/instance from the given IP address, as the given account."""
+	headers = {}
+	if account:
+		token = tokens.issue_token(account, "test_client", list(objects.Permissions.scopes))
+		headers["Authorization"] = "Bearer " + token
+	return client.get('/api/v1/instance', headers=headers, environ_base={"REMOTE_ADDR": ip})
+
+def test_parse_limits():
+	"""Tests parsing of the rate_limits setting."""
+	routes, default = ratelimit.parse_limits({
+		"a": {"routes": ["POST /api/v1/messages", "/api/v1/id"], "ip": {"rate": 1, "burst": 1}},
+		"b": {"account": {"rate": 0.5, "burst": 10}}
+	})
+	assert routes[("POST", "/api/v1/messages")] == ("a", {"ip": (1.0, 1.0)})
+	assert routes[(None, "/api/v1/id")][0] == "a"
+	assert default == ("b", {"account": (0.5, 10.0)})
+	for invalid in [{"rate": 0, "burst": 1}, {"rate": 1, "burst": 0.5}, {"rate": "1", "burst": 1}]:
+		with pytest.raises(ValueError):
+			ratelimit.parse_limits({"a": {"ip": invalid}})
+
+@pytest.mark.parametrize("backend", ["memory", "database"])
+def test_rate_limits(client, backend):
+	"""Tests limiting requests per IP address and per account."""
+	ratelimit.configure(TEST_LIMITS, backend=backend)
+	ip = "test-" + str(uuid4())
+	for i in range(3):
+		assert get_instance(client, ip).status == "200 OK"
+	response = get_instance(client, ip)
+	assert response.status == "429 TOO MANY REQUESTS"
+	assert response.json['error_code'] == 14
+	assert response.headers['Retry-After'] == "1"
+
+	# The account runs out before the IP address
+	ip = "test-" + str(uuid4())
+	account = "test-" + str(uuid4())
+	assert get_instance(client, ip, account).status == "200 OK"
+	assert get_instance(client, ip, account).status == "200 OK"
+	assert get_instance(client, ip, account).status == "429 TOO MANY REQUESTS"
+	if backend == "memory":
+		# Turned down requests don't take tokens from the other buckets
+		assert get_instance(client, ip, "test-" + str(uuid4())).status == "200 OK"
+	assert get_instance(client, ip, "test-" + str(uuid4())).status == "429 TOO MANY REQUESTS"
+
+	# Other routes are not limited
+	assert client.get('/api/v1/id/0', environ_base={"REMOTE_ADDR": ip}).status == "200 OK"
+
+def test_refill(monkeypatch):
+	"""Tests refilling of in-memory buckets."""
+	ratelimit.configure(TEST_LIMITS)
+	now = [1000.0]
+	monkeypatch.setattr(ratelimit.time, "monotonic", lambda: now[0])
+	bucket = [(("test", "ip", "test-" + str(uuid4())), 2.0, 2.0)]
+	assert ratelimit._take_memory(bucket) == 0
+	assert ratelimit._take_memory(bucket) == 0
+	assert ratelimit._take_memory(bucket) == 0.5
+	now[0] += 0.25
+	assert ratelimit._take_memory(bucket) == 0.25
+	now[0] += 0.25
+	assert ratelimit._take_memory(bucket) == 0
+	# Buckets never hold more than burst tokens
+	now[0] += 100
+	assert ratelimit._take_memory(bucket) == 0
+	assert ratelimit._take_memory(bucket) == 0
+	assert ratelimit._take_memory(bucket) > 0
+	ratelimit.configure()
+
+def test_trusted_proxies(client, monkeypatch):
+	"""Tests keeping IP address buckets per client behind a reverse proxy."""
+	ratelimit.configure(TEST_LIMITS)
+	proxy = "test-" + str(uuid4())
+	def get_forwarded(ip):
+		return client.get('/api/v1/instance', headers={"X-Forwarded-For": ip}, environ_base={"REMOTE_ADDR": proxy})
+
+	monkeypatch.setattr(drywall.config, "_config", dict(drywall.config._config, trusted_proxies=1))
+	drywall.create_app()
+	try:
+		for ip in ["test-" + str(uuid4()) for i in range(2)]:
+			for i in range(3):
+				assert get_forwarded(ip).status == "200 OK"
+			assert get_forwarded(ip).status == "429 TOO MANY REQUESTS"
+	finally:
+		monkeypatch.undo()
+		drywall.create_app()
+
+	# Without trusted proxies, the header is ignored
+	for i in range(3):
+		assert get_forwarded("test-" + str(uuid4())).status == "200 OK"
+	assert get_forwarded("test-" + str(uuid4())).status == "429 TOO MANY REQUESTS"
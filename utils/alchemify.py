@@ -1,8 +1,41 @@
 #!/usr/bin/env python3
 # coding: utf-8
-"""Generates SQLAlchemy tables from drywall object definitions"""
+"""
+Generates SQLAlchemy tables from drywall object definitions, and migrations
+for the changes made to them.
+
+To change the schema, change the object definitions, then regenerate the
+tables and write a migration with the changes:
+
+    $ python3 utils/alchemify.py > drywall/db_models.py
+    $ python3 utils/alchemify.py --migration add_something
+
+Migrations are written to drywall/migrations, as numbered SQL files; they
+are made by comparing the tables in drywall/db_models.py with the snapshot
+of the schema at the time of the last migration (drywall/migrations/schema.json),
+which is updated as well. Always review generated migrations: changed
+columns have to be migrated by hand.
+
+--check exits with an error if the tables have changes that don't have a
+migration yet.
+"""
 from drywall import objects
 
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateColumn, CreateIndex, CreateTable
+import argparse
+import datetime
+import os
+import simplejson as json
+import sys
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'drywall', 'migrations')
+SNAPSHOT_FILE = os.path.join(MIGRATIONS_DIR, 'schema.json')
+
+# Text search configuration used for search vectors. "simple" does not do any
+# language-specific stemming, as messages can be in any language.
+TEXT_SEARCH_CONFIG = "simple"
+
 class FauxTable:
 	"""Table to be turned into an SQLAlchemy table"""
 	def __init__(self, class_name, table_name):
@@ -10,10 +43,16 @@ class FauxTable:
 		self.table_name = table_name
 		self.columns = {}
 		self.columns['id'] = "Column('id', String(255), primary_key=True)"
+		self.attributes = {}
+		self.indexes = []
 
 	def dump_orm(self):
 		print("class " + self.class_name + "(Base, CustomSerializerMixin):")
 		print("	__tablename__ = '" + self.table_name + "'")
+		if self.indexes:
+			print("	__table_args__ = (" + ", ".join(self.indexes) + ",)")
+		for attr_name, attr_info in self.attributes.items():
+			print("	" + attr_name + " = " + attr_info)
 		print("")
 		for col_name, col_info in self.columns.items():
 			print("	" + col_name + " = " + col_info)
@@ -24,7 +63,8 @@ def get_object_properties(object):
 	properties = {}
 	for prop in ['type', 'object_type', 'valid_keys', 'required_keys',
 				'default_keys', 'key_types', 'id_key_types',
-				'nonrewritable_keys', 'unique_keys']:
+				'nonrewritable_keys', 'unique_keys', 'search_keys',
+				'index_keys', 'unique_index_keys']:
 		if hasattr(object, prop):
 			properties[prop] = getattr(object, prop)
 		else:
@@ -56,6 +96,61 @@ def is_unique(object_properties, key):
 		return "unique=True"
 	return ""
 
+def is_indexed(object_properties, key):
+	"""
+	Checks if key needs an index of its own and returns ORM statement if
+	needed. Keys that contain an ID are indexed, as they're used to look up
+	related objects, unless they're the first key of a declared index, which
+	can be used for those lookups as well.
+	"""
+	if object_properties['key_types'][key] != "id":
+		return ""
+	if object_properties['unique_keys'] and key in object_properties['unique_keys']:
+		return ""
+	for index_keys in (object_properties['index_keys'] or []) + (object_properties['unique_index_keys'] or []):
+		if index_keys[0] == key:
+			return ""
+	return "index=True"
+
+def add_declared_indexes(object_table, object_properties):
+	"""
+	Adds an index for every list of keys in the object's index keys, and a
+	unique index for every list in its unique index keys.
+	"""
+	for index_keys in object_properties['index_keys'] or []:
+		object_table.indexes.append("Index('ix_" + object_table.table_name + "_" + "_".join(index_keys) +
+			"', " + ", ".join("'" + key + "'" for key in index_keys) + ")")
+	for index_keys in object_properties['unique_index_keys'] or []:
+		object_table.indexes.append("Index('ix_" + object_table.table_name + "_" + "_".join(index_keys) +
+			"', " + ", ".join("'" + key + "'" for key in index_keys) + ", unique=True)")
+
+def add_array_indexes(object_table, object_properties):
+	"""
+	Adds a GIN index for every list key, so that containment and overlap
+	queries on them (see db.get_object_by_key_value_pair) don't have to
+	scan the whole table.
+	"""
+	for key in object_properties['valid_keys']:
+		if object_properties['key_types'][key] in ["list", "id_list"]:
+			object_table.indexes.append("Index('ix_" + object_table.table_name + "_" + key +
+				"', '" + key + "', postgresql_using='gin')")
+
+def add_search_vector(object_table, object_properties):
+	"""
+	Adds a generated tsvector column with the object's search keys and a GIN
+	index on it, if the object has any search keys. The column is deferred
+	and left out of serialization, as it's only used in queries.
+	"""
+	search_keys = object_properties['search_keys']
+	if not search_keys:
+		return
+	document = " || ' ' || ".join("coalesce(" + key + ", '')" for key in search_keys)
+	object_table.columns['search_vector'] = ('deferred(Column(postgresql.TSVECTOR, Computed("to_tsvector(\'' +
+		TEXT_SEARCH_CONFIG + '\', ' + document + ')", persisted=True)))')
+	object_table.indexes.append("Index('ix_" + object_table.table_name +
+		"_search_vector', 'search_vector', postgresql_using='gin')")
+	object_table.attributes['serialize_rules'] = "('-search_vector',)"
+
 def is_required(object_properties, key):
 	"""Checks if key is required and returns ORM statement if needed"""
 	if object_properties['required_keys'] and key in object_properties['required_keys']:
@@ -66,11 +161,13 @@ def is_id(object_properties, key):
 	"""Checks if key contains an ID and returns ORM relationship statement if needed"""
 	if object_properties['key_types'][key] == "id":
 		id_key_type = object_properties['id_key_types'][key]
-		if id_key_type == 'any':
-			if object_properties['object_type'] == 'report' and key == 'target':
+		if object_properties['object_type'] == 'report':
+			# Reports go away along with the object they're about
+			if id_key_type == 'any':
 				return "ForeignKey('objects.id', ondelete='CASCADE')"
-			else:
-				return "ForeignKey('objects.id')"
+			return "ForeignKey('" + id_key_type + ".id', ondelete='CASCADE')"
+		if id_key_type == 'any':
+			return "ForeignKey('objects.id')"
 		else:
 			return "ForeignKey('" + id_key_type + ".id')"
 	return ""
@@ -104,6 +201,124 @@ def ormify(args):
 	return final_string
 
 
+def get_schema(metadata):
+	"""
+	Returns a snapshot of the schema described by the given SQLAlchemy
+	metadata: a dict with table names as keys and dicts with the DDL of
+	every column and index as values.
+	"""
+	dialect = postgresql.dialect()
+	schema = {}
+	for table in metadata.sorted_tables:
+		columns = {}
+		for column in table.columns:
+			ddl = str(CreateColumn(column).compile(dialect=dialect))
+			if column.primary_key:
+				ddl += " PRIMARY KEY"
+			if column.unique:
+				ddl += " UNIQUE"
+			for foreign_key in column.foreign_keys:
+				target_table, target_column = foreign_key.target_fullname.split('.')
+				ddl += " REFERENCES " + target_table + " (" + target_column + ")"
+				if foreign_key.ondelete:
+					ddl += " ON DELETE " + foreign_key.ondelete
+			columns[column.name] = ddl
+		indexes = {}
+		for index in sorted(table.indexes, key=lambda index: index.name):
+			indexes[index.name] = str(CreateIndex(index, if_not_exists=True).compile(dialect=dialect))
+		schema[table.name] = {"columns": columns, "indexes": indexes}
+	return schema
+
+def diff_schema(old, new, metadata):
+	"""
+	Returns a list of SQL statements that turn the old schema snapshot into
+	the new one. Statements are idempotent, so that migrations can be
+	applied to databases that already have some of the changes.
+	"""
+	dialect = postgresql.dialect()
+	statements = []
+	for table_name, table in new.items():
+		if table_name not in old:
+			create_table = str(CreateTable(metadata.tables[table_name], if_not_exists=True).compile(dialect=dialect))
+			statements.append("\n".join(line.rstrip() for line in create_table.strip().splitlines()))
+			statements += table['indexes'].values()
+			continue
+		old_table = old[table_name]
+		for column_name, column in table['columns'].items():
+			if column_name not in old_table['columns']:
+				statements.append('ALTER TABLE "' + table_name + '" ADD COLUMN IF NOT EXISTS ' + column)
+			elif old_table['columns'][column_name] != column:
+				statements.append("-- TODO: column " + table_name + "." + column_name + " changed from \"" +
+				                  old_table['columns'][column_name] + "\" to \"" + column + "\"; migrate it by hand")
+		for column_name in old_table['columns']:
+			if column_name not in table['columns']:
+				statements.append('ALTER TABLE "' + table_name + '" DROP COLUMN IF EXISTS "' + column_name + '"')
+		for index_name, index in old_table['indexes'].items():
+			if table['indexes'].get(index_name) != index:
+				statements.append('DROP INDEX IF EXISTS "' + index_name + '"')
+		for index_name, index in table['indexes'].items():
+			if old_table['indexes'].get(index_name) != index:
+				statements.append(index)
+	for table_name in reversed(list(old)):
+		if table_name not in new:
+			statements.append('DROP TABLE IF EXISTS "' + table_name + '"')
+	return statements
+
+def load_snapshot():
+	"""Returns the schema snapshot of the last migration."""
+	if not os.path.exists(SNAPSHOT_FILE):
+		return {}
+	with open(SNAPSHOT_FILE, 'r') as snapshot_file:
+		return json.loads(snapshot_file.read())
+
+def get_pending_changes():
+	"""
+	Returns a tuple with the SQL statements needed to bring the last
+	snapshot up to date with drywall/db_models.py, and the new snapshot.
+	"""
+	from drywall import db_models
+	schema = get_schema(db_models.Base.metadata)
+	return (diff_schema(load_snapshot(), schema, db_models.Base.metadata), schema)
+
+def write_migration(name):
+	"""
+	Writes a migration with the pending changes to drywall/migrations and
+	updates the schema snapshot. Returns the path of the migration, or None
+	if there are no changes.
+	"""
+	statements, schema = get_pending_changes()
+	if not statements:
+		return None
+	numbers = [int(file_name.split('_', 1)[0]) for file_name in os.listdir(MIGRATIONS_DIR)
+	           if file_name.endswith('.sql')]
+	path = os.path.join(MIGRATIONS_DIR, "%04d_%s.sql" % (max(numbers, default=0) + 1, name))
+	with open(path, 'w') as migration_file:
+		migration_file.write("-- Generated by utils/alchemify.py on " + datetime.date.today().isoformat() + "\n\n")
+		migration_file.write(";\n\n".join(statements) + ";\n")
+	with open(SNAPSHOT_FILE, 'w') as snapshot_file:
+		snapshot_file.write(json.dumps(schema, indent="\t") + "\n")
+	return path
+
+parser = argparse.ArgumentParser(description="Generates SQLAlchemy tables from drywall object definitions.")
+parser.add_argument('--migration', metavar='NAME',
+                    help="write a migration with the changes made to drywall/db_models.py")
+parser.add_argument('--check', action='store_true',
+                    help="exit with an error if drywall/db_models.py has changes without a migration")
+args = parser.parse_args()
+if args.migration:
+	migration_path = write_migration(args.migration)
+	if not migration_path:
+		print("No changes to migrate.", file=sys.stderr)
+		sys.exit(1)
+	print("Wrote " + os.path.normpath(migration_path), file=sys.stderr)
+	sys.exit(0)
+elif args.check:
+	pending_statements = get_pending_changes()[0]
+	if pending_statements:
+		print("Changes without a migration:\n" + ";\n".join(pending_statements), file=sys.stderr)
+		sys.exit(1)
+	sys.exit(0)
+
 object_tables = {}
 
 print("""# The following tables have been generated by alchemify.py from the
@@ -111,15 +326,18 @@ print("""# The following tables have been generated by alchemify.py from the
 # https://punctum-im.github.io/drywall/dev/alchemify""")
 
 print("""
-from sqlalchemy import Column, ForeignKey
-from sqlalchemy import Integer, String, DateTime, Boolean, SmallInteger, Text
-from sqlalchemy.orm import declarative_base
+from sqlalchemy import Column, Computed, ForeignKey, Index, text
+from sqlalchemy import BigInteger, Integer, String, DateTime, Boolean, SmallInteger, Text, Float
+from sqlalchemy.orm import declarative_base, deferred
 from sqlalchemy.dialects import postgresql
 from sqlalchemy_serializer import SerializerMixin
 import datetime
 
 Base = declarative_base()
 
+# Text search configuration used for search vectors and queries.
+TEXT_SEARCH_CONFIG = '""" + TEXT_SEARCH_CONFIG + """'
+
 class CustomSerializerMixin(SerializerMixin):
 	# TODO: Ideally we'd just set datetime_format to None to set it to isoformat,
 	#       but that leaves out the +00:00 suffix, because we're missing
@@ -134,9 +352,13 @@ print("""
 # Main object lookup table
 class Objects(Base):
 	__tablename__ = 'objects'
+	__table_args__ = (Index('ix_objects_deleted', 'deleted', postgresql_where=text('deleted IS NOT NULL')),)
 
 	id = Column(String(255), primary_key=True)
 	object_type = Column(String(255), nullable=False)
+	# Set when the object is deleted, until its dependents are removed in
+	# the background (see drywall/deletion.py)
+	deleted = Column(DateTime)
 """)
 
 for object in objects.objects:
@@ -148,7 +370,11 @@ for object in objects.objects:
 		object_table.columns[key] = "Column(" + key_type_to_sql(object.key_types[key]) + ormify([is_id(object_properties, key),
 			is_required(object_properties, key),
 			is_unique(object_properties, key),
+			is_indexed(object_properties, key),
 			set_defaults(object_properties, key)]) + ")"
+	add_declared_indexes(object_table, object_properties)
+	add_array_indexes(object_table, object_properties)
+	add_search_vector(object_table, object_properties)
 	object_table.dump_orm()
 	object_tables[object_type] = object_table
 
@@ -161,6 +387,122 @@ class User(Base, SerializerMixin):
 	username = Column(String(255), nullable=False, unique=True)
 	password = Column(Text, nullable=False)""")
 
+print("""
+# OAuth2 clients
+class Client(Base, SerializerMixin):
+	__tablename__ = "clients"
+
+	client_id = Column(String(255), primary_key=True)
+	client_secret = Column(String(255), nullable=False)
+	name = Column(Text, nullable=False)
+	description = Column(Text)
+	scopes = Column(postgresql.ARRAY(String(255)))
+	owner = Column(String(255), ForeignKey('account.id'), nullable=False, index=True)
+	type = Column(String(255), nullable=False)
+	account_id = Column(String(255), ForeignKey('account.id'))""")
+
+print("""
+# Revoked access tokens
+class RevokedToken(Base):
+	__tablename__ = "revoked_tokens"
+
+	jti = Column(String(255), primary_key=True)
+	expires = Column(DateTime, nullable=False, index=True)""")
+
+print("""
+# Rate limit token buckets, for the database rate limit backend
+class RateLimitBucket(Base):
+	__tablename__ = "rate_limit_buckets"
+
+	key = Column(String(255), primary_key=True)
+	tokens = Column(Float, nullable=False)
+	rate = Column(Float, nullable=False)
+	burst = Column(Float, nullable=False)
+	allowed = Column(Boolean, nullable=False)
+	updated = Column(DateTime, nullable=False)""")
+
+print("""
+# Background jobs; see drywall/jobs.py
+class Job(Base):
+	__tablename__ = "jobs"
+	__table_args__ = (Index('ix_jobs_queue_priority_run_at_id', 'queue', 'priority', 'run_at', 'id',
+		postgresql_where=text('failed IS NULL')),)
+
+	id = Column(BigInteger, primary_key=True)
+	queue = Column(String(255), nullable=False)
+	task = Column(String(255), nullable=False)
+	payload = Column(postgresql.JSONB, nullable=False)
+	priority = Column(SmallInteger, nullable=False, default=0)
+	attempts = Column(Integer, nullable=False, default=0)
+	max_attempts = Column(Integer, nullable=False)
+	# When the job can run next; pushed forward while the job is running
+	# (see job_lease_time) and after failed attempts
+	run_at = Column(DateTime, nullable=False)
+	created = Column(DateTime, nullable=False)
+	last_error = Column(Text)
+	# Set once the job has used up all of its attempts
+	failed = Column(DateTime)""")
+
+print("""
+# Message counters for unread counts; see db.get_unread_counts
+class ChannelState(Base):
+	__tablename__ = "channel_state"
+
+	channel_id = Column(String(255), ForeignKey('channel.id', ondelete='CASCADE'), primary_key=True)
+	# Amount of messages ever posted in the channel
+	message_count = Column(BigInteger, nullable=False, default=0)
+	last_message = Column(String(255))
+	last_message_date = Column(DateTime)""")
+
+print("""
+# Position of messages in their channel; see db.mark_channel_read
+class MessagePosition(Base):
+	__tablename__ = "message_position"
+
+	message_id = Column(String(255), ForeignKey('message.id', ondelete='CASCADE'), primary_key=True)
+	# The channel's message_count right after the message was posted
+	position = Column(BigInteger, nullable=False)""")
+
+print("""
+# How far accounts have read in channels
+class ReadState(Base):
+	__tablename__ = "read_state"
+
+	account_id = Column(String(255), ForeignKey('account.id', ondelete='CASCADE'), primary_key=True)
+	channel_id = Column(String(255), ForeignKey('channel.id', ondelete='CASCADE'), primary_key=True, index=True)
+	last_read_message = Column(String(255))
+	# The channel's message_count at last_read_message
+	read_count = Column(BigInteger, nullable=False, default=0)
+	# Amount of messages mentioning the account posted since last_read_message
+	mention_count = Column(Integer, nullable=False, default=0)""")
+
+print("""
+# Reactions to messages; see db.add_reaction
+class Reaction(Base):
+	__tablename__ = "reactions"
+
+	message_id = Column(String(255), ForeignKey('message.id', ondelete='CASCADE'), primary_key=True)
+	emoji = Column(String(255), primary_key=True)
+	account_id = Column(String(255), ForeignKey('account.id', ondelete='CASCADE'), primary_key=True, index=True)
+	created = Column(DateTime, nullable=False)""")
+
+print("""
+# Amount of reactions with each emoji on messages
+class ReactionCount(Base):
+	__tablename__ = "reaction_counts"
+
+	message_id = Column(String(255), ForeignKey('message.id', ondelete='CASCADE'), primary_key=True)
+	emoji = Column(String(255), primary_key=True)
+	count = Column(Integer, nullable=False, default=0)""")
+
+print("""
+# Applied migrations
+class SchemaMigration(Base):
+	__tablename__ = "schema_migrations"
+
+	version = Column(String(255), primary_key=True)
+	applied = Column(DateTime, nullable=False)""")
+
 print("""
 # Helper functions
 """)